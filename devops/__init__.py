@@ -12,16 +12,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+import logging
+import logging.config
 import os
+import threading
 import time
-import logging.config
 from devops import settings
 
 __version__ = '3.0.3'
 
-if not os.path.exists(settings.LOGS_DIR):
-    os.makedirs(settings.LOGS_DIR)
-
 LOGGER_SETTINGS = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -61,7 +61,65 @@ LOGGER_SETTINGS = {
     },
 }
 
-logging.config.dictConfig(LOGGER_SETTINGS)
+_logging_lock = threading.Lock()
+_logging_configured = False
+
+
+def _console_settings():
+    """LOGGER_SETTINGS without handlers which write to files"""
+    config = copy.deepcopy(LOGGER_SETTINGS)
+    file_handlers = {name for name, handler in config['handlers'].items()
+                     if 'filename' in handler}
+    for name in file_handlers:
+        del config['handlers'][name]
+    for logger_config in config['loggers'].values():
+        if 'handlers' in logger_config:
+            logger_config['handlers'] = [
+                name for name in logger_config['handlers']
+                if name not in file_handlers]
+    return config
+
+
+def setup_logging():
+    """Create LOGS_DIR and configure logging using LOGGER_SETTINGS
+
+    Everything but log files is configured at import. This is called
+    on the first record logged by devops, so commands which do not log
+    anything (e.g. 'dos.py list') do not create LOGS_DIR and log files.
+    """
+    global _logging_configured
+    with _logging_lock:
+        if _logging_configured:
+            return
+        if not os.path.exists(settings.LOGS_DIR):
+            os.makedirs(settings.LOGS_DIR)
+
+        # dictConfig replaces handlers of the 'devops' logger; give it a new
+        # list, so the one iterated by the logger calling us is kept intact
+        logger.handlers = []
+        logging.config.dictConfig(LOGGER_SETTINGS)
+        _logging_configured = True
+
+
+class _DeferredSetupHandler(logging.Handler):
+    """Handler which sets up log files and passes the record to them"""
+
+    def handle(self, record):
+        setup_logging()
+        # console handlers configured at import got the record already
+        for handler in logger.handlers:
+            if (isinstance(handler, logging.FileHandler) and
+                    record.levelno >= handler.level):
+                handler.handle(record)
+        return True
+
+    def emit(self, record):
+        pass
+
+
+logging.config.dictConfig(_console_settings())
 # set logging timezone to GMT
 logging.Formatter.converter = time.gmtime
+
 logger = logging.getLogger(__name__)
+logger.addHandler(_DeferredSetupHandler())
@@ -13,6 +13,7 @@
 #    under the License.
 
 from devops.client import environment
+from devops.helpers import capacity
 from devops.helpers import templates
 from devops import models
 from devops import settings
@@ -33,6 +34,35 @@ class DevopsClient(object):
     def list_env_names():
         return [env.name for env in models.Environment.list_all()]
 
+    @staticmethod
+    def list_envs():
+        """Get all environments with a single query
+
+        :rtype: list
+        """
+        return list(models.Environment.list_all())
+
+    @staticmethod
+    def get_admin_ips():
+        """Get IP addresses of admin nodes of all environments
+
+        Gives the same addresses as DevopsEnvironment.get_admin_ip(),
+        but for all environments with a single query.
+
+        :rtype: dict
+        :returns: {environment name: admin node IP address}
+        """
+        addresses = models.Address.objects.filter(
+            interface__node__name='admin',
+            interface__l2_network_device__name=settings.SSH_CREDENTIALS[
+                'admin_network'],
+        ).order_by(
+            # the first interface of a node wins, as in get_admin_ip()
+            '-interface__id', '-id',
+        ).values_list(
+            'interface__node__group__environment__name', 'ip_address')
+        return dict(addresses)
+
     @staticmethod
     def synchronize_all():
         models.Environment.synchronize_all()
@@ -49,6 +79,18 @@ class DevopsClient(object):
         env = models.Environment.create_environment(config)
         return environment.DevopsEnvironment(env)
 
+    @staticmethod
+    def plan_env_from_config(config):
+        """Check if the host has enough resources for env from template
+
+        :type config: str or dict
+        :rtype: devops.helpers.capacity.CapacityReport
+        """
+        if isinstance(config, str):
+            config = templates.get_devops_config(config)
+
+        return capacity.plan_environment(config)
+
     def create_env(self,
                    boot_from='cdrom',
                    env_name=None,
@@ -12,20 +12,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import paramiko
 # pylint: disable=redefined-builtin
 # noinspection PyUnresolvedReferences
 from six.moves import xrange
 # pylint: enable=redefined-builtin
 
-from devops.client import nailgun
 from devops import error
 from devops.helpers import helpers
-from devops.helpers import ntp
+from devops.helpers import loader
 from devops.helpers import ssh_client
 from devops.helpers import templates
 from devops import settings
 
+paramiko = loader.lazy_import('paramiko')
+nailgun = loader.lazy_import('devops.client.nailgun')
+ntp = loader.lazy_import('devops.helpers.ntp')
+
 
 class DevopsEnvironment(object):
     """DevopsEnvironment
@@ -53,31 +55,35 @@ class DevopsEnvironment(object):
         created_nodes = len(group.get_nodes())
 
         new_nodes = []
-        for node_num in xrange(created_nodes, created_nodes + nodes_count):
-            node_name = "slave-{:02d}".format(node_num)
-            slave_conf = templates.create_slave_config(
-                slave_name=node_name,
-                slave_role='fuel_slave',
-                slave_vcpu=slave_vcpu,
-                slave_memory=slave_memory,
-                slave_volume_capacity=settings.NODE_VOLUME_SIZE,
-                second_volume_capacity=second_volume_capacity,
-                third_volume_capacity=third_volume_capacity,
-                interfaceorder=settings.INTERFACE_ORDER,
-                numa_nodes=settings.HARDWARE['numa_nodes'],
-                use_all_disks=True,
-                networks_multiplenetworks=settings.MULTIPLE_NETWORKS,
-                networks_nodegroups=settings.NODEGROUPS,
-                networks_bonding=settings.BONDING,
-                networks_bondinginterfaces=settings.BONDING_INTERFACES,
-            )
-            node = group.add_node(**slave_conf)
-            if force_define is True:
-                for volume in node.get_volumes():
-                    volume.define()
-                node.define()
-
-            new_nodes.append(node)
+        # static leases of all new nodes are added to running networks
+        # at once
+        with group.driver.dhcp_hosts_batch():
+            for node_num in xrange(created_nodes,
+                                   created_nodes + nodes_count):
+                node_name = "slave-{:02d}".format(node_num)
+                slave_conf = templates.create_slave_config(
+                    slave_name=node_name,
+                    slave_role='fuel_slave',
+                    slave_vcpu=slave_vcpu,
+                    slave_memory=slave_memory,
+                    slave_volume_capacity=settings.NODE_VOLUME_SIZE,
+                    second_volume_capacity=second_volume_capacity,
+                    third_volume_capacity=third_volume_capacity,
+                    interfaceorder=settings.INTERFACE_ORDER,
+                    numa_nodes=settings.HARDWARE['numa_nodes'],
+                    use_all_disks=True,
+                    networks_multiplenetworks=settings.MULTIPLE_NETWORKS,
+                    networks_nodegroups=settings.NODEGROUPS,
+                    networks_bonding=settings.BONDING,
+                    networks_bondinginterfaces=settings.BONDING_INTERFACES,
+                )
+                node = group.add_node(**slave_conf)
+                if force_define is True:
+                    for volume in node.get_volumes():
+                        volume.define()
+                    node.define()
+
+                new_nodes.append(node)
 
         return new_nodes
 
@@ -103,7 +109,7 @@ class DevopsEnvironment(object):
         return admin_node
 
     def get_active_nodes(self):
-        return [node for node in self._env.get_nodes() if node.is_active()]
+        return self._env.get_active_nodes()
 
     def get_admin(self):
         if self.has_admin():
@@ -0,0 +1,169 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fcntl
+import json
+import os
+# noinspection PyPep8Naming
+import xml.etree.ElementTree as ET
+
+from django.conf import settings
+
+from devops import error
+from devops import logger
+
+
+class HostCapabilities(object):
+    """Parsed host capabilities with precomputed lookup tables
+
+    :param xml: capabilities XML returned by virConnect.getCapabilities()
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        self.root = ET.fromstring(xml)
+        # {(architecture, domain type): emulator path}
+        self.emulators = {}
+        # {(os type, architecture): {feature name: attributes}}
+        self.guest_features = {}
+
+        for guest in self.root.findall('guest'):
+            os_type = guest.findtext('os_type')
+            features = guest.find('features')
+            for arch in guest.findall('arch'):
+                arch_name = arch.get('name')
+                default_emulator = arch.findtext('emulator')
+                for domain in arch.findall('domain'):
+                    self.emulators[(arch_name, domain.get('type'))] = (
+                        domain.findtext('emulator') or default_emulator)
+                self.guest_features[(os_type, arch_name)] = {
+                    feature.tag: dict(feature.attrib)
+                    for feature in (features if features is not None else [])}
+
+    def supports(self, architecture, hypervisor):
+        """Check if the host can run guests of the architecture
+
+        :rtype: bool
+        """
+        return (architecture, hypervisor) in self.emulators
+
+    def get_emulator(self, architecture, hypervisor):
+        """Get path to the emulator for guests of the architecture
+
+        :rtype: str
+        """
+        try:
+            return self.emulators[(architecture, hypervisor)]
+        except KeyError:
+            raise error.DevopsError(
+                'Host does not support {0} guests of {1} '
+                'architecture'.format(hypervisor, architecture))
+
+    def get_guest_features(self, architecture, os_type='hvm'):
+        """Get features of guests of the architecture
+
+        :rtype: dict
+        :returns: {feature name: attributes}
+        """
+        return self.guest_features.get((os_type, architecture), {})
+
+
+class CapabilitiesCache(object):
+    """On-disk cache of host capabilities shared by all processes
+
+    Capabilities are stored per connection URI together with versions of
+    libvirt and the hypervisor, and requested again when any of them is
+    changed. The cache is disabled if the path is empty.
+
+    :param cache_path: path to JSON file, LIBVIRT_CAPABILITIES_CACHE
+        by default
+    """
+
+    def __init__(self, cache_path=None):
+        self._cache_path = cache_path
+
+    @property
+    def cache_path(self):
+        if self._cache_path is not None:
+            return self._cache_path
+        return settings.LIBVIRT_CAPABILITIES_CACHE
+
+    @staticmethod
+    def get_versions(conn):
+        """Get versions of libvirt daemon and hypervisor
+
+        :type conn: libvirt.virConnect
+        :rtype: list
+        """
+        return [conn.getLibVersion(), conn.getVersion()]
+
+    def _load(self, uri, versions):
+        try:
+            with open(self.cache_path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                try:
+                    record = json.load(f).get(uri)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except (IOError, OSError, ValueError):
+            return None
+        if record is None or record.get('versions') != versions:
+            return None
+        return record.get('xml')
+
+    def _store(self, uri, versions, xml):
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.cache_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                try:
+                    cache = json.loads(content) if content else {}
+                except ValueError:
+                    logger.warning('Capabilities cache {} is corrupted, '
+                                   'resetting it'.format(self.cache_path))
+                    cache = {}
+                cache[uri] = {'versions': versions, 'xml': xml}
+                f.seek(0)
+                f.truncate()
+                json.dump(cache, f, indent=2, sort_keys=True)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, conn, uri):
+        """Get capabilities of the host from the cache or from libvirt
+
+        :type conn: libvirt.virConnect
+        :param uri: connection string
+        :rtype: HostCapabilities
+        """
+        if not self.cache_path:
+            return HostCapabilities(conn.getCapabilities())
+
+        versions = self.get_versions(conn)
+        xml = self._load(uri, versions)
+        if xml is None:
+            xml = conn.getCapabilities()
+            try:
+                self._store(uri, versions, xml)
+            except (IOError, OSError) as e:
+                logger.warning('Unable to store capabilities cache {0}: '
+                               '{1}'.format(self.cache_path, e))
+        return HostCapabilities(xml)
+
+
+capabilities_cache = CapabilitiesCache()
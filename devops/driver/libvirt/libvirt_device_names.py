@@ -0,0 +1,160 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from devops.helpers import helpers
+from devops import logger
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class DeviceNameAllocator(object):
+    """Allocates unused names of bridges and network devices of a host
+
+    Names used on the host are listed once per batch. Every name given
+    out is remembered, so threads of the process never get the same name,
+    and it is also reserved in a file shared by processes of all users of
+    this machine (DEVICE_NAMES_LOCK) until the process exits, so concurrent
+    dos.py runs don't pick the same name before the device is created.
+
+    :param uri: connection string of the host
+    :param list_names: callable which returns names used on the host
+    :param lock_path: path to the reservations file, empty value disables
+        reservations between processes
+    """
+
+    # Reservations of processes which are alive are dropped after this
+    # number of seconds in case the pid was reused
+    reservation_timeout = 24 * 60 * 60
+
+    def __init__(self, uri, list_names, lock_path=None):
+        self.uri = uri
+        self.list_names = list_names
+        self._lock_path = lock_path
+        self._lock = threading.Lock()
+        self._reserved = set()
+        # {prefix: index of the next name to check}
+        self._next_index = {}
+        self._batch_depth = 0
+        self._host_names = None
+
+    @property
+    def lock_path(self):
+        if self._lock_path is not None:
+            return self._lock_path
+        return settings.DEVICE_NAMES_LOCK
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Use one listing of host names for all allocations in the block"""
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._host_names = None
+
+    def _get_host_names(self):
+        if self._host_names is not None:
+            return self._host_names
+        names = set(self.list_names())
+        if self._batch_depth:
+            self._host_names = names
+        return names
+
+    @contextlib.contextmanager
+    def _shared_reservations(self):
+        """Lock the reservations file and yield names reserved for the host
+
+        Names added to the yielded set are reserved by this process.
+        """
+        if not self.lock_path:
+            yield set()
+            return
+
+        try:
+            f = helpers.open_shared_file(self.lock_path)
+        except (IOError, OSError) as e:
+            logger.warning('Unable to reserve device names in {0}: '
+                           '{1}'.format(self.lock_path, e))
+            yield set()
+            return
+
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                try:
+                    reservations = json.loads(content) if content else {}
+                except ValueError:
+                    reservations = {}
+
+                now = time.time()
+                host_reservations = {
+                    name: record
+                    for name, record in reservations.get(self.uri, {}).items()
+                    if now - record['time'] < self.reservation_timeout and
+                    _is_process_alive(record['pid'])}
+                names = set(host_reservations)
+                yield names
+
+                for name in names.difference(host_reservations):
+                    host_reservations[name] = {'pid': os.getpid(),
+                                               'time': now}
+                reservations[self.uri] = host_reservations
+                f.seek(0)
+                f.truncate()
+                json.dump(reservations, f, indent=2, sort_keys=True)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def allocate(self, prefix, count=1):
+        """Get names which are not used on the host and not reserved
+
+        :type prefix: str
+        :type count: int
+        :rtype: list
+        """
+        with self._lock, self._shared_reservations() as shared:
+            used = self._get_host_names() | self._reserved | shared
+            names = []
+            index = self._next_index.get(prefix, 0)
+            while len(names) < count:
+                name = '{0}{1}'.format(prefix, index)
+                index += 1
+                if name not in used:
+                    names.append(name)
+            self._next_index[prefix] = index
+            self._reserved.update(names)
+            shared.update(names)
+        return names
@@ -12,11 +12,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
 import datetime
-import itertools
+import errno
+import functools
+import hashlib
+from multiprocessing import pool as mp_pool
 import os
 import re
 import shutil
+import sys
+import threading
 import time
 import uuid
 import warnings
@@ -24,16 +31,25 @@ import warnings
 import xml.etree.ElementTree as ET
 
 from django.conf import settings
-from django.utils import functional
 import libvirt
 import netaddr
 import paramiko
-
+import six
+
+from devops.driver.libvirt import libvirt_capabilities
+from devops.driver.libvirt import libvirt_device_names
+from devops.driver.libvirt import libvirt_image_cache
+from devops.driver.libvirt import libvirt_memory_files
+from devops.driver.libvirt import libvirt_nwfilters
+from devops.driver.libvirt import libvirt_snapshot_index
+from devops.driver.libvirt import libvirt_stats
+from devops.driver.libvirt import libvirt_volume_pipeline
 from devops.driver.libvirt import libvirt_xml_builder as builder
 from devops import error
 from devops.helpers import cloud_image_settings
 from devops.helpers import decorators
 from devops.helpers import helpers
+from devops.helpers import instrumentation
 from devops.helpers import scancodes
 from devops.helpers import ssh_client
 from devops.helpers import subprocess_runner
@@ -51,12 +67,24 @@ class _LibvirtManager(object):
         libvirt.virInitialize()
         libvirt.registerErrorHandler(_LibvirtManager._error_handler, self)
         self.connections = {}
+        self.storage_pools = {}
+        self.pool_target_paths = {}
+        self.capabilities = {}
+        self.nwfilter_states = {}
 
     def get_connection(self, connection_string):
         """Get libvirt connection for connection string
 
+        Calls of the connection and objects it returns are measured if
+        'libvirt' instrumentation is enabled.
+
         :type connection_string: str
         """
+        conn = self._get_connection(connection_string)
+        return instrumentation.instrument(conn, 'libvirt',
+                                          wrapped_modules=('libvirt',))
+
+    def _get_connection(self, connection_string):
         if connection_string in self.connections:
             conn = self.connections[connection_string]
             if conn.isAlive():
@@ -68,8 +96,81 @@ class _LibvirtManager(object):
         # Create a new connection
         conn = libvirt.open(connection_string)
         self.connections[connection_string] = conn
+        # Pool handles of the previous connection are not valid anymore
+        self.storage_pools.pop(connection_string, None)
+        self.pool_target_paths.pop(connection_string, None)
+        # libvirtd could be restarted with another version
+        self.capabilities.pop(connection_string, None)
+        self.nwfilter_states.pop(connection_string, None)
         return conn
 
+    def get_capabilities(self, connection_string):
+        """Get host capabilities cached for the connection
+
+        :type connection_string: str
+        :rtype: libvirt_capabilities.HostCapabilities
+        """
+        conn = self.get_connection(connection_string)
+        if connection_string not in self.capabilities:
+            self.capabilities[connection_string] = (
+                libvirt_capabilities.capabilities_cache.get(
+                    conn, connection_string))
+        return self.capabilities[connection_string]
+
+    def get_nwfilter_states(self, connection_string):
+        """Get cached states of nwfilters of the connection
+
+        :type connection_string: str
+        :rtype: libvirt_nwfilters.NWFilterStates
+        """
+        conn = self.get_connection(connection_string)
+        if connection_string not in self.nwfilter_states:
+            self.nwfilter_states[connection_string] = (
+                libvirt_nwfilters.NWFilterStates(conn))
+        return self.nwfilter_states[connection_string]
+
+    def get_storage_pool(self, connection_string, name):
+        """Get cached storage pool handle
+
+        :type connection_string: str
+        :type name: str
+        :rtype: libvirt.virStoragePool
+        """
+        conn = self.get_connection(connection_string)
+        pools = self.storage_pools.setdefault(connection_string, {})
+        if name not in pools:
+            pools[name] = conn.storagePoolLookupByName(name)
+            # the pool could be redefined with another target
+            self.pool_target_paths.get(connection_string, {}).pop(name, None)
+        return pools[name]
+
+    def get_pool_target_path(self, connection_string, pool):
+        """Get target directory of the storage pool cached for connection
+
+        :type connection_string: str
+        :type pool: libvirt.virStoragePool
+        :rtype: str
+        """
+        paths = self.pool_target_paths.setdefault(connection_string, {})
+        name = pool.name()
+        if name not in paths:
+            paths[name] = ET.fromstring(
+                pool.XMLDesc(0)).findtext('target/path')
+        return paths[name]
+
+    def get_storage_pools(self, connection_string):
+        """Get all storage pool handles cached for the connection
+
+        :rtype: dict
+        :returns: {pool name: libvirt.virStoragePool}
+        """
+        self.get_connection(connection_string)
+        return dict(self.storage_pools.get(connection_string, {}))
+
+    def forget_storage_pool(self, connection_string, name):
+        self.storage_pools.get(connection_string, {}).pop(name, None)
+        self.pool_target_paths.get(connection_string, {}).pop(name, None)
+
     def _error_handler(self, error):
         # this handler redirects libvirt messages to debug logger
         if len(error) > 2 and error[2] is not None:
@@ -96,6 +197,9 @@ class Snapshot(object):
         snap_memory = self._xml_tree.findall('./memory')[0]
         if snap_memory.get('file') is not None:
             snap_files.append(snap_memory.get('file'))
+            # memory file may be compressed after the snapshot is created
+            snap_files.append(
+                snap_memory.get('file') + libvirt_memory_files.SUFFIX)
         return snap_files
 
     def delete_snapshot_files(self):
@@ -201,12 +305,120 @@ class Snapshot(object):
                                       self.name, self.created)
 
 
+def _get_vnc_port(xml_desc):
+    """Get VNC port from domain XML description
+
+    :type xml_desc: str
+    :rtype: str or None
+    """
+    vnc_element = ET.fromstring(xml_desc).find(
+        'devices/graphics[@type="vnc"][@port]')
+    if vnc_element is not None:
+        return vnc_element.get('port')
+
+
+class DomainState(driver.NodeState):
+    """State and resource usage of a libvirt domain
+
+    Wraps one record returned by virConnect.getAllDomainStats()
+
+    :type domain: libvirt.virDomain
+    :type stats: dict
+    """
+
+    STATUS_NAMES = {
+        libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
+        libvirt.VIR_DOMAIN_RUNNING: 'running',
+        libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
+        libvirt.VIR_DOMAIN_PAUSED: 'paused',
+        libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
+        libvirt.VIR_DOMAIN_SHUTOFF: 'shutoff',
+        libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+        libvirt.VIR_DOMAIN_PMSUSPENDED: 'pmsuspended',
+    }
+
+    def __init__(self, domain, stats):
+        self.domain = domain
+        self.stats = stats
+        self.state = stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE)
+        super(DomainState, self).__init__(
+            active=self.state not in (libvirt.VIR_DOMAIN_NOSTATE,
+                                      libvirt.VIR_DOMAIN_SHUTOFF,
+                                      libvirt.VIR_DOMAIN_CRASHED),
+            paused=self.state == libvirt.VIR_DOMAIN_PAUSED)
+
+    @property
+    def status(self):
+        return self.STATUS_NAMES.get(self.state, 'unknown')
+
+    @property
+    def cpu_time(self):
+        """Total CPU time spent by the domain in nanoseconds"""
+        return self.stats.get('cpu.time')
+
+    @property
+    def vcpu(self):
+        """Current vCPU count, None if not reported"""
+        return self.stats.get('vcpu.current')
+
+    @property
+    def memory(self):
+        """Current balloon size in KiB, None if not reported"""
+        return self.stats.get('balloon.current')
+
+    @property
+    def block(self):
+        """Block devices statistics
+
+        :rtype: list
+        """
+        devices = []
+        for i in range(self.stats.get('block.count', 0)):
+            prefix = 'block.{}.'.format(i)
+            devices.append(dict(
+                name=self.stats.get(prefix + 'name'),
+                path=self.stats.get(prefix + 'path'),
+                rd_reqs=self.stats.get(prefix + 'rd.reqs', 0),
+                rd_bytes=self.stats.get(prefix + 'rd.bytes', 0),
+                wr_reqs=self.stats.get(prefix + 'wr.reqs', 0),
+                wr_bytes=self.stats.get(prefix + 'wr.bytes', 0),
+                allocation=self.stats.get(prefix + 'allocation'),
+                capacity=self.stats.get(prefix + 'capacity'),
+            ))
+        return devices
+
+    @property
+    def net(self):
+        """Network interfaces statistics
+
+        :rtype: list
+        """
+        interfaces = []
+        for i in range(self.stats.get('net.count', 0)):
+            prefix = 'net.{}.'.format(i)
+            interfaces.append(dict(
+                name=self.stats.get(prefix + 'name'),
+                rx_bytes=self.stats.get(prefix + 'rx.bytes', 0),
+                rx_pkts=self.stats.get(prefix + 'rx.pkts', 0),
+                tx_bytes=self.stats.get(prefix + 'tx.bytes', 0),
+                tx_pkts=self.stats.get(prefix + 'tx.pkts', 0),
+            ))
+        return interfaces
+
+
 class LibvirtDriver(driver.Driver):
     """libvirt driver
 
     :param use_host_cpu: When creating nodes, should libvirt's
         CPU "host-model" mode be used to set CPU settings. If set to False,
         default mode ("custom") will be used.  (default: True)
+    :param use_image_cache: upload every source image to the storage pool
+        only once and create volumes as qcow2 overlays of it
+        (default: False)
+    :param stats_interval: seconds between resource usage samples taken
+        by the stats collector (default: 5)
+    :param stats_buffer_size: number of samples kept for every node
+        (default: 120)
 
     Note: This class is imported as Driver at .__init__.py
     """
@@ -221,8 +433,25 @@ class LibvirtDriver(driver.Driver):
     reboot_timeout = base.ParamField()
     use_hugepages = base.ParamField(default=False)
     vnc_password = base.ParamField()
-
-    _device_name_generators = {}
+    use_image_cache = base.ParamField(default=False)
+    stats_interval = base.ParamField(default=5)
+    stats_buffer_size = base.ParamField(default=120)
+    # flatten backing chains of external snapshot disks which are
+    # longer than this number of backing files, 0 disables flattening
+    snapshot_flatten_depth = base.ParamField(default=0)
+    snapshot_flatten_timeout = base.ParamField(default=3600)
+
+    _device_name_allocators = {}
+    # interfaces collected by dhcp_hosts_batch() of the current thread
+    _dhcp_hosts_batch = threading.local()
+
+    # Statistics requested from getAllDomainStats() by the stats collector
+    domain_stats = (libvirt.VIR_DOMAIN_STATS_STATE |
+                    libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                    libvirt.VIR_DOMAIN_STATS_VCPU |
+                    libvirt.VIR_DOMAIN_STATS_BALLOON |
+                    libvirt.VIR_DOMAIN_STATS_INTERFACE |
+                    libvirt.VIR_DOMAIN_STATS_BLOCK)
 
     @property
     def conn(self):
@@ -239,15 +468,472 @@ class LibvirtDriver(driver.Driver):
         """
         return self.capabilities
 
-    @functional.cached_property
+    @property
     def capabilities(self):
-        return ET.fromstring(self.conn.getCapabilities())
+        return self.host_capabilities.root
+
+    @property
+    def host_capabilities(self):
+        """Host capabilities shared by all drivers of the connection
+
+        :rtype: libvirt_capabilities.HostCapabilities
+        """
+        return LibvirtManager.get_capabilities(self.connection_string)
 
     def node_list(self):
         # virConnect.listDefinedDomains() only returns stopped domains
         #   https://bugzilla.redhat.com/show_bug.cgi?id=839259
         return [item.name() for item in self.conn.listAllDomains()]
 
+    @decorators.retry(libvirt.libvirtError)
+    def get_domains_state(self, stats=libvirt.VIR_DOMAIN_STATS_STATE):
+        """Get state of all domains of the connection in one request
+
+        Falls back to listing domains by state flags if the hypervisor
+        doesn't support getAllDomainStats().
+
+        :param stats: VIR_DOMAIN_STATS_* groups to request, only the
+            state by default
+        :rtype: dict
+        :returns: {domain UUID: DomainState}
+        """
+        try:
+            records = self.conn.getAllDomainStats(stats, 0)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+                raise
+            records = self._list_domains_state()
+        return {dom.UUIDString(): DomainState(dom, stats)
+                for dom, stats in records}
+
+    def _list_domains_state(self):
+        paused = {dom.UUIDString() for dom in self.conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_PAUSED)}
+        active = {dom.UUIDString() for dom in self.conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)}
+
+        records = []
+        for dom in self.conn.listAllDomains():
+            uuid_str = dom.UUIDString()
+            if uuid_str in paused:
+                state = libvirt.VIR_DOMAIN_PAUSED
+            elif uuid_str in active:
+                state = libvirt.VIR_DOMAIN_RUNNING
+            else:
+                state = libvirt.VIR_DOMAIN_SHUTOFF
+            records.append((dom, {'state.state': state}))
+        return records
+
+    @property
+    def storage_pool(self):
+        """Cached handle of the storage pool of the driver
+
+        :rtype: libvirt.virStoragePool
+        """
+        return self.get_storage_pool()
+
+    def get_storage_pool(self, name=None):
+        """Get cached storage pool handle
+
+        :param name: pool name, storage pool of the driver if None
+        :rtype: libvirt.virStoragePool
+        """
+        return LibvirtManager.get_storage_pool(
+            self.connection_string, name or self.storage_pool_name)
+
+    def get_volume_pool(self, libvirt_volume):
+        """Get cached handle of the storage pool containing the volume
+
+        Pools are matched by the target directory, so no request is sent
+        to libvirt for volumes of already known pools.
+
+        :type libvirt_volume: libvirt.virStorageVol
+        :rtype: libvirt.virStoragePool
+        """
+        vol_dir = os.path.dirname(libvirt_volume.path())
+        pools = LibvirtManager.get_storage_pools(self.connection_string)
+        for pool in pools.values():
+            if LibvirtManager.get_pool_target_path(
+                    self.connection_string, pool) == vol_dir:
+                return pool
+        pool = libvirt_volume.storagePoolLookupByVolume()
+        return self.get_storage_pool(pool.name())
+
+    @decorators.retry(libvirt.libvirtError)
+    def refresh_storage_pool(self, pool=None):
+        """Refresh volumes list of the storage pool
+
+        :type pool: libvirt.virStoragePool
+        """
+        pool = pool or self.storage_pool
+        try:
+            pool.refresh(0)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_POOL:
+                LibvirtManager.forget_storage_pool(self.connection_string,
+                                                   pool.name())
+            raise
+
+    def create_volumes(self, xmls, pool=None, refresh=True):
+        """Create several volumes in one storage pool
+
+        :param xmls: list of volume XMLs
+        :type pool: libvirt.virStoragePool
+        :param refresh: refresh the pool once after all volumes are created
+        :rtype: list
+        :returns: list of created libvirt.virStorageVol
+        """
+        pool = pool or self.storage_pool
+        volumes = [pool.createXML(xml, 0) for xml in xmls]
+        if refresh and volumes:
+            self.refresh_storage_pool(pool)
+        return volumes
+
+    @decorators.retry(libvirt.libvirtError)
+    def get_storage_pool_info(self, name=None):
+        """Get capacity of the storage pool
+
+        :param name: pool name, storage pool of the driver if None
+        :rtype: dict
+        :returns: {'capacity': ..., 'allocation': ..., 'available': ...}
+            in bytes
+        """
+        _, capacity, allocation, available = self.get_storage_pool(
+            name).info()
+        return {'capacity': capacity,
+                'allocation': allocation,
+                'available': available}
+
+    def get_free_hugepages(self):
+        """Get free memory in hugepages of the default size
+
+        :rtype: int or None
+        :returns: megabytes, None if the host can't report free pages or
+            reports no hugepage sizes
+        """
+        sizes = [int(pages.get('size'))
+                 for pages in self.capabilities.findall('host/cpu/pages')
+                 if pages.get('unit', 'KiB') == 'KiB' and
+                 int(pages.get('size')) > 4]
+        if not sizes:
+            return None
+        size = min(sizes)
+        cells = len(self.capabilities.findall('host/topology/cells/cell'))
+        try:
+            free_pages = self.conn.getFreePages([size], 0, max(cells, 1))
+        except (libvirt.libvirtError, AttributeError):
+            return None
+        return sum(cell.get(size, 0)
+                   for cell in free_pages.values()) * size // 1024
+
+    def check_capacity(self, requirements, report):
+        """Check requirements against the host and the storage pool
+
+        Uses the cached host capabilities and a few cheap requests:
+        host info, free memory, free hugepages and storage pool info.
+        """
+        _, host_memory, host_cpus = self.conn.getInfo()[:3]
+        host = self.connection_string
+
+        if requirements.max_vcpu > host_cpus:
+            report.error(
+                'Node requires {0} vCPUs, but host {1} has only {2} '
+                'CPUs'.format(requirements.max_vcpu, host, host_cpus))
+        elif requirements.vcpu > host_cpus:
+            report.warning(
+                '{0} vCPUs overcommit {1} CPUs of host {2}'.format(
+                    requirements.vcpu, host_cpus, host))
+
+        for architecture, hypervisor in sorted(requirements.guests):
+            if not self.host_capabilities.supports(architecture, hypervisor):
+                report.error(
+                    'Host {0} does not support {1} guests of {2} '
+                    'architecture'.format(host, hypervisor, architecture))
+
+        if requirements.memory > host_memory:
+            report.error(
+                'Nodes require {0} MB of memory, but host {1} has only '
+                '{2} MB'.format(requirements.memory, host, host_memory))
+        else:
+            memory = requirements.memory - requirements.hugepages
+            try:
+                free_memory = self.conn.getFreeMemory() // 1024 ** 2
+            except libvirt.libvirtError:
+                free_memory = host_memory
+            if memory > free_memory:
+                report.warning(
+                    'Nodes require {0} MB of memory, but only {1} MB is '
+                    'free on host {2}'.format(memory, free_memory, host))
+
+        if requirements.hugepages:
+            free_hugepages = self.get_free_hugepages()
+            if free_hugepages is None:
+                report.warning(
+                    'Unable to get free hugepages on host {}'.format(host))
+            elif requirements.hugepages > free_hugepages:
+                report.error(
+                    'Nodes require {0} MB of hugepages, but only {1} MB is '
+                    'free on host {2}'.format(
+                        requirements.hugepages, free_hugepages, host))
+
+        try:
+            # no retries here, a missing pool should be reported at once
+            available = self.get_storage_pool().info()[3]
+        except libvirt.libvirtError as e:
+            report.error('Storage pool {0!r} is not available: {1}'.format(
+                self.storage_pool_name, e))
+            return
+        disk = requirements.disk_thick + requirements.disk_thin
+        if requirements.disk_thick > available:
+            report.error(
+                'Volumes require {0} GB, but only {1} GB is available in '
+                'storage pool {2!r}'.format(
+                    requirements.disk_thick // 1024 ** 3,
+                    available // 1024 ** 3, self.storage_pool_name))
+        elif disk > available:
+            report.warning(
+                'Volumes may grow up to {0} GB, but only {1} GB is '
+                'available in storage pool {2!r}'.format(
+                    disk // 1024 ** 3, available // 1024 ** 3,
+                    self.storage_pool_name))
+
+    def define_volumes(self, volumes):
+        """Create volumes and upload their images concurrently
+
+        See libvirt_volume_pipeline.VolumePipeline
+        """
+        pipeline = libvirt_volume_pipeline.VolumePipeline(
+            self.conn, self.storage_pool,
+            image_cache=self.image_cache if self.use_image_cache else None)
+        for _ in pipeline.run([(None, list(volumes))]):
+            pass
+        self.refresh_storage_pool()
+        if self.use_image_cache:
+            self.image_cache.trim()
+
+    def define_nodes_volumes(self, nodes):
+        """Create volumes of nodes and upload their images concurrently
+
+        See libvirt_volume_pipeline.VolumePipeline
+        """
+        nodes = list(nodes)
+        pipeline = libvirt_volume_pipeline.VolumePipeline(
+            self.conn, self.storage_pool,
+            image_cache=self.image_cache if self.use_image_cache else None)
+        for i in pipeline.run(
+                (i, list(nod.get_volumes())) for i, nod in enumerate(nodes)):
+            yield nodes[i]
+        self.refresh_storage_pool()
+        if self.use_image_cache:
+            self.image_cache.trim()
+
+    def revert_nodes(self, nodes, name, resume=True, paused=False):
+        """Revert nodes to snapshot
+
+        Interfaces of all nodes are unblocked at once, nwfilters which
+        are not blocked are not touched. Nodes with memory state are
+        reverted paused and resumed after the last of them is reverted,
+        so nodes reverted first don't run while others are still being
+        restored. SSH connections are closed to addresses of reverted
+        nodes only.
+
+        :type nodes: list
+        :param paused: leave nodes with memory state paused when they are
+            not resumed, e.g. to resume them together with other groups
+        :rtype: collections.OrderedDict
+        :returns: {phase name: seconds spent}
+        """
+        nodes = list(nodes)
+        timings = collections.OrderedDict()
+        attrs = {'snapshot': name}
+        if nodes and instrumentation.is_enabled():
+            attrs['env'] = helpers.deepgetattr(nodes[0],
+                                               'group.environment.name')
+
+        with instrumentation.span('group.revert.unblock',
+                                  **attrs) as cur_span:
+            self.set_blocked(
+                network.Interface.objects.filter(node__in=nodes),
+                blocked=False, missing_ok=True)
+        timings['unblock'] = cur_span.duration
+
+        with instrumentation.span('group.revert.nodes',
+                                  **attrs) as cur_span:
+            reverted_paused = [
+                nod for nod in nodes
+                if nod._revert_snapshot(name, paused=resume or paused)]
+        timings['revert'] = cur_span.duration
+
+        if resume:
+            with instrumentation.span('group.revert.resume',
+                                      **attrs) as cur_span:
+                for nod in reverted_paused:
+                    nod._resume_reverted(name)
+            timings['resume'] = cur_span.duration
+
+        with instrumentation.span('group.revert.ssh',
+                                  **attrs) as cur_span:
+            hosts = set(network.Address.objects.filter(
+                interface__node__in=nodes).values_list('ip_address',
+                                                       flat=True))
+            for host in sorted(hosts):
+                ssh_client.SSHClient.close_connections(hostname=host)
+        timings['ssh'] = cur_span.duration
+
+        logger.info('Reverted {0} nodes to snapshot {1} in {2:.2f}s '
+                    '({3})'.format(
+                        len(nodes), name, sum(timings.values()),
+                        ', '.join('{0} {1:.2f}s'.format(phase, seconds)
+                                  for phase, seconds in timings.items())))
+        return timings
+
+    def get_nodes_state(self, nodes):
+        states = self.get_domains_state()
+        inactive = driver.NodeState(active=False)
+        return {nod.name: states.get(nod.uuid, inactive) for nod in nodes}
+
+    @property
+    def image_cache(self):
+        """Cache of source images in the storage pool of the driver
+
+        :rtype: libvirt_image_cache.ImageCache
+        """
+        return libvirt_image_cache.ImageCache(self.conn,
+                                              self.storage_pool_name,
+                                              pool=self.storage_pool)
+
+    @property
+    def memory_files(self):
+        """Memory state files of external snapshots
+
+        :rtype: libvirt_memory_files.MemoryFiles
+        """
+        return libvirt_memory_files.MemoryFiles(
+            settings.SNAPSHOTS_EXTERNAL_DIR,
+            compression=settings.SNAPSHOTS_MEMORY_COMPRESSION,
+            level=settings.SNAPSHOTS_MEMORY_COMPRESSION_LEVEL)
+
+    def snapshot_nodes(self, nodes, name, description=None, force=False,
+                       external=False):
+        """Snapshot nodes concurrently
+
+        Snapshots are prepared and registered in the main thread, while
+        libvirt saves the state of several domains at once and memory
+        files are compressed.
+
+        :type nodes: list
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return
+
+        jobs = [(nod, nod._prepare_snapshot(
+            name=name, force=force, description=description,
+            external=external)) for nod in nodes]
+
+        def create(job):
+            nod, (xml, flags, memory_file) = job
+            try:
+                nod._create_snapshot(xml, flags)
+                if memory_file:
+                    nod._compress_memory_file(memory_file)
+                return None
+            except Exception:
+                return sys.exc_info()
+
+        pool = mp_pool.ThreadPool(
+            min(settings.SNAPSHOTS_CONCURRENCY, len(jobs)))
+        try:
+            results = pool.map(create, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        # register snapshots which are created, so they can be erased
+        # even if some other node has failed
+        failure = None
+        for (nod, _), exc_info in zip(jobs, results):
+            if exc_info is not None:
+                failure = failure or exc_info
+                continue
+            nod._finish_snapshot(name, external=external)
+        if failure is not None:
+            six.reraise(*failure)
+
+    @property
+    def stats_collector(self):
+        """Resource usage collector shared by drivers of the connection
+
+        Drivers with different stats_interval or stats_buffer_size get
+        separate collectors.
+
+        :rtype: libvirt_stats.StatsCollector
+        """
+        return libvirt_stats.StatsCollectors.get_collector(self)
+
+    def start_stats_collector(self, nodes=None):
+        """Start periodic sampling of resource usage in background
+
+        :param nodes: nodes to sample, all nodes of the driver if None
+        """
+        if nodes is None:
+            nodes = node.Node.objects.filter(group__driver=self)
+        self.stats_collector.start(uuids=[nod.uuid for nod in nodes])
+
+    def stop_stats_collector(self):
+        self.stats_collector.stop()
+
+    def sample_nodes_stats(self, nodes):
+        """Take the first sample unless the stats collector is running
+
+        :type nodes: list
+        :rtype: int
+        :returns: stats_interval, 0 if the collector is running
+        """
+        collector = self.stats_collector
+        if collector.is_running:
+            return 0
+        collector.sample({nod.uuid for nod in nodes})
+        return self.stats_interval
+
+    def get_nodes_stats(self, nodes):
+        """Get resource usage rates of nodes
+
+        Uses samples of the running stats collector. If the collector is
+        not running, takes the second sample to measure the rates since
+        sample_nodes_stats().
+
+        :type nodes: list
+        :rtype: dict
+        :returns: {node name: libvirt_stats.NodeRates or None}
+        """
+        collector = self.stats_collector
+        if not collector.is_running:
+            collector.sample({nod.uuid for nod in nodes})
+        return {nod.name: collector.get_rates(nod.uuid) for nod in nodes}
+
+    @decorators.retry(libvirt.libvirtError)
+    def get_nodes_vnc_ports(self, nodes):
+        """Get VNC ports of nodes
+
+        Domains are listed with a single request instead of being looked
+        up one by one. libvirt has no request for XML of several domains
+        and getAllDomainStats() doesn't report graphics, so XML of every
+        domain of the nodes is requested and parsed once. Nodes without
+        a domain have no VNC port.
+
+        :type nodes: list
+        :rtype: dict
+        :returns: {node name: VNC port or None}
+        """
+        names = {nod.uuid: nod.name for nod in nodes if nod.uuid}
+        ports = {nod.name: None for nod in nodes}
+        for dom in self.conn.listAllDomains():
+            name = names.get(dom.UUIDString())
+            if name is not None:
+                ports[name] = _get_vnc_port(dom.XMLDesc(0))
+        return ports
+
     @decorators.retry(libvirt.libvirtError)
     def get_allocated_networks(self):
         """Get list of allocated networks
@@ -288,22 +974,178 @@ class LibvirtDriver(driver.Driver):
 
         return names
 
+    @property
+    def device_name_allocator(self):
+        """Allocator of device names shared by drivers of the connection
+
+        :rtype: libvirt_device_names.DeviceNameAllocator
+        """
+        allocators = self._device_name_allocators
+        if self.connection_string not in allocators:
+            allocators[self.connection_string] = (
+                libvirt_device_names.DeviceNameAllocator(
+                    self.connection_string, self.get_allocated_device_names))
+        return allocators[self.connection_string]
+
     def get_available_device_name(self, prefix):
         """Get available name for network device or bridge
 
         :type prefix: str
         :rtype : String
         """
-        allocated_names = self.get_allocated_device_names()
-        if prefix not in self._device_name_generators:
-            self._device_name_generators[prefix] = (
-                '{}{}'.format(prefix, i) for i in itertools.count())
-        all_names = self._device_name_generators[prefix]
+        return self.device_name_allocator.allocate(prefix)[0]
+
+    def get_available_device_names(self, prefix, count):
+        """Get several available names listing host devices only once
 
-        for name in all_names:
-            if name in allocated_names:
+        :type prefix: str
+        :type count: int
+        :rtype: list
+        """
+        return self.device_name_allocator.allocate(prefix, count)
+
+    def define_networks(self, l2_network_devices):
+        """Define libvirt networks in one batch
+
+        Interfaces of the networks are fetched with their nodes and
+        addresses in two queries, names of all bridges are allocated from
+        one listing of host devices, and XMLs of all networks are built
+        before the first libvirt call. Then nwfilters, tagged interfaces
+        and networks are defined concurrently, NETWORK_DEFINE_CONCURRENCY
+        networks at a time. Models are saved from the calling thread.
+
+        :type l2_network_devices: list
+        """
+        l2_network_devices = list(l2_network_devices)
+        if not l2_network_devices:
+            return
+
+        interfaces = collections.defaultdict(list)
+        for interface in network.Interface.objects.filter(
+                l2_network_device__in=l2_network_devices).select_related(
+                'node').prefetch_related('address_set'):
+            interfaces[interface.l2_network_device_id].append(interface)
+
+        # networks in 'bridge' mode use an existing bridge
+        bridge_names = {dev.pk: dev.parent_iface.phys_dev
+                        for dev in l2_network_devices
+                        if dev.forward.mode == 'bridge'}
+        new_bridges = [dev.pk for dev in l2_network_devices
+                       if dev.pk not in bridge_names]
+        if new_bridges:
+            bridge_names.update(zip(
+                new_bridges,
+                self.get_available_device_names('virbr', len(new_bridges))))
+
+        jobs = [(dev, dict(
+            bridge_name=bridge_names[dev.pk],
+            network_xml=dev.build_network_xml(bridge_names[dev.pk],
+                                              interfaces[dev.pk]),
+            filter_xml=dev.build_filter_xml(),
+        )) for dev in l2_network_devices]
+
+        def define(job):
+            dev, kwargs = job
+            try:
+                return dev.define_libvirt_network(**kwargs), None
+            except Exception:
+                return None, sys.exc_info()
+
+        pool = mp_pool.ThreadPool(
+            min(settings.NETWORK_DEFINE_CONCURRENCY, len(jobs)))
+        try:
+            results = pool.map(define, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        # save networks which are defined, so they can be erased
+        # even if some other network has failed
+        failure = None
+        for (dev, _), (uuid_string, exc_info) in zip(jobs, results):
+            if exc_info is not None:
+                failure = failure or exc_info
                 continue
-            return name
+            dev.uuid = uuid_string
+            network.L2NetworkDevice.define(dev)
+        if failure is not None:
+            six.reraise(*failure)
+
+    def add_dhcp_hosts(self, interfaces):
+        """Add static leases of interfaces to defined networks with DHCP
+
+        Leases are added to running networks without restarting them.
+        Inside dhcp_hosts_batch() interfaces are collected and every
+        network is updated once when the batch is left.
+
+        :type interfaces: list
+        """
+        pending = getattr(self._dhcp_hosts_batch, 'interfaces', None)
+        if pending is not None:
+            pending.extend(interfaces)
+            return
+
+        l2_network_devices = collections.OrderedDict()
+        network_interfaces = collections.defaultdict(list)
+        for interface in interfaces:
+            l2_network_device = interface.l2_network_device
+            # leases of networks which are not defined yet are added
+            # when the network is defined
+            if (l2_network_device is None or not l2_network_device.uuid or
+                    not l2_network_device.dhcp):
+                continue
+            l2_network_devices.setdefault(l2_network_device.pk,
+                                          l2_network_device)
+            network_interfaces[l2_network_device.pk].append(interface)
+
+        for pk, l2_network_device in l2_network_devices.items():
+            hosts = l2_network_device.get_dhcp_hosts(network_interfaces[pk])
+            if hosts:
+                l2_network_device.add_dhcp_hosts(hosts)
+
+    @contextlib.contextmanager
+    def dhcp_hosts_batch(self):
+        """Add static leases of all interfaces of the block at once"""
+        batch = self._dhcp_hosts_batch
+        if getattr(batch, 'interfaces', None) is not None:
+            # nested batch is a part of the outer one
+            yield
+            return
+
+        batch.interfaces = []
+        try:
+            yield
+            interfaces = batch.interfaces
+        finally:
+            batch.interfaces = None
+        self.add_dhcp_hosts(interfaces)
+
+    @property
+    def nwfilter_states(self):
+        """Cached states of nwfilters shared by drivers of the connection
+
+        :rtype: libvirt_nwfilters.NWFilterStates
+        """
+        return LibvirtManager.get_nwfilter_states(self.connection_string)
+
+    def set_blocked(self, items, blocked, missing_ok=False):
+        """Block or unblock traffic of interfaces and networks at once
+
+        Only nwfilters which are not in the desired state are redefined,
+        see libvirt_nwfilters.NWFilterStates.
+
+        :param items: LibvirtInterface and LibvirtL2NetworkDevice objects
+        :type blocked: bool
+        :param missing_ok: skip items without nwfilter
+        """
+        if not self.enable_nwfilters:
+            return
+        changed = self.nwfilter_states.set_blocked(
+            {item.nwfilter_name: item.build_filter_xml for item in items},
+            blocked, missing_ok=missing_ok)
+        for name in changed:
+            logger.info('Traffic of nwfilter {0} has been {1}'.format(
+                name, 'blocked' if blocked else 'unblocked'))
 
     @decorators.retry(libvirt.libvirtError)
     def get_libvirt_version(self):
@@ -564,25 +1406,39 @@ class LibvirtL2NetworkDevice(network.L2NetworkDevice):
         """
         return self._libvirt_network.isActive()
 
-    @decorators.retry(libvirt.libvirtError, delay=3)
-    def define(self):
-        # define filter first
-        if self.driver.enable_nwfilters:
-            filter_xml = builder.LibvirtXMLBuilder.build_network_filter(
-                name=self.network_name)
-            self.driver.conn.nwfilterDefineXML(filter_xml)
+    @property
+    def nwfilter_name(self):
+        return self.network_name
 
-        if self.forward.mode == 'bridge':
-            bridge_name = self.parent_iface.phys_dev
-        else:
-            bridge_name = self.driver.get_available_device_name(prefix='virbr')
+    def build_filter_xml(self, uuid=None, blocked=False):
+        """Build XML of the nwfilter of the network
 
-        # TODO(ddmitriev): check if 'vlan' package installed
-        # Define tagged interfaces on the bridge
-        for vlanid in self.vlan_ifaces:
-            self.iface_define(name=bridge_name, vlanid=vlanid)
+        :type uuid: str
+        :param blocked: drop all traffic in the network
+        :rtype: str or None
+        :returns: None if nwfilters are disabled for the driver
+        """
+        if not self.driver.enable_nwfilters:
+            return None
+        rule = None
+        if blocked:
+            rule = dict(action='drop',
+                        direction='inout',
+                        priority='-1000')
+        return builder.LibvirtXMLBuilder.build_network_filter(
+            name=self.nwfilter_name, uuid=uuid, rule=rule)
+
+    def build_network_xml(self, bridge_name, interfaces=None):
+        """Build XML of the libvirt network
+
+        :type bridge_name: str
+        :param interfaces: interfaces of the network with fetched nodes
+            and addresses, self.interfaces if None
+        :rtype: str
+        """
+        if interfaces is None:
+            interfaces = self.interfaces
 
-        # Define libvirt network
         ip_network_address = None
         ip_network_prefixlen = None
         dhcp_range_start = None
@@ -601,17 +1457,9 @@ class LibvirtL2NetworkDevice(network.L2NetworkDevice):
             dhcp_range_start = self.address_pool.ip_range_start('dhcp')
             dhcp_range_end = self.address_pool.ip_range_end('dhcp')
 
-            for interface in self.interfaces:
-                for address in interface.addresses:
-                    ip_addr = netaddr.IPAddress(address.ip_address)
-                    if ip_addr in self.address_pool.ip_network:
-                        addresses.append(dict(
-                            mac=str(interface.mac_address),
-                            ip=str(address.ip_address),
-                            name=interface.node.name
-                        ))
-
-        xml = builder.LibvirtXMLBuilder.build_network_xml(
+            addresses = self.get_dhcp_hosts(interfaces)
+
+        return builder.LibvirtXMLBuilder.build_network_xml(
             network_name=self.network_name,
             bridge_name=bridge_name,
             addresses=addresses,
@@ -625,9 +1473,104 @@ class LibvirtL2NetworkDevice(network.L2NetworkDevice):
             dhcp=self.dhcp,
             tftp_root_dir=self.tftp_root_dir,
         )
-        ret = self.driver.conn.networkDefineXML(xml)
+
+    def get_dhcp_hosts(self, interfaces):
+        """Get DHCP host entries for addresses of interfaces in the network
+
+        :param interfaces: interfaces with fetched nodes and addresses
+        :rtype: list
+        :returns: list of dicts with mac, ip and name of the host
+        """
+        if self.address_pool is None:
+            return []
+
+        hosts = []
+        ip_network = self.address_pool.ip_network
+        for interface in interfaces:
+            for address in interface.addresses:
+                ip_addr = netaddr.IPAddress(address.ip_address)
+                if ip_addr in ip_network:
+                    hosts.append(dict(
+                        mac=str(interface.mac_address),
+                        ip=str(address.ip_address),
+                        name=interface.node.name
+                    ))
+        return hosts
+
+    @decorators.retry(libvirt.libvirtError)
+    def add_dhcp_hosts(self, hosts):
+        """Add DHCP host entries to the defined network
+
+        The running network is updated together with its persistent
+        config, so new static leases are served without restarting the
+        network. Hosts with a MAC address which is already in the network
+        are skipped, so the method may be safely called again.
+
+        :param hosts: list of dicts with mac, ip and name of the host
+        """
+        net = self._libvirt_network
+        net_xml = ET.fromstring(
+            net.XMLDesc(libvirt.VIR_NETWORK_XML_INACTIVE))
+        if net_xml.find('./ip/dhcp') is None:
+            logger.debug('DHCP is not enabled in network {}, static leases '
+                         'are not added'.format(self.network_name))
+            return
+        existing = {host.get('mac')
+                    for host in net_xml.iterfind('./ip/dhcp/host')}
+
+        flags = libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG
+        if net.isActive():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+
+        for host in hosts:
+            if host['mac'] in existing:
+                continue
+            net.update(
+                libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
+                -1,
+                builder.LibvirtXMLBuilder.build_network_dhcp_host_xml(**host),
+                flags)
+            existing.add(host['mac'])
+
+    @decorators.retry(libvirt.libvirtError, delay=3)
+    def define_libvirt_network(self, bridge_name, network_xml,
+                               filter_xml=None):
+        """Define nwfilter, tagged interfaces and the libvirt network
+
+        Only libvirt is accessed here, so networks of a group can be
+        defined from several threads.
+
+        :type bridge_name: str
+        :type network_xml: str
+        :type filter_xml: str
+        :rtype: str
+        :returns: UUID of the libvirt network
+        """
+        # define filter first
+        if filter_xml is not None:
+            self.driver.conn.nwfilterDefineXML(filter_xml)
+            self.driver.nwfilter_states.forget([self.nwfilter_name])
+
+        # TODO(ddmitriev): check if 'vlan' package installed
+        # Define tagged interfaces on the bridge
+        for vlanid in self.vlan_ifaces:
+            self.iface_define(name=bridge_name, vlanid=vlanid)
+
+        ret = self.driver.conn.networkDefineXML(network_xml)
         ret.setAutostart(True)
-        self.uuid = ret.UUIDString()
+        return ret.UUIDString()
+
+    def define(self):
+        if self.forward.mode == 'bridge':
+            bridge_name = self.parent_iface.phys_dev
+        else:
+            bridge_name = self.driver.get_available_device_name(prefix='virbr')
+
+        self.uuid = self.define_libvirt_network(
+            bridge_name=bridge_name,
+            network_xml=self.build_network_xml(bridge_name),
+            filter_xml=self.build_filter_xml())
 
         super(LibvirtL2NetworkDevice, self).define()
 
@@ -696,6 +1639,7 @@ class LibvirtL2NetworkDevice(network.L2NetworkDevice):
                 if self.driver.enable_nwfilters:
                     if self._nwfilter:
                         self._nwfilter.undefine()
+                    self.driver.nwfilter_states.forget([self.nwfilter_name])
         super(LibvirtL2NetworkDevice, self).remove()
 
     @decorators.retry(libvirt.libvirtError)
@@ -763,38 +1707,65 @@ class LibvirtL2NetworkDevice(network.L2NetworkDevice):
         filter_xml = ET.fromstring(self._nwfilter.XMLDesc())
         return filter_xml.find('./rule') is not None
 
-    @decorators.retry(libvirt.libvirtError)
     def block(self):
         """Block all traffic in network"""
-        if not self.driver.enable_nwfilters:
-            return
-        if not self._nwfilter:
-            raise error.DevopsError(
-                'Unable to block network {0}: nwfilter not found!'
-                ''.format(self.network_name))
-
-        filter_xml = builder.LibvirtXMLBuilder.build_network_filter(
-            name=self.network_name,
-            uuid=self._nwfilter.UUIDString(),
-            rule=dict(action='drop',
-                      direction='inout',
-                      priority='-1000'))
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+        self.driver.set_blocked([self], blocked=True)
 
-    @decorators.retry(libvirt.libvirtError)
     def unblock(self):
         """Unblock all traffic in network"""
-        if not self.driver.enable_nwfilters:
-            return
-        if not self._nwfilter:
-            raise error.DevopsError(
-                'Unable to unblock network {0}: nwfilter not found!'
-                ''.format(self.network_name))
+        self.driver.set_blocked([self], blocked=False)
+
+
+class _FileStreamSource(object):
+    """Handlers feeding an image file to virStream.sendAll/sparseSendAll
+
+    Both handlers read exactly the size requested by libvirt-python:
+    sendAll() passes every chunk to a single virStream.send() call which
+    doesn't check for short writes, and sparse upload must not cross data
+    section boundary.
+    """
+
+    def __init__(self):
+        self.sent = 0
 
-        filter_xml = builder.LibvirtXMLBuilder.build_network_filter(
-            name=self.network_name,
-            uuid=self._nwfilter.UUIDString())
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+    def read(self, _stream, nbytes, fd):
+        """sendAll()/sparseSendAll() handler: read next chunk of the file"""
+        chunk = os.read(fd, nbytes)
+        self.sent += len(chunk)
+        return chunk
+
+    @staticmethod
+    def hole(_stream, fd):
+        """sparseSendAll() handler: get type and length of current section
+
+        :returns: [True if it is data section, section length]
+        """
+        cur = os.lseek(fd, 0, os.SEEK_CUR)
+        try:
+            data = os.lseek(fd, cur, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            # trailing hole up to the end of the file
+            data = -1
+
+        if data < 0:
+            in_data = False
+            section_len = os.lseek(fd, 0, os.SEEK_END) - cur
+        elif data > cur:
+            in_data = False
+            section_len = data - cur
+        else:
+            in_data = True
+            section_len = os.lseek(fd, data, os.SEEK_HOLE) - data
+        os.lseek(fd, cur, os.SEEK_SET)
+        return [in_data, section_len]
+
+    @staticmethod
+    def skip(_stream, length, fd):
+        """sparseSendAll() handler: skip hole section of the file"""
+        os.lseek(fd, length, os.SEEK_CUR)
+        return 0
 
 
 class LibvirtVolume(volume.Volume):
@@ -822,8 +1793,27 @@ class LibvirtVolume(volume.Volume):
             else:
                 raise
 
-    @decorators.retry(libvirt.libvirtError)
-    def define(self):
+    def uses_image_cache(self):
+        """Check if the volume is an overlay of a cached source image"""
+        return (self.source_image is not None and
+                self.format == 'qcow2' and
+                self.backing_store_id is None and
+                self.driver.use_image_cache)
+
+    def get_define_xml(self, base_vol=None):
+        """Prepare libvirt XML of the volume
+
+        Reads everything required to create the volume from the database,
+        so the volume can be created later without database access.
+
+        :param base_vol: base volume of the source image in the image
+            cache, required if the volume uses the image cache. Keep it
+            pinned by ImageCache.acquire_base() until the volume is created
+        :type base_vol: libvirt.virStorageVol
+        :rtype: tuple
+        :returns: (volume XML, capacity in bytes, True if the source image
+            should be uploaded to the created volume)
+        """
         # Generate libvirt volume name
         if self.node:
             name = helpers.underscored(
@@ -868,9 +1858,19 @@ class LibvirtVolume(volume.Volume):
                 "Can't create volume {!r}: no capacity or "
                 "source_image specified".format(self.name))
 
+        # Use cached copy of the source image as backing store
+        cached = self.uses_image_cache()
+        if cached:
+            if base_vol is None:
+                raise error.DevopsError(
+                    "Can't create volume {!r}: base volume of the cached "
+                    "source image is not given".format(self.name))
+            backing_store_path = base_vol.path()
+            backing_store_format = ET.fromstring(
+                base_vol.XMLDesc(0)).find('target/format').get('type')
+            capacity = max(capacity, base_vol.info()[1])
+
         # Generate xml
-        pool_name = self.driver.storage_pool_name
-        pool = self.driver.conn.storagePoolLookupByName(pool_name)
         xml = builder.LibvirtXMLBuilder.build_volume_xml(
             name=name,
             capacity=capacity,
@@ -878,10 +1878,13 @@ class LibvirtVolume(volume.Volume):
             backing_store_path=backing_store_path,
             backing_store_format=backing_store_format,
         )
+        return xml, capacity, self.source_image is not None and not cached
 
-        # Define volume
-        libvirt_volume = pool.createXML(xml, 0)
+    def set_libvirt_volume(self, libvirt_volume):
+        """Bind created libvirt volume to the model (without saving)
 
+        :type libvirt_volume: libvirt.virStorageVol
+        """
         # Save uuid
         self.uuid = libvirt_volume.key()
 
@@ -891,11 +1894,30 @@ class LibvirtVolume(volume.Volume):
         if not self.wwn:
             self.wwn = '0' + ''.join(uuid.uuid4().hex)[:15]
 
+    @decorators.retry(libvirt.libvirtError)
+    def define(self):
+        base_vol, pin = None, None
+        if self.uses_image_cache():
+            # Cached image is pinned until its overlay is created
+            base_vol, pin = self.driver.image_cache.acquire_base(
+                self.source_image, upload=self.upload_file)
+        try:
+            xml, capacity, upload = self.get_define_xml(base_vol=base_vol)
+
+            # Define volume
+            self.set_libvirt_volume(
+                self.driver.storage_pool.createXML(xml, 0))
+        finally:
+            if pin is not None:
+                pin.close()
+
         super(LibvirtVolume, self).define()
 
         # Upload predefined image to the volume
-        if self.source_image is not None:
+        if upload:
             self.upload(self.source_image, capacity)
+        elif self.uses_image_cache():
+            self.driver.image_cache.trim()
 
     @decorators.retry(libvirt.libvirtError)
     def remove(self, *args, **kwargs):
@@ -924,43 +1946,126 @@ class LibvirtVolume(volume.Volume):
         warnings.warn(msg, DeprecationWarning)
         logger.debug(msg)
 
-    @decorators.retry(libvirt.libvirtError, count=2)
-    def upload(self, path, capacity=0):
-        def chunk_render(_, _size, _fd):
-            return _fd.read(_size)
+    @staticmethod
+    def sparse_upload_supported():
+        """Check if libvirt and OS allow to upload sparse streams"""
+        return (hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM') and
+                hasattr(libvirt.virStream, 'sparseSendAll') and
+                hasattr(os, 'SEEK_DATA'))
 
+    @classmethod
+    def upload_file(cls, conn, libvirt_volume, path, sparse=None):
+        """Stream image file to the beginning of libvirt volume
+
+        :type conn: libvirt.virConnect
+        :type libvirt_volume: libvirt.virStorageVol
+        :param path: path to the image file
+        :param sparse: skip holes of the file instead of sending zeroes.
+            If None, enabled for sparse files when supported by libvirt.
+        """
         size = helpers.get_file_size(path)
-        current_size = self._libvirt_volume.info()[1]
+        if sparse is None:
+            sparse = (cls.sparse_upload_supported() and
+                      helpers.get_file_allocation(path) < size)
+
+        start = time.time()
+        source = _FileStreamSource()
+        with open(path, 'rb') as fd:
+            stream = conn.newStream(0)
+            try:
+                if sparse:
+                    try:
+                        libvirt_volume.upload(
+                            stream=stream, offset=0, length=size,
+                            flags=libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+                    except libvirt.libvirtError as e:
+                        if e.get_error_code() not in (
+                                libvirt.VIR_ERR_NO_SUPPORT,
+                                libvirt.VIR_ERR_OPERATION_UNSUPPORTED):
+                            raise
+                        logger.warning(
+                            'Storage pool of volume {0} does not support '
+                            'sparse upload, sending {1} as is: {2}'.format(
+                                libvirt_volume.name(), path, e))
+                        sparse = False
+                        stream = conn.newStream(0)
+                if sparse:
+                    stream.sparseSendAll(source.read, source.hole,
+                                         source.skip, fd.fileno())
+                else:
+                    libvirt_volume.upload(
+                        stream=stream, offset=0,
+                        length=size, flags=0)
+                    stream.sendAll(source.read, fd.fileno())
+                stream.finish()
+            except Exception:
+                exc_info = sys.exc_info()
+                try:
+                    stream.abort()
+                except libvirt.libvirtError:
+                    logger.debug('Failed to abort upload stream of volume '
+                                 '{}'.format(libvirt_volume.name()))
+                six.reraise(*exc_info)
+
+        elapsed = time.time() - start
+        logger.info(
+            "Uploaded {path} to volume {name}: {sent} of {size} bytes sent "
+            "in {elapsed:.1f}s ({rate:.1f} MB/s)".format(
+                path=path, name=libvirt_volume.name(), sent=source.sent,
+                size=size, elapsed=elapsed,
+                rate=size / 1024.0 ** 2 / elapsed if elapsed else 0.0))
+
+    @classmethod
+    def upload_image(cls, conn, libvirt_volume, path, capacity=0,
+                     sparse=None):
+        """Upload image file to libvirt volume resizing it as required
+
+        Doesn't touch the database, so it is safe to call it from
+        a thread other than the one which owns the volume model.
+
+        :type conn: libvirt.virConnect
+        :type libvirt_volume: libvirt.virStorageVol
+        :param path: path to the image file
+        :param capacity: volume capacity in bytes to set after upload
+        :param sparse: see upload_file()
+        """
+        size = helpers.get_file_size(path)
+        current_size = libvirt_volume.info()[1]
 
         # resize volume if more space required to upload the image
         if size > current_size:
             # NOTE: qcow2 doesn't support shrinking images yet
-            self._libvirt_volume.resize(size)
-            self.save()
+            libvirt_volume.resize(size)
 
-        with open(path, 'rb') as fd:
-            stream = self.driver.conn.newStream(0)
-            self._libvirt_volume.upload(
-                stream=stream, offset=0,
-                length=size, flags=0)
-            stream.sendAll(chunk_render, fd)
-            stream.finish()
+        cls.upload_file(conn, libvirt_volume, path, sparse=sparse)
 
         if capacity > size:
             # Resize the uploaded image to specified capacity
             try:
-                self._libvirt_volume.resize(capacity)
-                self.save()
+                libvirt_volume.resize(capacity)
             except libvirt.libvirtError:
                 err = libvirt.virGetLastError()
                 if (err[0] == libvirt.VIR_ERR_INVALID_ARG and
                         err[1] == libvirt.VIR_FROM_STORAGE):
                     logger.error(
                         "Cannot resize volume {0}: {1}"
-                        .format(self._libvirt_volume.path(), err[2]))
+                        .format(libvirt_volume.path(), err[2]))
                 else:
                     raise
 
+    @decorators.retry(libvirt.libvirtError, count=2)
+    def upload(self, path, capacity=0, sparse=None):
+        """Upload image file to the volume
+
+        :param path: path to the image file
+        :param capacity: volume capacity in bytes to set after upload
+        :param sparse: skip holes of the file instead of sending zeroes.
+            If None, enabled for sparse files when supported by libvirt.
+        """
+        self.upload_image(self.driver.conn, self._libvirt_volume, path,
+                          capacity=capacity, sparse=sparse)
+        self.save()
+
     @decorators.retry(libvirt.libvirtError)
     def get_allocation(self):
         """Get allocated volume size
@@ -1021,6 +2126,21 @@ class LibvirtVolume(volume.Volume):
         return volume
 
 
+def _snapshot_span(span_name):
+    """Run a snapshot method of LibvirtNode in a span
+
+    The first argument of the method, if any, is the snapshot name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            snapshot_name = kwargs.get('name', args[0] if args else None)
+            with self._span(span_name, snapshot=snapshot_name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class LibvirtNode(node.Node):
     """Note: This class is imported as Node at .__init__.py """
 
@@ -1037,6 +2157,8 @@ class LibvirtNode(node.Node):
     numa = base.ParamField(default=[])
     cloud_init_volume_name = base.ParamField()
     cloud_init_iface_up = base.ParamField()
+    # see LibvirtNode.get_snapshot_index()
+    snapshot_chains = base.ParamField(default=None)
 
     @property
     @decorators.retry(libvirt.libvirtError)
@@ -1055,11 +2177,7 @@ class LibvirtNode(node.Node):
 
             :rtype : String
         """
-        xml_desc = ET.fromstring(
-            self._libvirt_node.XMLDesc(0))
-        vnc_element = xml_desc.find('devices/graphics[@type="vnc"][@port]')
-        if vnc_element is not None:
-            return vnc_element.get('port')
+        return _get_vnc_port(self._libvirt_node.XMLDesc(0))
 
     @property
     def vnc_password(self):
@@ -1088,19 +2206,83 @@ class LibvirtNode(node.Node):
         """
         return bool(self._libvirt_node.isActive())
 
-    def send_keys(self, keys):
+    @decorators.retry(libvirt.libvirtError)
+    def get_screenshot_hash(self):
+        """Get hash of the current screen of the node
+
+        :rtype: str
+        """
+        stream = self.driver.conn.newStream(0)
+        digest = hashlib.md5()
+        try:
+            self._libvirt_node.screenshot(stream, 0, 0)
+            stream.recvAll(lambda st, data, d: d.update(data), digest)
+            stream.finish()
+        except libvirt.libvirtError:
+            stream.abort()
+            raise
+        return digest.hexdigest()
+
+    def wait_screen_settled(self, last_hash, timeout, interval=0.1):
+        """Wait until the screen is changed and stops changing
+
+        :param last_hash: hash of the screen before the keys were sent
+        :param timeout: max time to wait in seconds
+        :param interval: time between screenshots in seconds
+        :rtype: str
+        :returns: hash of the current screen
+        """
+        deadline = time.time() + timeout
+        current_hash = self.get_screenshot_hash()
+        changed = current_hash != last_hash
+        while time.time() < deadline:
+            time.sleep(interval)
+            new_hash = self.get_screenshot_hash()
+            if changed and new_hash == current_hash:
+                break
+            changed = changed or new_hash != current_hash
+            current_hash = new_hash
+        return current_hash
+
+    def send_keys(self, keys, wait_screen=None):
         """Send keys to node
 
+        Runs of keys are pressed by one sendKey call, see
+        scancodes.to_batches(). If wait_screen is set, <Wait> lasts until
+        the screen of the node stops changing, but not longer than
+        SEND_KEYS_WAIT_TIMEOUT.
+
         :type keys: String
+        :param wait_screen: SEND_KEYS_WAIT_SCREEN if None
             :rtype : None
         """
-        key_codes = scancodes.from_string(str(keys))
-        for key_code in key_codes:
-            if isinstance(key_code[0], str):
-                if key_code[0] == 'wait':
-                    time.sleep(1)
+        if wait_screen is None:
+            wait_screen = settings.SEND_KEYS_WAIT_SCREEN
+
+        screen_hash = None
+        if wait_screen:
+            try:
+                screen_hash = self.get_screenshot_hash()
+            except libvirt.libvirtError as e:
+                logger.warning('Unable to take screenshot of node {0}, '
+                               'waiting for {1}s instead: {2}'.format(
+                                   self.name,
+                                   settings.SEND_KEYS_WAIT_TIMEOUT, e))
+
+        batches = scancodes.batches_from_string(
+            str(keys), max_keys=settings.SEND_KEYS_BATCH_SIZE)
+        for key_codes in batches:
+            if isinstance(key_codes[0], str):
+                if key_codes[0] == 'wait':
+                    if screen_hash is None:
+                        time.sleep(settings.SEND_KEYS_WAIT_TIMEOUT)
+                    else:
+                        screen_hash = self.wait_screen_settled(
+                            screen_hash, settings.SEND_KEYS_WAIT_TIMEOUT)
                 continue
-            self._libvirt_node.sendKey(0, 0, list(key_code), len(key_code), 0)
+            self._libvirt_node.sendKey(
+                libvirt.VIR_KEYCODE_SET_LINUX, settings.SEND_KEYS_HOLD_TIME,
+                list(key_codes), len(key_codes), 0)
 
     @decorators.retry(libvirt.libvirtError)
     def define(self):
@@ -1152,10 +2334,8 @@ class LibvirtNode(node.Node):
                 interface_filter=filter_name,
             ))
 
-        emulator = self.driver.get_capabilities().find(
-            'guest/arch[@name="{0:>s}"]/'
-            'domain[@type="{1:>s}"]/emulator'.format(
-                self.architecture, self.hypervisor)).text
+        emulator = self.driver.host_capabilities.get_emulator(
+            self.architecture, self.hypervisor)
         node_xml = builder.LibvirtXMLBuilder.build_node_xml(
             name=name,
             hypervisor=self.hypervisor,
@@ -1176,6 +2356,7 @@ class LibvirtNode(node.Node):
             interfaces=local_interfaces,
             acpi=self.driver.enable_acpi,
             numa=self.numa,
+            pretty=False,
         )
         self.uuid = self.driver.conn.defineXML(node_xml).UUIDString()
 
@@ -1224,15 +2405,32 @@ class LibvirtNode(node.Node):
         super(LibvirtNode, self).remove()
 
     @decorators.retry(libvirt.libvirtError)
-    def suspend(self, *args, **kwargs):
-        if self.is_active():
-            self._libvirt_node.suspend()
+    def suspend(self, state=None, *args, **kwargs):
+        """Suspend node
+
+        :param state: state prefetched with LibvirtDriver.get_nodes_state(),
+                      avoids extra lookups when many nodes are suspended
+        :type state: DomainState
+        """
+        if state is None:
+            if self.is_active():
+                self._libvirt_node.suspend()
+        elif state.active and not state.paused:
+            state.domain.suspend()
         super(LibvirtNode, self).suspend()
 
     @decorators.retry(libvirt.libvirtError)
-    def resume(self, *args, **kwargs):
-        if self._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_PAUSED:
-            self._libvirt_node.resume()
+    def resume(self, state=None, *args, **kwargs):
+        """Resume node
+
+        :param state: state prefetched with LibvirtDriver.get_nodes_state()
+        :type state: DomainState
+        """
+        if state is None:
+            if self._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_PAUSED:
+                self._libvirt_node.resume()
+        elif state.paused:
+            state.domain.resume()
 
     @decorators.retry(libvirt.libvirtError)
     def reboot(self):
@@ -1307,32 +2505,201 @@ class LibvirtNode(node.Node):
         if os.path.exists(dir_path):
             shutil.rmtree(dir_path)
 
+    # EXTERNAL SNAPSHOT
+    def get_snapshot_index(self):
+        """Get index of snapshot chains of the node
+
+        Index is built on first use and then kept up to date when
+        external snapshots are created, reverted and erased.
+
+        :rtype: libvirt_snapshot_index.SnapshotIndex
+        """
+        if self.snapshot_chains is None:
+            return self.rebuild_snapshot_index()
+        return libvirt_snapshot_index.SnapshotIndex(self.snapshot_chains)
+
+    # EXTERNAL SNAPSHOT
+    @decorators.retry(libvirt.libvirtError)
+    def rebuild_snapshot_index(self):
+        """Build index of snapshot chains from libvirt and the database
+
+        :rtype: libvirt_snapshot_index.SnapshotIndex
+        """
+        snapshots = []
+        for snap in self._libvirt_node.listAllSnapshots(0):
+            try:
+                parent = snap.getParent().getName()
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+                    raise
+                parent = None
+            snapshots.append((snap.getName(), parent))
+
+        current = None
+        if self._libvirt_node.hasCurrentSnapshot(0):
+            current = self._libvirt_node.snapshotCurrent(0).getName()
+
+        volumes = list(self.volume_set.values_list(
+            'id', 'name', 'backing_store_id'))
+        volumes += self.group.volume_set.values_list(
+            'id', 'name', 'backing_store_id')
+
+        index = libvirt_snapshot_index.SnapshotIndex.build(
+            snapshots, current, volumes)
+        self.snapshot_chains = index.data
+        self.save()
+        return index
+
+    # EXTERNAL SNAPSHOT
+    @staticmethod
+    def _get_volume_chain(vol, index):
+        chain = index.get_volume_chain(vol.id)
+        if chain is not None:
+            return chain
+
+        # Volume is added after the index was built, walk its chain once
+        back_vol = vol
+        back_count = 0
+        while back_vol.backing_store is not None:
+            back_count += 1
+            back_vol = back_vol.backing_store
+            if back_count > 500:
+                break
+        return index.add_volume(vol.id, back_vol.name, back_count,
+                                root_id=back_vol.id)
+
     # EXTERNAL SNAPSHOT
     def snapshot_create_child_volumes(self, name):
+        index = self.get_snapshot_index()
         for disk in self.disk_devices:
             if disk.device == 'disk':
 
                 # Find main disk name, it is used for external disk
-                back_vol_name = disk.volume.name
-                back_count = 0
-                disk_test = disk.volume.backing_store
-                while disk_test is not None:
-                    back_count += 1
-                    back_vol_name = disk_test.name
-                    disk_test = disk_test.backing_store
-                    if back_count > 500:
-                        raise error.DevopsError(
-                            "More then 500 snapshots in chain for {0}.{1}"
-                            .format(back_vol_name, name))
+                back_vol_name, back_count = self._get_volume_chain(
+                    disk.volume, index)
+                if back_count > 500:
+                    raise error.DevopsError(
+                        "More then 500 snapshots in chain for {0}.{1}"
+                        .format(back_vol_name, name))
                 # Create new volume for snapshot
                 vol_child = disk.volume.create_child(
                     name='{0}.{1}'.format(back_vol_name, name),
                 )
                 vol_child.define()
+                index.add_volume(
+                    vol_child.id, back_vol_name, back_count + 1,
+                    root_id=index.get_root_id(disk.volume.id),
+                    length=index.get_chain_length(disk.volume.id) + 1)
 
                 # update disk node to new snapshot
                 disk.volume = vol_child
                 disk.save()
+        self.save()
+
+    # EXTERNAL SNAPSHOT
+    @decorators.retry(libvirt.libvirtError)
+    def get_block_job_progress(self, disk_dev):
+        """Get progress of the block job of a disk
+
+        :param disk_dev: target device of the disk, e.g. 'vda'
+        :rtype: tuple or None
+        :returns: (current, end) or None if there is no job
+        """
+        info = self._libvirt_node.blockJobInfo(disk_dev, 0)
+        if not info:
+            return None
+        return info['cur'], info['end']
+
+    # EXTERNAL SNAPSHOT
+    def wait_block_job(self, disk_dev, timeout, interval=1):
+        """Wait until the block job of a disk is finished
+
+        Job is aborted if it is not finished in time, the image stays
+        consistent in this case.
+
+        :param disk_dev: target device of the disk, e.g. 'vda'
+        :param timeout: seconds to wait
+        :raises: TimeoutError
+        """
+        deadline = time.time() + timeout
+        while True:
+            progress = self.get_block_job_progress(disk_dev)
+            if progress is None:
+                return
+            cur, end = progress
+            logger.debug('Block job of {0} {1}: {2}/{3}'.format(
+                self.name, disk_dev, cur, end))
+            if time.time() > deadline:
+                self._libvirt_node.blockJobAbort(disk_dev, 0)
+                raise error.TimeoutError(
+                    'Block job of {0} {1} has not finished in {2} seconds, '
+                    'aborted'.format(self.name, disk_dev, timeout))
+            time.sleep(interval)
+
+    # EXTERNAL SNAPSHOT
+    def flatten_snapshot_chains(self, max_length=1, timeout=None):
+        """Shorten backing chains of disks down to their root volumes
+
+        Data of all external snapshot overlays between the root volume and
+        the disk volume is copied to the disk volume, so reads of the guest
+        don't walk the whole chain any more. Running domains are flattened
+        online by a block pull job (blockRebase onto the root volume),
+        stopped domains by qemu-img rebase on the libvirt host.
+
+        Overlays are kept since snapshots refer to them, so snapshot XMLs
+        stay valid, and backing stores of volumes in the database still
+        point to the volume the snapshot state is based on, which is used
+        when a disk is recreated on revert. blockCommit is not used for the
+        same reason: it would change overlays other snapshots depend on.
+
+        :param max_length: flatten only disks which images have more
+            backing files than this
+        :param timeout: seconds to wait for every block job,
+            snapshot_flatten_timeout of the driver by default
+        :rtype: list
+        :returns: flattened volumes
+        """
+        if timeout is None:
+            timeout = self.driver.snapshot_flatten_timeout
+        index = self.get_snapshot_index()
+        is_active = self.is_active()
+
+        flattened = []
+        for disk in self.disk_devices:
+            if disk.device != 'disk':
+                continue
+            vol = disk.volume
+            self._get_volume_chain(vol, index)
+            length = index.get_chain_length(vol.id)
+            if length <= max(max_length, 1):
+                continue
+
+            root = volume.Volume.objects.get(id=index.get_root_id(vol.id))
+            logger.info(
+                "Flatten {0} backing files of {1} {2} onto {3}".format(
+                    length, self.name, vol.name, root.name))
+            if is_active:
+                self._libvirt_node.blockRebase(
+                    disk.target_dev, root.get_path(), 0, 0)
+                self.wait_block_job(disk.target_dev, timeout=timeout)
+            else:
+                self.driver.shell.check_call(
+                    'sudo qemu-img rebase -f {fmt} -b {base} -F {base_fmt} '
+                    '{path}'.format(fmt=vol.format, base=root.get_path(),
+                                    base_fmt=root.format,
+                                    path=vol.get_path()),
+                    timeout=timeout)
+            index.set_chain_length(vol.id, 1)
+            self.save()
+            flattened.append(vol)
+        return flattened
+
+    # EXTERNAL SNAPSHOT
+    @_snapshot_span('node.snapshot.flatten')
+    def _flatten_snapshot_chains_by_policy(self):
+        if self.driver.snapshot_flatten_depth:
+            self.flatten_snapshot_chains(
+                max_length=self.driver.snapshot_flatten_depth)
 
     # EXTERNAL SNAPSHOT
     def _assert_snapshot_type(self, external=False):
@@ -1366,10 +2733,42 @@ class LibvirtNode(node.Node):
             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REDEFINE |
             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_CURRENT)
 
+        self.get_snapshot_index().current = name
+        self.save()
+
+    def _span(self, name, **attrs):
+        """Span of a snapshot operation with attributes of the node
+
+        :rtype: contextlib.GeneratorContextManager
+        """
+        if instrumentation.is_enabled():
+            attrs.update(
+                env=helpers.deepgetattr(self, 'group.environment.name'),
+                node=self.name,
+                role=self.role)
+        return instrumentation.span(name, **attrs)
+
+    @_snapshot_span('node.snapshot')
     @decorators.retry(libvirt.libvirtError)
     def snapshot(self, name=None, force=False, description=None,
                  disk_only=False, external=False):
         super(LibvirtNode, self).snapshot()
+        xml, create_xml_flag, memory_file = self._prepare_snapshot(
+            name=name, force=force, description=description,
+            disk_only=disk_only, external=external)
+        self._create_snapshot(xml, create_xml_flag)
+        if memory_file:
+            self._compress_memory_file(memory_file)
+        self._finish_snapshot(name, external=external)
+
+    @_snapshot_span('node.snapshot.prepare')
+    def _prepare_snapshot(self, name=None, force=False, description=None,
+                          disk_only=False, external=False):
+        """Prepare node to be snapshotted
+
+        :rtype: tuple
+        :returns: (snapshot XML, create flags, memory file or '')
+        """
         # Erase existing snapshot or raise an error if already exists
         if self.has_snapshot(name):
             if force:
@@ -1381,6 +2780,7 @@ class LibvirtNode(node.Node):
         # Check that existing snapshot has the same type
         self._assert_snapshot_type(external=external)
 
+        domain_isactive = self.is_active()
         local_disk_devices = []
         if external:
             # EXTERNAL SNAPSHOTS
@@ -1397,14 +2797,15 @@ class LibvirtNode(node.Node):
             # disk for snapshot changes
             self.snapshot_create_child_volumes(name)
 
-            base_memory_file = '{0}/snapshot-memory-{1}_{2}.{3}'.format(
+            base_memory_file = '{0}/{1}{2}_{3}.{4}'.format(
                 settings.SNAPSHOTS_EXTERNAL_DIR,
+                libvirt_memory_files.PREFIX,
                 helpers.deepgetattr(self, 'group.environment.name'),
                 self.name,
                 name)
             file_count = 0
             memory_file = base_memory_file
-            while os.path.exists(memory_file):
+            while libvirt_memory_files.MemoryFiles.exists(memory_file):
                 memory_file = base_memory_file + '-' + str(file_count)
                 file_count += 1
 
@@ -1415,7 +2816,7 @@ class LibvirtNode(node.Node):
                         disk_target_dev=disk.target_dev,
                     ))
 
-            if self.is_active() and not disk_only:
+            if domain_isactive and not disk_only:
                 create_xml_flag = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT
             else:
                 create_xml_flag = (
@@ -1434,19 +2835,36 @@ class LibvirtNode(node.Node):
             external=external,
             disk_only=disk_only,
             memory_file=memory_file,
-            domain_isactive=self.is_active(),
+            domain_isactive=domain_isactive,
             local_disk_devices=local_disk_devices
         )
+        if disk_only or not domain_isactive:
+            # memory state is saved for running domains only
+            memory_file = ''
+        return xml, create_xml_flag, memory_file
+
+    def _create_snapshot(self, xml, create_xml_flag):
+        """Create libvirt snapshot, doesn't touch the database
 
+        Safe to be called in a thread.
+        """
         domain = self._libvirt_node
         logger.debug(domain.state(0))
+        with self._span('node.snapshot.libvirt'):
+            domain.snapshotCreateXML(xml, create_xml_flag)
+        logger.debug(domain.state(0))
 
-        domain.snapshotCreateXML(xml, create_xml_flag)
+    def _compress_memory_file(self, memory_file):
+        with self._span('node.snapshot.compress'):
+            self.driver.memory_files.compress(memory_file)
 
+    @_snapshot_span('node.snapshot.finish')
+    def _finish_snapshot(self, name, external=False):
         if external:
+            index = self.get_snapshot_index()
+            index.add_snapshot(name, parent=index.current)
             self.set_snapshot_current(name)
-
-        logger.debug(domain.state(0))
+            self._flatten_snapshot_chains_by_policy()
 
     # EXTERNAL SNAPSHOT
     @staticmethod
@@ -1461,6 +2879,7 @@ class LibvirtNode(node.Node):
         return snapshot.delete_snapshot_files()
 
     # EXTERNAL SNAPSHOT
+    @_snapshot_span('node.revert.restore')
     @decorators.retry(libvirt.libvirtError)
     def _redefine_external_snapshot(self, name=None):
         snapshot = self._get_snapshot(name)
@@ -1493,14 +2912,17 @@ class LibvirtNode(node.Node):
             # Redefine domain for snapshot without memory save
             self.driver.conn.defineXML(helpers.xml_tostring(xml_domain))
         else:
-            self.driver.conn.restoreFlags(
-                snapshot.memory_file,
-                dxml=helpers.xml_tostring(xml_domain),
-                flags=libvirt.VIR_DOMAIN_SAVE_PAUSED)
+            with self.driver.memory_files.uncompressed(
+                    snapshot.memory_file) as memory_file:
+                self.driver.conn.restoreFlags(
+                    memory_file,
+                    dxml=helpers.xml_tostring(xml_domain),
+                    flags=libvirt.VIR_DOMAIN_SAVE_PAUSED)
 
         # set snapshot as current
         self.set_snapshot_current(name)
 
+    @_snapshot_span('node.revert.update_disks')
     def _update_disks_from_snapshot(self, name):
         """Update actual node disks volumes to disks from snapshot
 
@@ -1521,22 +2943,70 @@ class LibvirtNode(node.Node):
                             uuid=snap_disk_file).backing_store
                     disk.save()
 
+    @staticmethod
+    def _set_volume_xml_backing_store(volume_xml, backing_store):
+        """Point volume XML to the backing store if it points elsewhere
+
+        :type volume_xml: str
+        :type backing_store: LibvirtVolume
+        :rtype: str
+        """
+        volume_xmltree = ET.fromstring(volume_xml)
+        backing_path = backing_store.get_path()
+        xml_backing_store = volume_xmltree.find('./backingStore')
+        if xml_backing_store is None:
+            xml_backing_store = ET.SubElement(volume_xmltree, 'backingStore')
+        elif xml_backing_store.findtext('./path') == backing_path:
+            return volume_xml
+
+        for child in list(xml_backing_store):
+            xml_backing_store.remove(child)
+        ET.SubElement(xml_backing_store, 'path').text = backing_path
+        ET.SubElement(xml_backing_store, 'format',
+                      type=backing_store.format)
+        return helpers.xml_tostring(volume_xmltree)
+
+    @_snapshot_span('node.revert.recreate_disks')
     @decorators.retry(libvirt.libvirtError)
     def _node_revert_snapshot_recreate_disks(self, name):
         """Recreate snapshot disks."""
         snapshot = self._get_snapshot(name)
 
         if snapshot.children_num == 0:
+            # Save actual volumes XML, delete volumes and create
+            # new from saved XML. Every volume is recreated right after
+            # it is deleted, so a failure (and a retry) never leaves
+            # deleted disks behind; pools are refreshed once at the end
+            index = self.get_snapshot_index()
+            pools = {}
             for s_disk_data in snapshot.disks.values():
                 logger.info("Recreate {0}".format(s_disk_data))
 
-                # Save actual volume XML, delete volume and create
-                # new from saved XML
                 volume = self.driver.conn.storageVolLookupByKey(s_disk_data)
+                volume_pool = self.driver.get_volume_pool(volume)
                 volume_xml = volume.XMLDesc()
-                volume_pool = volume.storagePoolLookupByVolume()
+
+                # Flattened image is backed by the root volume, recreate
+                # it on top of the volume the snapshot is based on
+                snap_vol = self.get_volume(uuid=s_disk_data)
+                if snap_vol.backing_store is not None:
+                    volume_xml = self._set_volume_xml_backing_store(
+                        volume_xml, snap_vol.backing_store)
+                    self._get_volume_chain(snap_vol, index)
+                    self._get_volume_chain(snap_vol.backing_store, index)
+                    index.set_chain_length(
+                        snap_vol.id,
+                        index.get_chain_length(
+                            snap_vol.backing_store.id) + 1)
+
                 volume.delete()
-                volume_pool.createXML(volume_xml)
+                self.driver.create_volumes([volume_xml], pool=volume_pool,
+                                           refresh=False)
+                pools[volume_pool.name()] = volume_pool
+            self.save()
+
+            for volume_pool in pools.values():
+                self.driver.refresh_storage_pool(volume_pool)
 
     def _revert_external_snapshot(self, name=None):
         snapshot = self._get_snapshot(name)
@@ -1553,14 +3023,15 @@ class LibvirtNode(node.Node):
             # Revert snapshot
             # self.driver.node_revert_snapshot(node=self, name=name)
             self._redefine_external_snapshot(name=name)
+            self._flatten_snapshot_chains_by_policy()
         else:
             # Looking for last reverted snapshot without children
             # or create new and start next snapshot chain
-            revert_name = name + '-revert'
-            revert_count = 0
-            create_new = True
+            index = self.get_snapshot_index()
+            if not index.has_snapshot(name):
+                index = self.rebuild_snapshot_index()
 
-            while self.has_snapshot(revert_name):
+            for revert_name in index.get_revert_names(name):
                 # Check wheter revert snapshot has children
                 snapshot_revert = self._get_snapshot(revert_name)
                 if snapshot_revert.children_num == 0:
@@ -1577,27 +3048,23 @@ class LibvirtNode(node.Node):
                     # self.driver.node_revert_snapshot(
                     #    node=self, name=revert_name)
                     self._redefine_external_snapshot(name=revert_name)
-                    create_new = False
-                    break
-                else:
-                    revert_name = name + '-revert' + str(revert_count)
-                    revert_count += 1
+                    self._flatten_snapshot_chains_by_policy()
+                    return
 
-            if create_new:
-                logger.info("Create new revert snapshot")
+            logger.info("Create new revert snapshot")
+            revert_name = index.add_revert(name)
 
-                # Update current node disks
-                self._update_disks_from_snapshot(name)
+            # Update current node disks
+            self._update_disks_from_snapshot(name)
 
-                # Revert snapshot
-                # self.driver.node_revert_snapshot(node=self, name=name)
-                self._redefine_external_snapshot(name=name)
+            # Revert snapshot
+            # self.driver.node_revert_snapshot(node=self, name=name)
+            self._redefine_external_snapshot(name=name)
 
-                # Create new snapshot
-                self.snapshot(name=revert_name, external=True)
+            # Create new snapshot
+            self.snapshot(name=revert_name, external=True)
 
-    @decorators.retry(libvirt.libvirtError)
-    def revert(self, name=None):
+    def revert(self, name=None, resume=False):
         """Method to revert node in state from snapshot
 
            For external snapshots in libvirt we use restore function.
@@ -1608,34 +3075,57 @@ class LibvirtNode(node.Node):
            In case of usage external snapshots we clean snapshot disk when
            revert to snapshot without childs and create new snapshot point
            when reverting to snapshots with childs.
+
+        :param resume: leave node running if the snapshot has memory state
         """
-        if self.has_snapshot(name):
-            snapshot = self._get_snapshot(name)
+        if self._revert_snapshot(name, paused=resume) and resume:
+            self._resume_reverted(name)
 
-            if snapshot.get_type == 'external':
-                # EXTERNAL SNAPSHOT
-                self._revert_external_snapshot(name)
-            else:
-                # ORIGINAL SNAPSHOT
-                logger.info("Revert {0} ({1}) to internal snapshot {2}".format(
-                    self.name, snapshot.state, name))
-                # noinspection PyProtectedMember
-                self._libvirt_node.revertToSnapshot(snapshot._snapshot, 0)
+        # unblock all interfaces
+        self.driver.set_blocked(self.interfaces, blocked=False,
+                                missing_ok=True)
 
-        else:
+    @_snapshot_span('node.revert')
+    @decorators.retry(libvirt.libvirtError)
+    def _revert_snapshot(self, name=None, paused=False):
+        """Revert node to snapshot without unblocking its interfaces
+
+        :param paused: leave node paused if the snapshot has memory state,
+            otherwise internal snapshots are reverted to the state of the
+            snapshot and external ones are restored paused
+        :rtype: bool
+        :returns: True if the node is left paused by the revert
+        """
+        if not self.has_snapshot(name):
             raise error.DevopsError(
                 'Domain snapshot for {0} node not found: no domain '
                 'snapshot with matching'
                 ' name {1}'.format(self.name, name))
 
-        # unblock all interfaces
-        for iface in self.interfaces:
-            if iface.is_blocked:
-                logger.info("Interface({}) in {} network has "
-                            "been unblocked".format(
-                                iface.mac_address,
-                                iface.l2_network_device.name))
-                iface.unblock()
+        snapshot = self._get_snapshot(name)
+        state = snapshot.state
+        if snapshot.get_type == 'external':
+            # EXTERNAL SNAPSHOT
+            self._revert_external_snapshot(name)
+            # domain is restored paused
+            return state != 'shutoff'
+
+        # ORIGINAL SNAPSHOT
+        logger.info("Revert {0} ({1}) to internal snapshot {2}".format(
+            self.name, state, name))
+        flags = 0
+        if paused and state != 'shutoff':
+            flags = libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_PAUSED
+        with self._span('node.revert.libvirt', snapshot=name):
+            # noinspection PyProtectedMember
+            self._libvirt_node.revertToSnapshot(snapshot._snapshot, flags)
+        return bool(flags) or state == 'paused'
+
+    @decorators.retry(libvirt.libvirtError)
+    def _resume_reverted(self, name):
+        """Resume node left paused by _revert_snapshot()"""
+        with self._span('node.revert.resume', snapshot=name):
+            self._libvirt_node.resume()
 
     @decorators.retry(libvirt.libvirtError)
     def _get_snapshot(self, name):
@@ -1655,6 +3145,7 @@ class LibvirtNode(node.Node):
         snapshots = self._libvirt_node.listAllSnapshots(0)
         return [Snapshot(snap) for snap in snapshots]
 
+    @_snapshot_span('node.erase_snapshot')
     @decorators.retry(libvirt.libvirtError)
     def erase_snapshot(self, name):
         if self.has_snapshot(name):
@@ -1677,13 +3168,17 @@ class LibvirtNode(node.Node):
                 snapshot.delete_snapshot_files()
                 snapshot.delete(2)
 
+                index = self.get_snapshot_index()
                 for disk in self.disk_devices:
                     if disk.device == 'disk':
                         snap_disk = disk.volume
                         # update disk on node
                         disk.volume = disk.volume.backing_store
                         disk.save()
+                        index.remove_volume(snap_disk.id)
                         snap_disk.remove()
+                index.remove_snapshot(name)
+                self.save()
 
             else:
                 # ORIGINAL DELETE
@@ -1801,10 +3296,8 @@ class LibvirtInterface(network.Interface):
     @decorators.retry(libvirt.libvirtError)
     def define(self):
         if self.driver.enable_nwfilters:
-            filter_xml = builder.LibvirtXMLBuilder.build_interface_filter(
-                name=self.nwfilter_name,
-                filterref=self.l2_network_device.network_name)
-            self.driver.conn.nwfilterDefineXML(filter_xml)
+            self.driver.conn.nwfilterDefineXML(self.build_filter_xml())
+            self.driver.nwfilter_states.forget([self.nwfilter_name])
 
         super(LibvirtInterface, self).define()
 
@@ -1813,8 +3306,26 @@ class LibvirtInterface(network.Interface):
         if self.driver.enable_nwfilters:
             if self._nwfilter:
                 self._nwfilter.undefine()
+            self.driver.nwfilter_states.forget([self.nwfilter_name])
         super(LibvirtInterface, self).remove()
 
+    def build_filter_xml(self, uuid=None, blocked=False):
+        """Build XML of the nwfilter of the interface
+
+        :type uuid: str
+        :param blocked: drop all traffic of the interface
+        :rtype: str
+        """
+        rule = None
+        if blocked:
+            rule = dict(action='drop',
+                        direction='inout',
+                        priority='-950')
+        return builder.LibvirtXMLBuilder.build_interface_filter(
+            name=self.nwfilter_name,
+            filterref=self.l2_network_device.network_name,
+            uuid=uuid, rule=rule)
+
     @property
     def nwfilter_name(self):
         return helpers.underscored(
@@ -1843,41 +3354,13 @@ class LibvirtInterface(network.Interface):
         filter_xml = ET.fromstring(self._nwfilter.XMLDesc())
         return filter_xml.find('./rule') is not None
 
-    @decorators.retry(libvirt.libvirtError)
     def block(self):
         """Block traffic on interface"""
-        if not self.driver.enable_nwfilters:
-            return
-        if not self._nwfilter:
-            raise error.DevopsError(
-                "Unable to block interface {} on node {}: nwfilter not"
-                " found!".format(self.label, self.node.name))
+        self.driver.set_blocked([self], blocked=True)
 
-        filter_xml = builder.LibvirtXMLBuilder.build_interface_filter(
-            name=self.nwfilter_name,
-            filterref=self.l2_network_device.network_name,
-            uuid=self._nwfilter.UUIDString(),
-            rule=dict(
-                action='drop',
-                direction='inout',
-                priority='-950'))
-        self.driver.conn.nwfilterDefineXML(filter_xml)
-
-    @decorators.retry(libvirt.libvirtError)
     def unblock(self):
         """Unblock traffic on interface"""
-        if not self.driver.enable_nwfilters:
-            return
-        if not self._nwfilter:
-            raise error.DevopsError(
-                "Unable to unblock interface {} on node {}: nwfilter not"
-                " found!".format(self.label, self.node.name))
-
-        filter_xml = builder.LibvirtXMLBuilder.build_interface_filter(
-            name=self.nwfilter_name,
-            filterref=self.l2_network_device.network_name,
-            uuid=self._nwfilter.UUIDString())
-        self.driver.conn.nwfilterDefineXML(filter_xml)
+        self.driver.set_blocked([self], blocked=False)
 
 
 class LibvirtDiskDevice(volume.DiskDevice):
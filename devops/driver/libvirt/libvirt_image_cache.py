@@ -0,0 +1,341 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import time
+# noinspection PyPep8Naming
+import xml.etree.ElementTree as ET
+
+from django.conf import settings
+import libvirt
+
+from devops.driver.libvirt import libvirt_xml_builder as builder
+from devops.helpers import hashing
+from devops.helpers import helpers
+from devops import logger
+
+
+CachedImage = collections.namedtuple(
+    'CachedImage',
+    ['name', 'digest', 'path', 'format', 'capacity', 'allocation',
+     'refcount', 'last_used', 'source'])
+
+
+QCOW2_MAGIC = b'QFI\xfb'
+
+
+def get_image_format(path):
+    """Detect format of the image file by its header
+
+    :rtype: str
+    :returns: 'qcow2' or 'raw'
+    """
+    with open(path, 'rb') as f:
+        return 'qcow2' if f.read(4) == QCOW2_MAGIC else 'raw'
+
+
+class ImageCache(object):
+    """Content addressed cache of source images in a storage pool
+
+    Every source image is uploaded once into a read-only base volume
+    named by the digest of the file content. Volumes created from the
+    same image are qcow2 overlays of the base volume.
+
+    Reference count of the base volume is the number of volumes of the
+    pool backed by it, so it never gets stale when overlays are removed
+    by devops, virsh or by hand. Completed uploads are marked in the pool
+    by empty volumes named by the digest with complete_prefix, so every
+    user of the pool sees them. Last usage time
+    and source path of base volumes are kept in the index file of the
+    user (IMAGE_CACHE_INDEX).
+
+    Locks of every digest are kept in IMAGE_CACHE_LOCK_DIR shared by all
+    users of the host: an exclusive '.lock' guards upload of the base
+    volume, a shared '.pin' is held by every user of the base volume until
+    its overlay is created, evict() skips images it can't pin exclusively.
+
+    :type conn: libvirt.virConnect
+    :param pool_name: name of the libvirt storage pool
+    :param pool: already known handle of the storage pool
+    :type pool: libvirt.virStoragePool
+    """
+
+    prefix = 'devops-image-'
+    complete_prefix = 'devops-ready-'
+
+    def __init__(self, conn, pool_name, index_path=None, pool=None,
+                 lock_dir=None):
+        self.conn = conn
+        self.pool_name = pool_name
+        self.index_path = index_path or settings.IMAGE_CACHE_INDEX
+        if lock_dir is None:
+            lock_dir = settings.IMAGE_CACHE_LOCK_DIR
+        self.lock_dir = lock_dir
+        self._pool = pool
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = self.conn.storagePoolLookupByName(self.pool_name)
+        return self._pool
+
+    @property
+    def _index_key(self):
+        return '{0}/{1}'.format(self.conn.getURI(), self.pool_name)
+
+    @contextlib.contextmanager
+    def _index(self):
+        """Lock index file and yield index of this pool for update"""
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        with open(self.index_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                index = json.loads(content) if content else {}
+                pool_index = index.setdefault(self._index_key, {})
+                yield pool_index
+                f.seek(0)
+                f.truncate()
+                json.dump(index, f, indent=2, sort_keys=True)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_volume_name(self, digest):
+        return self.prefix + digest
+
+    def get_marker_name(self, digest):
+        return self.complete_prefix + digest
+
+    def _open_lock(self, digest, kind, shared=False, blocking=True):
+        """Open and lock a lock file of the image
+
+        :param kind: 'lock' or 'pin'
+        :rtype: file
+        :returns: locked file, closing it releases the lock; None if
+            blocking is False and the file is locked by someone else
+        """
+        if not self.lock_dir:
+            return open(os.devnull)
+        path = os.path.join(self.lock_dir, '{0}.{1}'.format(digest, kind))
+        f = helpers.open_shared_file(path)
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except IOError as e:
+            f.close()
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return f
+
+    @contextlib.contextmanager
+    def _lock_image(self, digest, kind='lock', blocking=True):
+        """Lock the image exclusively for all processes of the host
+
+        Yields False if blocking is False and the image is already locked.
+        """
+        f = self._open_lock(digest, kind, blocking=blocking)
+        if f is None:
+            yield False
+            return
+        with f:
+            yield True
+
+    def _lookup(self, name):
+        try:
+            return self.pool.storageVolLookupByName(name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_VOL:
+                return None
+            raise
+
+    def _mark_complete(self, digest):
+        xml = builder.LibvirtXMLBuilder.build_volume_xml(
+            name=self.get_marker_name(digest),
+            capacity=0,
+            vol_format='raw',
+            backing_store_path=None,
+            backing_store_format=None,
+            permissions_mode='0444',
+        )
+        self.pool.createXML(xml, 0)
+
+    def acquire_base(self, path, upload):
+        """Get base volume with content of the image, upload it if needed
+
+        Blocks while the image is uploaded, by this or another process.
+        The base volume is pinned until the returned pin is closed, so
+        close it when overlays of the volume are created. Images are not
+        evicted here, call trim() afterwards.
+
+        :param path: path to the source image
+        :param upload: callable(conn, libvirt_volume, path) which uploads
+            the file to the volume
+        :rtype: tuple
+        :returns: (libvirt.virStorageVol, file-like pin)
+        """
+        digest = hashing.get_file_digest(path)
+        pin = self._open_lock(digest, 'pin', shared=True)
+        try:
+            base_vol = self._get_base(digest, path, upload)
+        except Exception:
+            pin.close()
+            raise
+        return base_vol, pin
+
+    def get_base(self, path, upload):
+        """Get base volume like acquire_base() without pinning it
+
+        :rtype: libvirt.virStorageVol
+        """
+        base_vol, pin = self.acquire_base(path, upload)
+        pin.close()
+        return base_vol
+
+    def _get_base(self, digest, path, upload):
+        name = self.get_volume_name(digest)
+
+        with self._lock_image(digest):
+            base_vol = self._lookup(name)
+            if (base_vol is not None and
+                    self._lookup(self.get_marker_name(digest)) is None):
+                if self._get_backing_paths()[base_vol.path()]:
+                    # Volume was cached before uploads were marked
+                    self._mark_complete(digest)
+                else:
+                    logger.warning(
+                        'Removing incomplete cached image {}'.format(name))
+                    base_vol.delete(0)
+                    base_vol = None
+
+            if base_vol is None:
+                logger.info('Caching image {0} as {1}'.format(path, name))
+                xml = builder.LibvirtXMLBuilder.build_volume_xml(
+                    name=name,
+                    capacity=helpers.get_file_size(path),
+                    vol_format=get_image_format(path),
+                    backing_store_path=None,
+                    backing_store_format=None,
+                    permissions_mode='0444',
+                )
+                base_vol = self.pool.createXML(xml, 0)
+                upload(self.conn, base_vol, path)
+                self._mark_complete(digest)
+
+        with self._index() as index:
+            index[digest] = {
+                'source': os.path.abspath(path),
+                'last_used': time.time(),
+            }
+        return base_vol
+
+    def _get_backing_paths(self):
+        """Count volumes of the pool by their backing store path
+
+        :rtype: collections.Counter
+        """
+        counter = collections.Counter()
+        for vol in self.pool.listAllVolumes(0):
+            path = ET.fromstring(vol.XMLDesc(0)).findtext('backingStore/path')
+            if path:
+                counter[path] += 1
+        return counter
+
+    def list(self):
+        """List cached images, least recently used first
+
+        :rtype: list
+        """
+        with self._index() as index:
+            index = dict(index)
+        backing_paths = self._get_backing_paths()
+
+        images = []
+        for vol in self.pool.listAllVolumes(0):
+            name = vol.name()
+            if not name.startswith(self.prefix):
+                continue
+            digest = name[len(self.prefix):]
+            info = index.get(digest, {})
+            _, capacity, allocation = vol.info()
+            xml = ET.fromstring(vol.XMLDesc(0))
+            images.append(CachedImage(
+                name=name,
+                digest=digest,
+                path=vol.path(),
+                format=xml.find('target/format').get('type'),
+                capacity=capacity,
+                allocation=allocation,
+                refcount=backing_paths[vol.path()],
+                last_used=info.get('last_used', 0),
+                source=info.get('source'),
+            ))
+        return sorted(images, key=lambda img: img.last_used)
+
+    def evict(self, max_size=0):
+        """Remove least recently used base volumes without overlays
+
+        Images pinned by acquire_base(), which are being uploaded or wait
+        for their overlays, are skipped.
+
+        :param max_size: remove images until total allocation of cached
+            images is not more than this number of bytes
+        :rtype: list
+        :returns: names of removed volumes
+        """
+        images = self.list()
+        total = sum(img.allocation for img in images)
+        evicted = collections.OrderedDict()
+        for img in images:
+            if total <= max_size:
+                break
+            if img.refcount:
+                continue
+            with self._lock_image(img.digest, 'pin',
+                                  blocking=False) as locked:
+                if not locked:
+                    continue
+                logger.info('Evicting cached image {}'.format(img.name))
+                marker = self._lookup(self.get_marker_name(img.digest))
+                if marker is not None:
+                    marker.delete(0)
+                self.pool.storageVolLookupByName(img.name).delete(0)
+            total -= img.allocation
+            evicted[img.digest] = img.name
+
+        if evicted:
+            with self._index() as index:
+                for digest in evicted:
+                    index.pop(digest, None)
+        return list(evicted.values())
+
+    def trim(self):
+        """Evict images over IMAGE_CACHE_MAX_SIZE if the limit is set
+
+        :rtype: list
+        :returns: names of removed volumes
+        """
+        if not settings.IMAGE_CACHE_MAX_SIZE:
+            return []
+        return self.evict(max_size=settings.IMAGE_CACHE_MAX_SIZE * 1024 ** 3)
@@ -0,0 +1,239 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import contextlib
+import errno
+import gzip
+import hashlib
+import os
+import shutil
+import time
+# noinspection PyPep8Naming
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+from devops import logger
+
+PREFIX = 'snapshot-memory-'
+SUFFIX = '.gz'
+CHUNK_SIZE = 1024 * 1024
+
+
+class _HashingWriter(object):
+    """File-like object which hashes data written to the file"""
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def list_snapshot_memory_files(conn):
+    """Get memory files of snapshots of all domains of the connection
+
+    Domains which are not managed by devops, e.g. of another database or
+    defined by hand, are included.
+
+    :type conn: libvirt.virConnect
+    :rtype: set
+    """
+    memory_files = set()
+    for domain in conn.listAllDomains(0):
+        try:
+            snapshots = domain.listAllSnapshots(0)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            continue
+        for snap in snapshots:
+            try:
+                xml = ET.fromstring(snap.getXMLDesc(0))
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+                    raise
+                continue
+            memory = xml.find('memory')
+            if memory is not None and memory.get('file'):
+                memory_files.add(memory.get('file'))
+    return memory_files
+
+
+class MemoryFiles(object):
+    """Memory state files of external snapshots
+
+    Without compression files are kept as they are written by libvirt.
+    With 'gzip' compression every memory file is replaced by a gzip file
+    with the same name and '.gz' suffix, which is decompressed back when
+    the domain is restored from it. Compressed files are deduplicated:
+    each of them is a hard link to a file named by the digest of its
+    content in the '.objects' subdirectory, so identical memory files
+    (e.g. of paused nodes snapshotted several times) take space once.
+
+    :param path: directory of memory files, SNAPSHOTS_EXTERNAL_DIR
+    :param compression: '' or 'gzip'
+    :param level: compression level, 1 is the fastest
+    """
+
+    def __init__(self, path, compression='', level=1):
+        self.path = path
+        self.compression = compression
+        self.level = level
+
+    @property
+    def objects_path(self):
+        return os.path.join(self.path, '.objects')
+
+    @staticmethod
+    def exists(memory_file):
+        return (os.path.exists(memory_file) or
+                os.path.exists(memory_file + SUFFIX))
+
+    def compress(self, memory_file):
+        """Compress memory file written by libvirt
+
+        :type memory_file: str
+        :rtype: str
+        :returns: path to the file which keeps the memory state
+        """
+        if self.compression != 'gzip' or not os.path.isfile(memory_file):
+            return memory_file
+
+        if not os.path.isdir(self.objects_path):
+            os.makedirs(self.objects_path)
+
+        tmp_file = memory_file + SUFFIX + '.tmp'
+        digest = hashlib.sha256()
+        try:
+            with open(memory_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+                # no file name and time in the header, so identical
+                # memory files are compressed to identical files
+                with gzip.GzipFile(filename='', mode='wb',
+                                   compresslevel=self.level, mtime=0,
+                                   fileobj=_HashingWriter(dst, digest)) as gz:
+                    shutil.copyfileobj(src, gz, CHUNK_SIZE)
+        except (IOError, OSError) as e:
+            # file can be unreadable for the user if it is owned by qemu
+            logger.warning('Unable to compress {0}: {1}'.format(
+                memory_file, e))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return memory_file
+
+        object_file = os.path.join(self.objects_path, digest.hexdigest())
+        try:
+            # a recent object is not removed by collect_garbage() until
+            # it is linked below
+            os.utime(object_file, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            os.rename(tmp_file, object_file)
+        else:
+            os.remove(tmp_file)
+            logger.debug('Memory file {0} is a duplicate of {1}'.format(
+                memory_file, object_file))
+
+        compressed_file = memory_file + SUFFIX
+        if os.path.exists(compressed_file):
+            os.remove(compressed_file)
+        os.link(object_file, compressed_file)
+        os.remove(memory_file)
+        return compressed_file
+
+    @contextlib.contextmanager
+    def uncompressed(self, memory_file):
+        """Provide memory file in the format libvirt is able to restore
+
+        Compressed file is decompressed for the time of the block.
+
+        :type memory_file: str
+        """
+        compressed_file = memory_file + SUFFIX
+        if (os.path.exists(memory_file) or
+                not os.path.exists(compressed_file)):
+            yield memory_file
+            return
+
+        logger.debug('Decompress {0}'.format(compressed_file))
+        with gzip.open(compressed_file, 'rb') as src,\
+                open(memory_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        try:
+            yield memory_file
+        finally:
+            os.remove(memory_file)
+
+    def collect_garbage(self, referenced, prefixes=None, min_age=3600,
+                        dry_run=False):
+        """Remove memory files which are not used by any snapshot
+
+        :param referenced: memory files of existing snapshots
+        :param prefixes: remove only memory files which names start with
+            one of these prefixes after PREFIX, e.g. names of environments
+            followed by '_', all files if None
+        :param min_age: keep files and objects changed less than this
+            number of seconds ago, they may belong to snapshots in progress
+        :param dry_run: only return files which would be removed
+        :rtype: list
+        :returns: removed files
+        """
+        if not os.path.isdir(self.path):
+            return []
+        referenced = set(referenced)
+        deadline = time.time() - min_age
+
+        garbage = []
+        for name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, name)
+            if not name.startswith(PREFIX) or not os.path.isfile(path):
+                continue
+            if prefixes is not None and not any(
+                    name.startswith(PREFIX + prefix) for prefix in prefixes):
+                continue
+            memory_file = path
+            for suffix in (SUFFIX + '.tmp', SUFFIX):
+                if memory_file.endswith(suffix):
+                    memory_file = memory_file[:-len(suffix)]
+                    break
+            if memory_file in referenced:
+                continue
+            if os.path.getmtime(path) > deadline:
+                continue
+            garbage.append(path)
+
+        if os.path.isdir(self.objects_path):
+            # links of files removed above don't count
+            removed_links = collections.Counter(
+                os.stat(path).st_ino for path in garbage)
+            for name in sorted(os.listdir(self.objects_path)):
+                path = os.path.join(self.objects_path, name)
+                stat = os.stat(path)
+                if stat.st_mtime > deadline:
+                    continue
+                if stat.st_nlink - removed_links[stat.st_ino] <= 1:
+                    garbage.append(path)
+
+        if not dry_run:
+            for path in garbage:
+                os.remove(path)
+                logger.info('Removed unused memory file {0}'.format(path))
+        return garbage
@@ -0,0 +1,152 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from multiprocessing import pool as mp_pool
+import threading
+# noinspection PyPep8Naming
+import xml.etree.ElementTree as ET
+
+from django.conf import settings
+import libvirt
+
+from devops import error
+from devops.helpers import decorators
+
+
+class FilterState(object):
+    """State of a libvirt nwfilter
+
+    :param uuid: UUID of the filter
+    :param blocked: True if the filter drops all traffic
+    """
+
+    def __init__(self, uuid, blocked):
+        self.uuid = uuid
+        self.blocked = blocked
+
+    def __repr__(self):
+        return '{0}(uuid={1!r}, blocked={2!r})'.format(
+            self.__class__.__name__, self.uuid, self.blocked)
+
+
+class NWFilterStates(object):
+    """Cached states of nwfilters of one libvirt connection
+
+    State of a filter is requested from libvirt once and then kept up to
+    date by set_blocked(), so blocking and unblocking of filters which are
+    already in the desired state doesn't make any libvirt calls. Filters
+    are requested and redefined concurrently, NWFILTER_CONCURRENCY at
+    a time. Filters changed by other processes are not noticed until they
+    are forgotten.
+
+    :type conn: libvirt.virConnect
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+        # {filter name: FilterState}
+        self._states = {}
+
+    def _map(self, func, items):
+        if len(items) < 2:
+            return [func(item) for item in items]
+        pool = mp_pool.ThreadPool(
+            min(settings.NWFILTER_CONCURRENCY, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    @decorators.retry(libvirt.libvirtError)
+    def _fetch(self, name):
+        try:
+            nwfilter = self.conn.nwfilterLookupByName(name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_NWFILTER:
+                return None
+            raise
+        filter_xml = ET.fromstring(nwfilter.XMLDesc())
+        return FilterState(uuid=nwfilter.UUIDString(),
+                           blocked=filter_xml.find('./rule') is not None)
+
+    def get(self, names):
+        """Get states of filters, requesting unknown ones from libvirt
+
+        :type names: list
+        :rtype: dict
+        :returns: {filter name: FilterState or None if not found}
+        """
+        with self._lock:
+            unknown = [name for name in set(names)
+                       if name not in self._states]
+        fetched = dict(zip(unknown, self._map(self._fetch, unknown)))
+        with self._lock:
+            for name, state in fetched.items():
+                if state is not None:
+                    self._states[name] = state
+            states = {name: self._states.get(name) for name in names}
+        return states
+
+    def forget(self, names):
+        """Drop cached states of filters, e.g. after they are redefined
+
+        :type names: list
+        """
+        with self._lock:
+            for name in names:
+                self._states.pop(name, None)
+
+    @decorators.retry(libvirt.libvirtError)
+    def _define(self, job):
+        name, xml = job
+        self.conn.nwfilterDefineXML(xml)
+        return name
+
+    def set_blocked(self, build_xmls, blocked, missing_ok=False):
+        """Block or unblock filters which are not in the desired state
+
+        :param build_xmls: {filter name: function(uuid, blocked)} which
+            builds XML of the filter
+        :type blocked: bool
+        :param missing_ok: skip filters which are not defined instead of
+            raising DevopsError
+        :rtype: list
+        :returns: names of redefined filters
+        """
+        states = self.get(list(build_xmls))
+
+        missing = sorted(name for name, state in states.items()
+                         if state is None)
+        if missing and not missing_ok:
+            raise error.DevopsError(
+                'Unable to {0} traffic: nwfilters not found: {1}'.format(
+                    'block' if blocked else 'unblock', ', '.join(missing)))
+
+        jobs = [(name, build_xmls[name](state.uuid, blocked))
+                for name, state in sorted(states.items())
+                if state is not None and state.blocked != blocked]
+        try:
+            changed = self._map(self._define, jobs)
+        except Exception:
+            # some filters may be changed, request them again next time
+            self.forget([name for name, _ in jobs])
+            raise
+
+        with self._lock:
+            for name in changed:
+                if name in self._states:
+                    self._states[name].blocked = blocked
+        return changed
@@ -0,0 +1,240 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+
+REVERT_RE = re.compile(r'^(?P<name>.+)-revert(?P<num>\d*)$')
+
+
+def revert_name(name, num):
+    """Name of the num-th revert snapshot of a snapshot
+
+    Revert snapshots are named 'name-revert', 'name-revert0',
+    'name-revert1' and so on.
+
+    :type name: str
+    :type num: int
+    :rtype: str
+    """
+    if num == 0:
+        return '{0}-revert'.format(name)
+    return '{0}-revert{1}'.format(name, num - 1)
+
+
+class SnapshotIndex(object):
+    """Index of snapshot chains of a node
+
+    Index is kept in params of the node as a plain dict, so it survives
+    between dos.py runs:
+
+    * volumes - {volume id: {'root': root volume name, 'root_id': root
+      volume id, 'depth': number of backing stores down to the root volume,
+      'length': number of backing files the image actually has}}; length
+      is less than depth when the chain of the volume is flattened
+    * snapshots - {snapshot name: {'parent': name, 'children': [names]}}
+    * reverts - {snapshot name: number of revert snapshots created}
+    * current - name of the current snapshot
+
+    The dict is changed in place, the node has to be saved afterwards.
+
+    :type data: dict
+    """
+
+    def __init__(self, data=None):
+        if data is None:
+            data = {}
+        data.setdefault('volumes', {})
+        data.setdefault('snapshots', {})
+        data.setdefault('reverts', {})
+        data.setdefault('current', None)
+        self.data = data
+
+    @classmethod
+    def build(cls, snapshots, current, volumes):
+        """Build index from scratch
+
+        :param snapshots: list of (snapshot name, parent name or None)
+        :param current: name of the current snapshot or None
+        :param volumes: list of (volume id, volume name, backing store id
+            or None); volumes whose backing store is not listed are
+            skipped
+        :rtype: SnapshotIndex
+        """
+        index = cls()
+        index.current = current
+
+        for name, parent in snapshots:
+            index.data['snapshots'].setdefault(
+                name, {'parent': None, 'children': []})['parent'] = parent
+            if parent is not None:
+                index.data['snapshots'].setdefault(
+                    parent, {'parent': None, 'children': []}
+                )['children'].append(name)
+
+        for name in index.data['snapshots']:
+            match = REVERT_RE.match(name)
+            if match is None or not index.has_snapshot(match.group('name')):
+                continue
+            num = int(match.group('num')) + 1 if match.group('num') else 0
+            reverts = index.data['reverts']
+            reverts[match.group('name')] = max(
+                reverts.get(match.group('name'), 0), num + 1)
+
+        rows = {vol_id: (vol_name, backing_id)
+                for vol_id, vol_name, backing_id in volumes}
+        chains = {}
+        for vol_id in rows:
+            path = []
+            cur_id = vol_id
+            while cur_id not in chains:
+                if cur_id not in rows or len(path) > len(rows):
+                    # unknown backing store or a loop
+                    path = None
+                    break
+                vol_name, backing_id = rows[cur_id]
+                if backing_id is None:
+                    chains[cur_id] = (vol_name, cur_id, 0)
+                    break
+                path.append(cur_id)
+                cur_id = backing_id
+            if path is None:
+                continue
+            root, root_id, depth = chains[cur_id]
+            for path_id in reversed(path):
+                depth += 1
+                chains[path_id] = (root, root_id, depth)
+
+        for vol_id, (root, root_id, depth) in chains.items():
+            index.add_volume(vol_id, root, depth, root_id=root_id)
+        return index
+
+    @property
+    def current(self):
+        return self.data['current']
+
+    @current.setter
+    def current(self, name):
+        self.data['current'] = name
+
+    def get_volume_chain(self, volume_id):
+        """Get root volume name and depth of a volume chain
+
+        :type volume_id: int
+        :rtype: tuple or None
+        :returns: (root volume name, depth) or None if volume is unknown
+        """
+        chain = self.data['volumes'].get(str(volume_id))
+        if chain is None:
+            return None
+        return chain['root'], chain['depth']
+
+    def add_volume(self, volume_id, root, depth, root_id=None, length=None):
+        """Add volume to the index
+
+        :type volume_id: int
+        :param root: name of the root volume of the chain
+        :param depth: number of backing stores down to the root volume
+        :param root_id: id of the root volume
+        :param length: number of backing files of the image, equals to
+            depth by default
+        :rtype: tuple
+        """
+        self.data['volumes'][str(volume_id)] = {
+            'root': root,
+            'root_id': root_id,
+            'depth': depth,
+            'length': depth if length is None else length,
+        }
+        return root, depth
+
+    def get_root_id(self, volume_id):
+        return self.data['volumes'][str(volume_id)]['root_id']
+
+    def get_chain_length(self, volume_id):
+        """Get number of backing files the image of a volume has
+
+        :type volume_id: int
+        :rtype: int
+        """
+        return self.data['volumes'][str(volume_id)]['length']
+
+    def set_chain_length(self, volume_id, length):
+        self.data['volumes'][str(volume_id)]['length'] = length
+
+    def remove_volume(self, volume_id):
+        self.data['volumes'].pop(str(volume_id), None)
+
+    def has_snapshot(self, name):
+        return name in self.data['snapshots']
+
+    def get_parent(self, name):
+        return self.data['snapshots'][name]['parent']
+
+    def get_children(self, name):
+        return list(self.data['snapshots'][name]['children'])
+
+    def add_snapshot(self, name, parent=None):
+        """Add snapshot to the index
+
+        :param parent: name of the parent snapshot, usually the current
+            snapshot at the moment the snapshot is created
+        """
+        self.remove_snapshot(name)
+        self.data['snapshots'][name] = {'parent': parent, 'children': []}
+        if parent is not None and self.has_snapshot(parent):
+            self.data['snapshots'][parent]['children'].append(name)
+
+    def remove_snapshot(self, name):
+        """Remove snapshot from the index
+
+        Children of the snapshot are moved to its parent and the parent
+        becomes current if the snapshot was current, the same way
+        libvirt does it.
+        """
+        snapshot = self.data['snapshots'].pop(name, None)
+        if snapshot is None:
+            return
+        parent = snapshot['parent']
+        if parent is not None and self.has_snapshot(parent):
+            children = self.data['snapshots'][parent]['children']
+            children.remove(name)
+            children.extend(snapshot['children'])
+        else:
+            parent = None
+        for child in snapshot['children']:
+            self.data['snapshots'][child]['parent'] = parent
+        if self.current == name:
+            self.current = parent
+
+    def get_revert_names(self, name):
+        """Get names of existing revert snapshots of a snapshot
+
+        :rtype: list
+        :returns: names in the order of creation
+        """
+        names = (revert_name(name, num)
+                 for num in range(self.data['reverts'].get(name, 0)))
+        return [revert_name_ for revert_name_ in names
+                if self.has_snapshot(revert_name_)]
+
+    def add_revert(self, name):
+        """Reserve the name of a new revert snapshot of a snapshot
+
+        :rtype: str
+        """
+        num = self.data['reverts'].get(name, 0)
+        while self.has_snapshot(revert_name(name, num)):
+            num += 1
+        self.data['reverts'][name] = num + 1
+        return revert_name(name, num)
@@ -0,0 +1,218 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+import libvirt
+
+from devops import logger
+
+
+StatsSample = collections.namedtuple(
+    'StatsSample',
+    ['timestamp', 'cpu_time', 'vcpu', 'memory',
+     'rd_reqs', 'wr_reqs', 'rd_bytes', 'wr_bytes',
+     'rx_bytes', 'tx_bytes'])
+
+
+NodeRates = collections.namedtuple(
+    'NodeRates',
+    ['cpu', 'memory', 'iops', 'read_mbps', 'write_mbps',
+     'rx_mbps', 'tx_mbps'])
+
+MB = 1024 * 1024
+
+
+def make_sample(state, timestamp):
+    """Reduce DomainState to a compact counters sample
+
+    :type state: devops.driver.libvirt.libvirt_driver.DomainState
+    :type timestamp: float
+    :rtype: StatsSample
+    """
+    block = state.block
+    net = state.net
+    return StatsSample(
+        timestamp=timestamp,
+        cpu_time=state.cpu_time or 0,
+        vcpu=state.vcpu or 1,
+        memory=state.memory or 0,
+        rd_reqs=sum(dev['rd_reqs'] for dev in block),
+        wr_reqs=sum(dev['wr_reqs'] for dev in block),
+        rd_bytes=sum(dev['rd_bytes'] for dev in block),
+        wr_bytes=sum(dev['wr_bytes'] for dev in block),
+        rx_bytes=sum(dev['rx_bytes'] for dev in net),
+        tx_bytes=sum(dev['tx_bytes'] for dev in net),
+    )
+
+
+def get_rates(prev, last):
+    """Calculate resource usage rates between two samples
+
+    Counters going backwards (domain was restarted between samples)
+    are treated as zero rates.
+
+    :type prev: StatsSample
+    :type last: StatsSample
+    :rtype: NodeRates
+    """
+    interval = last.timestamp - prev.timestamp
+    if interval <= 0:
+        return None
+
+    def rate(field):
+        delta = getattr(last, field) - getattr(prev, field)
+        return max(delta, 0) / float(interval)
+
+    return NodeRates(
+        cpu=round(rate('cpu_time') / 1e9 / last.vcpu * 100, 1),
+        memory=last.memory // 1024,
+        iops=round(rate('rd_reqs') + rate('wr_reqs'), 1),
+        read_mbps=round(rate('rd_bytes') / MB, 2),
+        write_mbps=round(rate('wr_bytes') / MB, 2),
+        rx_mbps=round(rate('rx_bytes') / MB, 2),
+        tx_mbps=round(rate('tx_bytes') / MB, 2),
+    )
+
+
+class StatsCollector(object):
+    """Periodically samples resource usage of libvirt domains
+
+    Each sampling is a single getAllDomainStats() request for all domains
+    of the connection, samples are kept in a fixed size ring buffer per
+    domain, so the collector can be left running for the whole test run.
+
+    :type driver: devops.driver.libvirt.libvirt_driver.LibvirtDriver
+    :param interval: seconds between samples
+    :param size: number of samples to keep for every domain
+    """
+
+    def __init__(self, driver, interval=5, size=120):
+        self.driver = driver
+        self.interval = interval
+        self.size = size
+        self.uuids = None
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample(self, uuids=None):
+        """Take one sample of all (or only selected) domains
+
+        :param uuids: collection of domain UUIDs, all domains if None
+        """
+        if uuids is None:
+            uuids = self.uuids
+        states = self.driver.get_domains_state(self.driver.domain_stats)
+        timestamp = time.time()
+        with self._lock:
+            for uuid, state in states.items():
+                if uuids is not None and uuid not in uuids:
+                    continue
+                if uuid not in self._buffers:
+                    self._buffers[uuid] = collections.deque(maxlen=self.size)
+                self._buffers[uuid].append(make_sample(state, timestamp))
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except libvirt.libvirtError as e:
+                logger.warning('Failed to collect domain stats: {}'.format(e))
+
+    def start(self, uuids=None):
+        """Start sampling in a background thread
+
+        :param uuids: collection of domain UUIDs, all domains if None
+        """
+        if self.is_running:
+            return
+        self.uuids = set(uuids) if uuids is not None else None
+        self._stop_event.clear()
+        self.sample()
+        self._thread = threading.Thread(target=self._run,
+                                        name='libvirt-stats')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+
+    def get_samples(self, uuid):
+        """Get collected samples of domain, oldest first
+
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._buffers.get(uuid, ()))
+
+    def get_rates(self, uuid):
+        """Get rates between two last samples of domain
+
+        :rtype: NodeRates or None
+        """
+        with self._lock:
+            samples = self._buffers.get(uuid)
+            if samples is None or len(samples) < 2:
+                return None
+            return get_rates(samples[-2], samples[-1])
+
+    def get_history(self, uuid):
+        """Get rates for every pair of adjacent samples of domain
+
+        :rtype: list
+        """
+        samples = self.get_samples(uuid)
+        return [get_rates(prev, last)
+                for prev, last in zip(samples, samples[1:])]
+
+
+class _StatsCollectors(object):
+    """Process-wide registry of collectors
+
+    Drivers share a collector if they use the same libvirt connection
+    with the same sampling interval and buffer size.
+    """
+
+    def __init__(self):
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def get_collector(self, driver):
+        with self._lock:
+            key = (driver.connection_string, driver.stats_interval,
+                   driver.stats_buffer_size)
+            if key not in self.collectors:
+                self.collectors[key] = StatsCollector(
+                    driver,
+                    interval=driver.stats_interval,
+                    size=driver.stats_buffer_size)
+            return self.collectors[key]
+
+
+StatsCollectors = _StatsCollectors()
@@ -0,0 +1,211 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+from multiprocessing import pool as mp_pool
+import sys
+import threading
+
+from django.conf import settings
+import libvirt
+import six
+# pylint: disable=import-error
+# noinspection PyUnresolvedReferences
+from six.moves import queue
+# pylint: enable=import-error
+
+from devops.helpers import decorators
+from devops import logger
+
+
+class _IOLimit(object):
+    """Process-wide limit of concurrent volume I/O operations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        with self._lock:
+            if self._semaphore is None:
+                self._semaphore = threading.BoundedSemaphore(
+                    settings.VOLUME_IO_CONCURRENCY)
+            return self._semaphore
+
+
+IOLimit = _IOLimit()
+
+
+class VolumePipeline(object):
+    """Creates libvirt volumes and uploads their images concurrently
+
+    Database is accessed only from the thread which runs the pipeline:
+    volume XMLs are prepared and models are saved there, while worker
+    threads do only libvirt calls. Volumes with a backing store which is
+    defined by the same pipeline wait until the backing store is ready.
+
+    Concurrency is bounded by VOLUME_IO_CONCURRENCY for all volume I/O
+    of the process and additionally by VOLUME_UPLOAD_STREAMS for uploads.
+    Source images of volumes which use the image cache are cached by
+    upload threads before the volumes are created, cached images stay
+    pinned until their overlays are created.
+
+    :type conn: libvirt.virConnect
+    :param pool: storage pool for volumes
+    :type pool: libvirt.virStoragePool
+    :param image_cache: cache of source images, None if it isn't used
+    :type image_cache: libvirt_image_cache.ImageCache
+    """
+
+    def __init__(self, conn, pool, image_cache=None):
+        self.conn = conn
+        self.pool = pool
+        self.image_cache = image_cache
+        self._events = queue.Queue()
+
+    def _run(self, stage, vol, func, *args):
+        with IOLimit.semaphore:
+            try:
+                result = func(*args)
+            except Exception:
+                self._events.put((stage, vol, None, sys.exc_info()))
+            else:
+                self._events.put((stage, vol, result, None))
+
+    @decorators.retry(libvirt.libvirtError)
+    def _create(self, xml):
+        return self.pool.createXML(xml, 0)
+
+    @decorators.retry(libvirt.libvirtError, count=2)
+    def _upload(self, vol, libvirt_volume, capacity):
+        vol.upload_image(self.conn, libvirt_volume, vol.source_image,
+                         capacity=capacity)
+
+    def run(self, groups):
+        """Define volumes, yield keys of groups with all volumes defined
+
+        :param groups: list of (key, [LibvirtVolume, ...])
+        :rtype: generator
+        """
+        groups = list(groups)
+        remaining = {}
+        group_keys = {}
+        volumes = collections.OrderedDict()
+        for key, vols in groups:
+            remaining[key] = len(vols)
+            for vol in vols:
+                group_keys[vol.pk] = key
+                volumes[vol.pk] = vol
+            if not vols:
+                yield key
+
+        waiting = collections.defaultdict(list)
+        upload_info = {}
+        pins = {}
+        done = set()
+        in_flight = [0]
+        error = []
+
+        create_pool = mp_pool.ThreadPool(settings.VOLUME_IO_CONCURRENCY)
+        upload_pool = mp_pool.ThreadPool(settings.VOLUME_UPLOAD_STREAMS)
+
+        def submit_create(vol, base_vol=None):
+            try:
+                if (base_vol is None and self.image_cache is not None and
+                        vol.uses_image_cache()):
+                    in_flight[0] += 1
+                    upload_pool.apply_async(
+                        self._run,
+                        ('cache', vol, self.image_cache.acquire_base,
+                         vol.source_image, vol.upload_file))
+                    return
+                xml, capacity, upload = vol.get_define_xml(base_vol=base_vol)
+            except Exception:
+                error.append(sys.exc_info())
+                return
+            if upload:
+                upload_info[vol.pk] = capacity
+            in_flight[0] += 1
+            create_pool.apply_async(
+                self._run, ('create', vol, self._create, xml))
+
+        def submit(vol):
+            backing_pk = vol.backing_store_id
+            if backing_pk in volumes and backing_pk not in done:
+                waiting[backing_pk].append(vol)
+            else:
+                submit_create(vol)
+
+        try:
+            for vol in volumes.values():
+                if error:
+                    break
+                submit(vol)
+
+            while in_flight[0]:
+                stage, vol, result, exc_info = self._events.get()
+                in_flight[0] -= 1
+                if stage == 'create' and vol.pk in pins:
+                    # Overlay exists or failed, the image may be evicted
+                    pins.pop(vol.pk).close()
+                if exc_info is not None:
+                    logger.error('Failed to {0} volume {1!r}'.format(
+                        stage, vol.name))
+                    error.append(exc_info)
+                    continue
+
+                if stage == 'cache':
+                    base_vol, pins[vol.pk] = result
+                    if not error:
+                        submit_create(vol, base_vol=base_vol)
+                    continue
+
+                if stage == 'create':
+                    vol.set_libvirt_volume(result)
+                    vol.save()
+                    if vol.pk in upload_info and not error:
+                        in_flight[0] += 1
+                        upload_pool.apply_async(
+                            self._run,
+                            ('upload', vol, self._upload, vol, result,
+                             upload_info[vol.pk]))
+                        continue
+                else:
+                    vol.save()
+
+                done.add(vol.pk)
+                if error:
+                    continue
+                for dependent in waiting.pop(vol.pk, []):
+                    submit(dependent)
+                key = group_keys[vol.pk]
+                remaining[key] -= 1
+                if remaining[key] == 0:
+                    yield key
+        finally:
+            create_pool.close()
+            upload_pool.close()
+            create_pool.join()
+            upload_pool.join()
+            # Release images cached by jobs which weren't waited for
+            while not self._events.empty():
+                stage, vol, result, exc_info = self._events.get()
+                if stage == 'cache' and exc_info is None:
+                    pins[vol.pk] = result[1]
+            for pin in pins.values():
+                pin.close()
+
+        if error:
+            six.reraise(*error[0])
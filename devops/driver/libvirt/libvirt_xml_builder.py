@@ -14,11 +14,14 @@
 from __future__ import unicode_literals
 
 import hashlib
+# noinspection PyPep8Naming
+import xml.etree.ElementTree as ET
 
 import six
 
 from devops.helpers.decorators import logwrap
 from devops.helpers import xmlgenerator
+from devops.helpers.xmlgenerator import sub_element
 
 
 class LibvirtXMLBuilder(object):
@@ -94,7 +97,7 @@ class LibvirtXMLBuilder(object):
     @classmethod
     @logwrap
     def build_volume_xml(cls, name, capacity, vol_format, backing_store_path,
-                         backing_store_format):
+                         backing_store_format, permissions_mode="0644"):
         """Generate volume XML
 
         :rtype : String
@@ -104,7 +107,7 @@ class LibvirtXMLBuilder(object):
         volume_xml.capacity(str(capacity))
         with volume_xml.target:
             volume_xml.format(type=vol_format)
-            volume_xml.permissions.mode("0644")
+            volume_xml.permissions.mode(permissions_mode)
         if backing_store_path:
             with volume_xml.backingStore:
                 volume_xml.path(backing_store_path)
@@ -146,56 +149,73 @@ class LibvirtXMLBuilder(object):
         return str(xml_builder)
 
     @classmethod
-    def _build_disk_device(cls, device_xml, disk_type, disk_device,
+    def _build_disk_device(cls, devices, disk_type, disk_device,
                            disk_volume_format, disk_volume_path, disk_bus,
                            disk_target_dev, disk_serial, disk_wwn):
         """Build xml for disk
 
-        :param device_xml: XMLBuilder
-        :param disk_device: DiskDevice
+        :param devices: devices element of the domain
+        :type devices: ET.Element
         """
 
-        with device_xml.disk(type=disk_type, device=disk_device):
-            # https://bugs.launchpad.net/ubuntu/+source/qemu-kvm/+bug/741887
-            device_xml.driver(type=disk_volume_format, cache="unsafe")
-            device_xml.source(file=disk_volume_path)
-            if disk_bus == 'usb':
-                device_xml.target(
-                    dev=disk_target_dev,
-                    bus=disk_bus,
-                    removable='on')
-                device_xml.readonly()
-            else:
-                device_xml.target(
-                    dev=disk_target_dev,
-                    bus=disk_bus)
-            device_xml.serial(disk_serial)
-            if disk_wwn:
-                device_xml.wwn(disk_wwn)
+        disk = sub_element(devices, 'disk',
+                           type=disk_type, device=disk_device)
+        # https://bugs.launchpad.net/ubuntu/+source/qemu-kvm/+bug/741887
+        sub_element(disk, 'driver', type=disk_volume_format, cache="unsafe")
+        sub_element(disk, 'source', file=disk_volume_path)
+        if disk_bus == 'usb':
+            sub_element(
+                disk, 'target',
+                dev=disk_target_dev,
+                bus=disk_bus,
+                removable='on')
+            sub_element(disk, 'readonly')
+        else:
+            sub_element(
+                disk, 'target',
+                dev=disk_target_dev,
+                bus=disk_bus)
+        sub_element(disk, 'serial', disk_serial)
+        if disk_wwn:
+            sub_element(disk, 'wwn', disk_wwn)
 
     @classmethod
-    def _build_interface_device(cls, device_xml, interface_type,
+    def _build_interface_device(cls, devices, interface_type,
                                 interface_mac_address, interface_network_name,
                                 interface_target_dev, interface_model,
                                 interface_filter):
         """Build xml for interface
 
-        :param device_xml: XMLBuilder
+        :param devices: devices element of the domain
+        :type devices: ET.Element
         """
 
-        with device_xml.interface(type=interface_type):
-            device_xml.mac(address=interface_mac_address)
-            device_xml.source(
-                network=interface_network_name)
-            if interface_target_dev is not None:
-                # NOTE(astudenov): libvirt allows to create inteface devides
-                # with the same name, but in this case
-                # there will be an error when such nodes are started together
-                device_xml.target(dev=interface_target_dev)
-            if interface_model is not None:
-                device_xml.model(type=interface_model)
-            if interface_filter is not None:
-                device_xml.filterref(filter=interface_filter)
+        interface = sub_element(devices, 'interface', type=interface_type)
+        sub_element(interface, 'mac', address=interface_mac_address)
+        sub_element(interface, 'source', network=interface_network_name)
+        if interface_target_dev is not None:
+            # NOTE(astudenov): libvirt allows to create inteface devides
+            # with the same name, but in this case
+            # there will be an error when such nodes are started together
+            sub_element(interface, 'target', dev=interface_target_dev)
+        if interface_model is not None:
+            sub_element(interface, 'model', type=interface_model)
+        if interface_filter is not None:
+            sub_element(interface, 'filterref', filter=interface_filter)
+
+    @classmethod
+    @logwrap
+    def build_network_dhcp_host_xml(cls, mac, ip, name):
+        """Generate DHCP host entry XML for virNetwork.update()
+
+        :type mac: String
+        :type ip: String
+        :type name: String
+           :rtype : String
+        """
+        host_xml = xmlgenerator.XMLGenerator('host', mac=mac, ip=ip,
+                                             name=name)
+        return str(host_xml)
 
     @classmethod
     @logwrap
@@ -235,101 +255,148 @@ class LibvirtXMLBuilder(object):
                 filter_xml.all()
         return str(filter_xml)
 
+    # Invariant parts of domain XML: {(fragment name, args): [ET.Element]}
+    _fragments = {}
+
+    @classmethod
+    def _get_fragment(cls, name, *args):
+        """Get cached elements built by _build_<name>_fragment(*args)
+
+        Cached elements are shared between domain XMLs, so they must not
+        be modified.
+
+        :rtype: list
+        """
+        key = (name, ) + args
+        if key not in cls._fragments:
+            build = getattr(cls, '_build_{}_fragment'.format(name))
+            cls._fragments[key] = build(*args)
+        return cls._fragments[key]
+
+    @staticmethod
+    def _build_features_fragment():
+        features = ET.Element('features')
+        sub_element(features, 'acpi')
+        return [features]
+
+    @staticmethod
+    def _build_clock_fragment(hpet):
+        clock = ET.Element('clock', offset='utc')
+        rtc_clock = ET.Element('clock')
+        rtc = sub_element(rtc_clock, 'timer', name='rtc',
+                          tickpolicy='catchup', track='wall')
+        sub_element(
+            rtc, 'catchup',
+            threshold='123',
+            slew='120',
+            limit='10000')
+        pit_clock = ET.Element('clock')
+        sub_element(
+            pit_clock, 'timer',
+            name='pit',
+            tickpolicy='delay')
+        hpet_clock = ET.Element('clock')
+        sub_element(
+            hpet_clock, 'timer',
+            name='hpet',
+            present='yes' if hpet else 'no')
+        return [clock, rtc_clock, pit_clock, hpet_clock]
+
+    @staticmethod
+    def _build_devices_head_fragment(emulator, has_vnc, vnc_password):
+        devices = ET.Element('devices')
+        sub_element(devices, 'controller', type='usb', model='nec-xhci')
+        sub_element(devices, 'emulator', emulator)
+        if has_vnc:
+            if vnc_password:
+                sub_element(
+                    devices, 'graphics',
+                    type='vnc',
+                    listen='0.0.0.0',
+                    autoport='yes',
+                    passwd=vnc_password)
+            else:
+                sub_element(
+                    devices, 'graphics',
+                    type='vnc',
+                    listen='0.0.0.0',
+                    autoport='yes')
+        return list(devices)
+
+    @staticmethod
+    def _build_devices_tail_fragment():
+        devices = ET.Element('devices')
+        video = sub_element(devices, 'video')
+        sub_element(video, 'model', type='vga', vram='9216', heads='1')
+        serial = sub_element(devices, 'serial', type='pty')
+        sub_element(serial, 'target', port='0')
+        console = sub_element(devices, 'console', type='pty')
+        sub_element(console, 'target', type='serial', port='0')
+        return list(devices)
+
     @classmethod
     @logwrap
     def build_node_xml(cls, name, hypervisor, use_host_cpu, vcpu, memory,
                        use_hugepages, hpet, os_type, architecture, boot,
                        reboot_timeout, bootmenu_timeout, emulator,
                        has_vnc, vnc_password, local_disk_devices, interfaces,
-                       acpi, numa):
+                       acpi, numa, pretty=True):
         """Generate node XML
 
+        Elements are created directly by ElementTree and parts which are
+        the same for all nodes of a driver are built only once.
+
+        :param pretty: indent XML, libvirt doesn't need it
         :rtype : String
         """
-        node_xml = xmlgenerator.XMLGenerator("domain", type=hypervisor)
-        node_xml.name(cls._crop_name(name))
+        node_xml = ET.Element('domain', type=hypervisor)
+        sub_element(node_xml, 'name', cls._crop_name(name))
 
         if acpi:
-            with node_xml.features:
-                # pylint: disable=pointless-statement
-                # noinspection PyStatementEffect
-                node_xml.acpi
-                # pylint: enable=pointless-statement
+            node_xml.extend(cls._get_fragment('features'))
 
         cpu_args = {}
         if use_host_cpu:
             cpu_args['mode'] = 'host-passthrough'
         if numa:
-            with node_xml.cpu(**cpu_args):
-                with node_xml.numa:
-                    for cell in numa:
-                        node_xml.cell(
-                            cpus=str(cell['cpus']),
-                            memory=str(cell['memory'] * 1024),
-                            unit='KiB',
-                        )
+            cpu = sub_element(node_xml, 'cpu', **cpu_args)
+            numa_xml = sub_element(cpu, 'numa')
+            for cell in numa:
+                sub_element(
+                    numa_xml, 'cell',
+                    cpus=str(cell['cpus']),
+                    memory=str(cell['memory'] * 1024),
+                    unit='KiB')
         elif cpu_args:
-            node_xml.cpu(**cpu_args)
-        node_xml.vcpu(str(vcpu))
-        node_xml.memory(str(memory * 1024), unit='KiB')
+            sub_element(node_xml, 'cpu', **cpu_args)
+        sub_element(node_xml, 'vcpu', str(vcpu))
+        sub_element(node_xml, 'memory', str(memory * 1024), unit='KiB')
 
         if use_hugepages:
-            with node_xml.memoryBacking:
-                # pylint: disable=pointless-statement
-                # noinspection PyStatementEffect
-                node_xml.hugepages
-                # pylint: enable=pointless-statement
-
-        node_xml.clock(offset='utc')
-        with node_xml.clock.timer(name='rtc',
-                                  tickpolicy='catchup', track='wall'):
-            node_xml.catchup(
-                threshold='123',
-                slew='120',
-                limit='10000')
-        node_xml.clock.timer(
-            name='pit',
-            tickpolicy='delay')
-        node_xml.clock.timer(
-            name='hpet',
-            present='yes' if hpet else 'no')
-
-        with node_xml.os:
-            node_xml.type(os_type, arch=architecture)
-            for boot_dev in boot:
-                node_xml.boot(dev=boot_dev)
-            if reboot_timeout:
-                node_xml.bios(rebootTimeout=str(reboot_timeout))
-            if bootmenu_timeout:
-                node_xml.bootmenu(enable='yes', timeout=str(bootmenu_timeout))
-
-        with node_xml.devices:
-            node_xml.controller(type='usb', model='nec-xhci')
-            node_xml.emulator(emulator)
-            if has_vnc:
-                if vnc_password:
-                    node_xml.graphics(
-                        type='vnc',
-                        listen='0.0.0.0',
-                        autoport='yes',
-                        passwd=vnc_password)
-                else:
-                    node_xml.graphics(
-                        type='vnc',
-                        listen='0.0.0.0',
-                        autoport='yes')
-
-            for disk_device in local_disk_devices:
-                cls._build_disk_device(node_xml, **disk_device)
-            for interface in interfaces:
-                cls._build_interface_device(node_xml, **interface)
-            with node_xml.video:
-                node_xml.model(type='vga', vram='9216', heads='1')
-            with node_xml.serial(type='pty'):
-                node_xml.target(port='0')
-            with node_xml.console(type='pty'):
-                node_xml.target(type='serial', port='0')
-        return str(node_xml)
+            memory_backing = sub_element(node_xml, 'memoryBacking')
+            sub_element(memory_backing, 'hugepages')
+
+        node_xml.extend(cls._get_fragment('clock', bool(hpet)))
+
+        os_xml = sub_element(node_xml, 'os')
+        sub_element(os_xml, 'type', os_type, arch=architecture)
+        for boot_dev in boot:
+            sub_element(os_xml, 'boot', dev=boot_dev)
+        if reboot_timeout:
+            sub_element(os_xml, 'bios', rebootTimeout=str(reboot_timeout))
+        if bootmenu_timeout:
+            sub_element(os_xml, 'bootmenu', enable='yes',
+                        timeout=str(bootmenu_timeout))
+
+        devices = sub_element(node_xml, 'devices')
+        devices.extend(cls._get_fragment(
+            'devices_head', emulator, bool(has_vnc), vnc_password))
+        for disk_device in local_disk_devices:
+            cls._build_disk_device(devices, **disk_device)
+        for interface in interfaces:
+            cls._build_interface_device(devices, **interface)
+        devices.extend(cls._get_fragment('devices_tail'))
+        return xmlgenerator.tostring(node_xml, pretty=pretty)
 
     @classmethod
     @logwrap
@@ -0,0 +1,216 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import division
+
+import collections
+import json
+import os
+
+from devops.helpers import loader
+
+
+GB = 1024 ** 3
+
+
+class Requirements(object):
+    """Resources required by nodes, volumes and networks of a template
+
+    Memory is in megabytes, disk usage is in bytes. `disk_thick` is
+    allocated right away (raw volumes and uploaded images), `disk_thin`
+    is what qcow2 volumes may grow up to in addition.
+    """
+
+    fields = ('nodes', 'vcpu', 'max_vcpu', 'memory', 'max_memory',
+              'hugepages', 'disk_thick', 'disk_thin', 'networks')
+
+    def __init__(self):
+        for name in self.fields:
+            setattr(self, name, 0)
+        # {(architecture, hypervisor), ...}
+        self.guests = set()
+        self.images = set()
+
+    def update(self, other):
+        for name in self.fields:
+            if name.startswith('max_'):
+                value = max(getattr(self, name), getattr(other, name))
+            else:
+                value = getattr(self, name) + getattr(other, name)
+            setattr(self, name, value)
+        self.guests |= other.guests
+        self.images |= other.images
+
+    def __str__(self):
+        return ('{0.nodes} nodes, {0.vcpu} vCPUs, {0.memory} MB memory '
+                '({0.hugepages} MB in hugepages), {1:.1f} GB thick and '
+                '{2:.1f} GB thin disk, {0.networks} networks'.format(
+                    self, self.disk_thick / GB, self.disk_thin / GB))
+
+
+class CapacityReport(object):
+    """Result of the capacity check of an environment template"""
+
+    def __init__(self):
+        # {group name: Requirements}
+        self.requirements = collections.OrderedDict()
+        self.errors = []
+        self.warnings = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    @property
+    def total(self):
+        total = Requirements()
+        for requirements in self.requirements.values():
+            total.update(requirements)
+        return total
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+    def __str__(self):
+        lines = ['Required: {}'.format(self.total)]
+        lines += ['ERROR: {}'.format(msg) for msg in self.errors]
+        lines += ['WARNING: {}'.format(msg) for msg in self.warnings]
+        return '\n'.join(lines)
+
+
+def _get_driver(driver_config):
+    """Create unsaved driver instance from template group driver section"""
+    name = driver_config['name']
+    if name == 'devops.driver.libvirt.libvirt_driver':
+        name = 'devops.driver.libvirt'
+    # noinspection PyPep8Naming
+    DriverCls = loader.load_class('{}:Driver'.format(name))
+    return DriverCls(name=name, **driver_config.get('params', {}))
+
+
+def _get_param(cls, params, name, default=None):
+    """Get value of template parameter or its default for the model class"""
+    if name in params:
+        return params[name]
+    return getattr(cls(params={}), name, default)
+
+
+def _add_volume(requirements, volume_cls, params, group_capacities,
+                use_image_cache, report):
+    capacity = (_get_param(volume_cls, params, 'capacity') or 0) * GB
+    vol_format = _get_param(volume_cls, params, 'format')
+    source_image = params.get('source_image')
+    if not capacity and params.get('backing_store'):
+        capacity = group_capacities.get(params['backing_store'], 0)
+
+    image_size = 0
+    if source_image:
+        if not os.path.isfile(source_image):
+            report.error('Source image {!r} does not exist'.format(
+                source_image))
+            return 0
+        image_size = os.path.getsize(source_image)
+        capacity = capacity or image_size
+        if not use_image_cache or source_image not in requirements.images:
+            requirements.disk_thick += image_size
+        requirements.images.add(source_image)
+
+    if vol_format == 'raw':
+        requirements.disk_thick += max(capacity - image_size, 0)
+    else:
+        requirements.disk_thin += max(capacity - image_size, 0)
+    return capacity
+
+
+def get_group_requirements(drv, group_config, report):
+    """Calculate resources required by a template group
+
+    :type drv: devops.models.Driver
+    :type group_config: dict
+    :type report: CapacityReport
+    :rtype: Requirements
+    """
+    requirements = Requirements()
+    node_cls = drv.get_model_class('Node')
+    volume_cls = drv.get_model_class('Volume')
+    use_hugepages = getattr(drv, 'use_hugepages', False)
+    use_image_cache = getattr(drv, 'use_image_cache', False)
+
+    requirements.networks = len(group_config.get('l2_network_devices') or {})
+
+    group_capacities = {}
+    for vol_params in group_config.get('group_volumes') or []:
+        group_capacities[vol_params['name']] = _add_volume(
+            requirements, volume_cls, vol_params, {}, use_image_cache,
+            report)
+
+    for node_config in group_config.get('nodes') or []:
+        params = node_config.get('params') or {}
+        vcpu = _get_param(node_cls, params, 'vcpu', 0)
+        memory = _get_param(node_cls, params, 'memory', 0)
+        requirements.nodes += 1
+        requirements.vcpu += vcpu
+        requirements.max_vcpu = max(requirements.max_vcpu, vcpu)
+        requirements.memory += memory
+        requirements.max_memory = max(requirements.max_memory, memory)
+        if use_hugepages:
+            requirements.hugepages += memory
+
+        architecture = _get_param(node_cls, params, 'architecture')
+        hypervisor = _get_param(node_cls, params, 'hypervisor')
+        if architecture and hypervisor:
+            requirements.guests.add((architecture, hypervisor))
+
+        for vol_params in params.get('volumes') or []:
+            _add_volume(requirements, volume_cls, vol_params,
+                        group_capacities, use_image_cache, report)
+
+    return requirements
+
+
+def plan_environment(full_config):
+    """Check if the host is able to run environment described by template
+
+    The template is read in one pass and resources of groups with the
+    same driver settings are summed up before the driver checks them
+    against the host, so no environment object is created and nothing
+    is sent to the hypervisor except a few informational requests.
+
+    :param full_config: environment template
+    :type full_config: dict
+    :rtype: CapacityReport
+    """
+    config = full_config['template']['devops_settings']
+    report = CapacityReport()
+
+    drivers = collections.OrderedDict()
+    for group_config in config.get('groups') or []:
+        driver_config = group_config['driver']
+        drv = _get_driver(driver_config)
+        key = json.dumps([drv.name, driver_config.get('params', {})],
+                         sort_keys=True)
+        group_requirements = get_group_requirements(
+            drv, group_config, report)
+        report.requirements[group_config['name']] = group_requirements
+
+        if key not in drivers:
+            drivers[key] = (drv, Requirements())
+        drivers[key][1].update(group_requirements)
+
+    for drv, requirements in drivers.values():
+        drv.check_capacity(requirements, report)
+    return report
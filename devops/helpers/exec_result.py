@@ -17,12 +17,13 @@ from __future__ import unicode_literals
 import json
 import threading
 
-import yaml
-
 from devops import error
+from devops.helpers import loader
 from devops.helpers import proc_enums
 from devops import logger
 
+yaml = loader.lazy_import('yaml')
+
 
 deprecated_aliases = {
     'stdout_str',
@@ -0,0 +1,158 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import absolute_import
+
+import fcntl
+import hashlib
+import json
+import mmap
+from multiprocessing import pool as mp_pool
+import os
+import threading
+
+from django.conf import settings
+
+from devops import logger
+
+
+def _stat_key(path):
+    """Get values which change when the file content is changed
+
+    :rtype: dict
+    """
+    stat = os.stat(path)
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 10 ** 9)
+    return {'inode': stat.st_ino, 'size': stat.st_size, 'mtime_ns': mtime_ns}
+
+
+def tree_hash(path, chunk_size=None, workers=None):
+    """Calculate SHA-256 tree hash of the file content
+
+    The file is memory mapped and split into chunks of `chunk_size`
+    bytes which are hashed in parallel threads (hashlib releases GIL).
+    The result is SHA-256 of concatenated digests of the chunks.
+
+    :type path: str
+    :rtype: str
+    """
+    chunk_size = chunk_size or settings.HASH_CHUNK_SIZE
+    workers = workers or settings.HASH_WORKERS
+    size = os.path.getsize(path)
+    if size == 0:
+        return hashlib.sha256().hexdigest()
+
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            def chunk_digest(offset):
+                return hashlib.sha256(
+                    data[offset:offset + chunk_size]).digest()
+
+            offsets = range(0, size, chunk_size)
+            if len(offsets) == 1:
+                digests = [chunk_digest(0)]
+            else:
+                workers_pool = mp_pool.ThreadPool(
+                    min(workers, len(offsets)))
+                try:
+                    digests = workers_pool.map(chunk_digest, offsets)
+                finally:
+                    workers_pool.close()
+                    workers_pool.join()
+        finally:
+            data.close()
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+class HashCache(object):
+    """Persistent cache of file digests
+
+    Digest is stored with inode, size and modification time of the file,
+    so checking if a known file was changed costs only a stat() call.
+
+    :param cache_path: path to JSON file with cached digests
+    """
+
+    def __init__(self, cache_path=None):
+        self._cache_path = cache_path
+        self._lock = threading.Lock()
+
+    @property
+    def cache_path(self):
+        return self._cache_path or settings.HASH_CACHE_PATH
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _store(self, path, record):
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with self._lock, open(self.cache_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                try:
+                    cache = json.loads(content) if content else {}
+                except ValueError:
+                    logger.warning('Hash cache {} is corrupted, '
+                                   'resetting it'.format(self.cache_path))
+                    cache = {}
+                cache[path] = record
+                f.seek(0)
+                f.truncate()
+                json.dump(cache, f, indent=2, sort_keys=True)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_digest(self, path):
+        """Get digest of file content, calculate it if file was changed
+
+        :type path: str
+        :rtype: str
+        """
+        path = os.path.realpath(path)
+        key = _stat_key(path)
+        record = self._load().get(path)
+        if record is not None and all(
+                record.get(name) == value for name, value in key.items()):
+            return record['digest']
+
+        logger.debug('Calculating digest of {}'.format(path))
+        record = dict(key, digest=tree_hash(path))
+        if _stat_key(path) != key:
+            # the file was changed while hashing, don't cache the digest
+            return record['digest']
+        self._store(path, record)
+        return record['digest']
+
+
+_hash_cache = HashCache()
+
+
+def get_file_digest(path):
+    """Get cached digest of file content
+
+    :type path: str
+    :rtype: str
+    """
+    return _hash_cache.get_digest(path)
@@ -14,6 +14,7 @@
 
 from __future__ import absolute_import
 
+import errno
 import functools
 import os
 import socket
@@ -32,6 +33,7 @@ from six.moves import xmlrpc_client
 # pylint: enable=import-error
 
 from devops import error
+from devops.helpers import instrumentation
 from devops.helpers import ssh_client
 from devops.helpers import subprocess_runner
 from devops import logger
@@ -97,22 +99,28 @@ def wait(predicate, interval=5, timeout=60, timeout_msg="Waiting timed out"):
     start_time = time.time()
     if not timeout:
         return predicate()
-    while not predicate():
-        if start_time + timeout < time.time():
-            msg = (
-                "{msg}\nWaited for pass {cmd}: {spent:0.3f} seconds."
-                "".format(
-                    msg=timeout_msg,
-                    cmd=predicate.func_name,
-                    spent=time.time() - start_time
-                ))
-            logger.debug(msg)
-            raise error.TimeoutError(timeout_msg)
-
-        seconds_to_sleep = max(
-            0,
-            min(interval, start_time + timeout - time.time()))
-        time.sleep(seconds_to_sleep)
+    predicate_name = getattr(predicate, '__name__', repr(predicate))
+    with instrumentation.span('wait.loop',
+                              predicate=predicate_name) as cur_span:
+        checks = 1
+        while not predicate():
+            if start_time + timeout < time.time():
+                msg = (
+                    "{msg}\nWaited for pass {cmd}: {spent:0.3f} seconds."
+                    "".format(
+                        msg=timeout_msg,
+                        cmd=predicate_name,
+                        spent=time.time() - start_time
+                    ))
+                logger.debug(msg)
+                raise error.TimeoutError(timeout_msg)
+
+            seconds_to_sleep = max(
+                0,
+                min(interval, start_time + timeout - time.time()))
+            time.sleep(seconds_to_sleep)
+            checks += 1
+        cur_span.attrs['checks'] = checks
 
     return timeout + start_time - time.time()
 
@@ -276,6 +284,52 @@ def get_file_size(path):
     return os.stat(path).st_size
 
 
+def get_file_allocation(path):
+    """Get number of bytes actually allocated on disk for a file
+
+    Is less than file size for sparse files.
+
+    :type path: str
+    :rtype : int
+    """
+
+    return os.stat(path).st_blocks * 512
+
+
+def open_shared_file(path):
+    """Open a file shared by processes of all users of the host
+
+    The file and its missing directory are created writable for everyone,
+    the directory gets the sticky bit like /tmp.
+
+    :type path: str
+    :rtype: file
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+            os.chmod(directory, 0o1777)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            fd = os.open(path, os.O_RDWR)
+        else:
+            # Mode of the created file is limited by umask
+            os.fchmod(fd, 0o666)
+    return os.fdopen(fd, 'r+')
+
+
 def xml_tostring(tree):
     """Converts ElementTree object to string
 
@@ -0,0 +1,667 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import atexit
+import binascii
+import collections
+import contextlib
+import functools
+import io
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core import exceptions
+import six
+
+from devops import logger
+
+HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+SNAPSHOT_CATEGORIES = ('env', 'group', 'node')
+
+
+def _category(name):
+    return name.split('.', 1)[0]
+
+
+def _new_id(size):
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+class Span(object):
+    """Timing of one operation
+
+    Spans opened inside another span of the same thread share its trace.
+
+    :param name: dotted name of the operation, e.g. 'node.revert.libvirt'
+    :param attrs: attributes of the operation, e.g. node name and role
+    """
+
+    def __init__(self, name, attrs, parent=None):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self.span_id = None
+        self.trace_id = None
+        self.parent_id = None
+        if parent is not None:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'error': self.error,
+            'attrs': self.attrs,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+        }
+
+    def __repr__(self):
+        return '{0}(name={1!r}, duration={2!r})'.format(
+            self.__class__.__name__, self.name, self.duration)
+
+
+class Exporter(object):
+    """Base class of exporters
+
+    :param categories: categories of spans and metrics to export, all if
+        None
+    """
+
+    def __init__(self, categories=None):
+        self.categories = categories
+
+    def accepts(self, category):
+        return self.categories is None or category in self.categories
+
+    def export(self, span):
+        """Export finished span
+
+        :type span: Span
+        """
+        pass
+
+    def export_metrics(self, metrics):
+        """Export current values of metrics, see get_metrics()
+
+        :type metrics: list
+        """
+        pass
+
+
+class InMemoryExporter(Exporter):
+    """Keep spans and metrics in lists, e.g. for tests or reports"""
+
+    def __init__(self, categories=None):
+        super(InMemoryExporter, self).__init__(categories=categories)
+        self.spans = []
+        self.metrics = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def export_metrics(self, metrics):
+        self.metrics.extend(metrics)
+
+
+class _FileExporter(Exporter):
+
+    def __init__(self, path, categories=None):
+        super(_FileExporter, self).__init__(categories=categories)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, records):
+        lines = u''.join(
+            u'{}\n'.format(json.dumps(record, sort_keys=True))
+            for record in records)
+        with self._lock:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with io.open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+
+class JsonLinesExporter(_FileExporter):
+    """Append spans and metrics to a file, one JSON object per line
+
+    Metrics have 'type': 'metric' key, spans don't have it.
+
+    :type path: str
+    """
+
+    def export(self, span):
+        self._write([span.to_dict()])
+
+    def export_metrics(self, metrics):
+        self._write(metrics)
+
+
+def _otlp_attributes(attrs):
+    result = []
+    for key, value in sorted(attrs.items()):
+        if isinstance(value, bool):
+            value = {'boolValue': value}
+        elif isinstance(value, six.integer_types):
+            value = {'intValue': str(value)}
+        elif isinstance(value, float):
+            value = {'doubleValue': value}
+        else:
+            value = {'stringValue': u'{}'.format(value)}
+        result.append({'key': key, 'value': value})
+    return result
+
+
+def _unix_nano(timestamp):
+    return str(int(timestamp * 1e9))
+
+
+class OtlpJsonExporter(_FileExporter):
+    """Append spans and metrics to a file in OpenTelemetry JSON format
+
+    Every line is an OTLP/JSON export request, the same as written by
+    the OpenTelemetry collector file exporter, so the file can be
+    replayed to any OpenTelemetry backend.
+
+    :type path: str
+    """
+
+    resource = {
+        'attributes': _otlp_attributes({'service.name': 'fuel-devops'}),
+    }
+    scope = {'name': 'devops'}
+
+    def export(self, span):
+        otlp_span = {
+            'traceId': span.trace_id or _new_id(16),
+            'spanId': span.span_id or _new_id(8),
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': _unix_nano(span.start),
+            'endTimeUnixNano': _unix_nano(span.start + span.duration),
+            'attributes': _otlp_attributes(span.attrs),
+            'status': ({'code': 2, 'message': span.error}
+                       if span.error else {'code': 0}),
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        self._write([{'resourceSpans': [{
+            'resource': self.resource,
+            'scopeSpans': [{'scope': self.scope, 'spans': [otlp_span]}],
+        }]}])
+
+    def export_metrics(self, metrics):
+        otlp_metrics = []
+        for metric in metrics:
+            point = {
+                'attributes': _otlp_attributes(metric['attrs']),
+                'startTimeUnixNano': _unix_nano(metric['start']),
+                'timeUnixNano': _unix_nano(metric['time']),
+            }
+            if metric['kind'] == 'counter':
+                if isinstance(metric['value'], six.integer_types):
+                    point['asInt'] = str(metric['value'])
+                else:
+                    point['asDouble'] = metric['value']
+                data = {'sum': {'dataPoints': [point],
+                                'aggregationTemporality': 2,
+                                'isMonotonic': True}}
+            else:
+                point.update(count=str(metric['count']),
+                             sum=metric['sum'],
+                             min=metric['min'],
+                             max=metric['max'],
+                             bucketCounts=[str(n) for n in metric['buckets']],
+                             explicitBounds=list(metric['bounds']))
+                data = {'histogram': {'dataPoints': [point],
+                                      'aggregationTemporality': 2}}
+            data['name'] = metric['name']
+            otlp_metrics.append(data)
+        if not otlp_metrics:
+            return
+        self._write([{'resourceMetrics': [{
+            'resource': self.resource,
+            'scopeMetrics': [{'scope': self.scope, 'metrics': otlp_metrics}],
+        }]}])
+
+
+EXPORTER_FORMATS = {
+    'jsonl': JsonLinesExporter,
+    'otlp': OtlpJsonExporter,
+}
+
+_exporters = []
+_configured = False
+_configure_lock = threading.RLock()
+_local = threading.local()
+
+
+def _configure():
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        try:
+            stats_file = settings.SNAPSHOT_STATS_FILE
+            instrumentation_file = settings.INSTRUMENTATION_FILE
+            exporter_cls = EXPORTER_FORMATS[settings.INSTRUMENTATION_FORMAT]
+            categories = settings.INSTRUMENTATION_CATEGORIES or None
+        except exceptions.ImproperlyConfigured:
+            # helpers are used without devops settings
+            _configured = True
+            return
+        if stats_file:
+            _exporters.append(JsonLinesExporter(
+                stats_file, categories=SNAPSHOT_CATEGORIES))
+        if instrumentation_file:
+            _exporters.append(exporter_cls(instrumentation_file,
+                                           categories=categories))
+        if _exporters:
+            atexit.register(flush)
+        _configured = True
+        if is_enabled('orm'):
+            install_orm_hook()
+
+
+def get_exporters():
+    """Get exporters of finished spans and metrics
+
+    Exporters configured in settings are added on the first call.
+
+    :rtype: list
+    """
+    if not _configured:
+        _configure()
+    return _exporters
+
+
+def add_exporter(exporter):
+    get_exporters().append(exporter)
+    if exporter.accepts('orm'):
+        install_orm_hook()
+
+
+def remove_exporter(exporter):
+    get_exporters().remove(exporter)
+
+
+def is_enabled(category=None):
+    """Check whether spans and metrics of the category are exported
+
+    Names of spans and metrics are dotted, the first component is the
+    category: 'libvirt', 'ssh', 'sftp', 'subprocess', 'orm' and 'wait' of
+    built-in hooks, 'env', 'group' and 'node' of snapshot operations.
+    Nothing is collected for categories which no exporter accepts.
+
+    :param category: any category if None
+    :rtype: bool
+    """
+    for exporter in get_exporters():
+        if category is None or exporter.accepts(category):
+            return True
+    return False
+
+
+def current_span():
+    """Innermost exported span of the thread
+
+    :rtype: Span or None
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Measure time spent in the block
+
+    Spans are measured always, so callers can use the duration, and are
+    passed to exporters only if there are any for the category. Errors
+    of exporters are logged and don't break the block.
+
+    :rtype: Span
+    """
+    category = _category(name)
+    if not is_enabled(category):
+        cur_span = Span(name, attrs)
+        try:
+            yield cur_span
+        finally:
+            cur_span.duration = time.time() - cur_span.start
+        return
+
+    cur_span = Span(name, attrs, parent=current_span())
+    cur_span.span_id = _new_id(8)
+    cur_span.trace_id = cur_span.trace_id or _new_id(16)
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(cur_span)
+    try:
+        yield cur_span
+    except BaseException as e:
+        cur_span.error = e.__class__.__name__
+        raise
+    finally:
+        cur_span.duration = time.time() - cur_span.start
+        _local.stack.pop()
+        for exporter in get_exporters():
+            if not exporter.accepts(category):
+                continue
+            try:
+                exporter.export(cur_span)
+            except Exception as e:
+                logger.warning('Unable to export span {0}: {1}'.format(
+                    name, e))
+
+
+def traced(name, get_attrs=None):
+    """Decorator: run function in a span
+
+    :param get_attrs: function which gets arguments of the decorated
+        function and returns attributes of the span, called only if the
+        span is exported
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            attrs = {}
+            if get_attrs is not None and is_enabled(_category(name)):
+                attrs = get_attrs(*args, **kwargs)
+            with span(name, **attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.start = time.time()
+        self.value = 0
+
+    def add(self, value):
+        self.value += value
+
+    def to_dict(self):
+        return {'value': self.value}
+
+
+class _Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self):
+        self.start = time.time()
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(HISTOGRAM_BOUNDS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min,
+                'max': self.max, 'buckets': list(self.buckets),
+                'bounds': list(HISTOGRAM_BOUNDS)}
+
+
+_metrics_lock = threading.Lock()
+# {(metric class, name, sorted attrs): _Counter or _Histogram}
+_metrics = collections.OrderedDict()
+
+
+def _record(metric_cls, name, value, attrs):
+    if not is_enabled(_category(name)):
+        return
+    key = (metric_cls, name, tuple(sorted(attrs.items())))
+    with _metrics_lock:
+        metric = _metrics.get(key)
+        if metric is None:
+            metric = _metrics[key] = metric_cls()
+        metric.add(value)
+
+
+def count(name, value=1, **attrs):
+    """Increase counter"""
+    _record(_Counter, name, value, attrs)
+
+
+def observe(name, value, **attrs):
+    """Add value, e.g. duration in seconds, to histogram"""
+    _record(_Histogram, name, value, attrs)
+
+
+def get_metrics():
+    """Get current values of metrics
+
+    :rtype: list
+    :returns: dicts with type, kind, name, attrs, start and time keys and
+        value of counters or count, sum, min, max, buckets and bounds of
+        histograms
+    """
+    now = time.time()
+    metrics = []
+    with _metrics_lock:
+        for (_, name, attrs), metric in _metrics.items():
+            record = {'type': 'metric', 'kind': metric.kind, 'name': name,
+                      'attrs': dict(attrs), 'start': metric.start,
+                      'time': now}
+            record.update(metric.to_dict())
+            metrics.append(record)
+    return metrics
+
+
+def flush():
+    """Pass metrics to exporters and start them over"""
+    metrics = get_metrics()
+    with _metrics_lock:
+        _metrics.clear()
+    if not metrics:
+        return
+    for exporter in get_exporters():
+        accepted = [metric for metric in metrics
+                    if exporter.accepts(_category(metric['name']))]
+        if not accepted:
+            continue
+        try:
+            exporter.export_metrics(accepted)
+        except Exception as e:
+            logger.warning('Unable to export metrics: {0}'.format(e))
+
+
+class InstrumentedProxy(object):
+    """Proxy which measures calls of public methods of an object
+
+    Every call is a span named '<category>.<class>.<method>' and is
+    counted in '<category>.calls' and '<category>.call.duration'
+    metrics. Results of calls which are objects of wrapped_modules are
+    wrapped too, so calls of objects returned by the connection (domains,
+    pools and so on) are measured as well.
+
+    :param obj: object to wrap
+    :param category: category of spans and metrics, e.g. 'libvirt'
+    :param wrapped_modules: modules of classes which results are wrapped
+    """
+
+    def __init__(self, obj, category, wrapped_modules=()):
+        self._obj = obj
+        self._category = category
+        self._wrapped_modules = wrapped_modules
+
+    def _wrap(self, result):
+        if isinstance(result, list):
+            return [self._wrap(item) for item in result]
+        if type(result).__module__ in self._wrapped_modules:
+            return self.__class__(result, self._category,
+                                  self._wrapped_modules)
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        method = '{0}.{1}'.format(type(self._obj).__name__, name)
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            args = [_unwrap(arg) for arg in args]
+            kwargs = {key: _unwrap(value) for key, value in kwargs.items()}
+            with span('{0}.{1}'.format(self._category, method)) as cur_span:
+                result = attr(*args, **kwargs)
+            count('{0}.calls'.format(self._category), method=method)
+            observe('{0}.call.duration'.format(self._category),
+                    cur_span.duration, method=method)
+            return self._wrap(result)
+        return call
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self._obj)
+
+
+def _unwrap(obj):
+    if isinstance(obj, InstrumentedProxy):
+        return obj._obj
+    return obj
+
+
+def instrument(obj, category, wrapped_modules=()):
+    """Wrap object to measure its calls if the category is exported
+
+    :returns: InstrumentedProxy or the object itself
+    """
+    if not is_enabled(category):
+        return obj
+    return InstrumentedProxy(obj, category, wrapped_modules)
+
+
+class _CountingCursor(object):
+    """Cursor wrapper which counts and measures ORM queries"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def _measure(self, func, *args):
+        if not is_enabled('orm'):
+            return func(*args)
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            count('orm.queries')
+            observe('orm.query.duration', time.time() - start)
+
+    def execute(self, sql, params=None):
+        return self._measure(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._measure(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.__exit__(exc_type, exc_value, traceback)
+
+
+def _instrument_connection(connection, **kwargs):
+    if getattr(connection, '_instrumented', False):
+        return
+    connection._instrumented = True
+    make_cursor = connection.make_cursor
+    make_debug_cursor = connection.make_debug_cursor
+    connection.make_cursor = lambda cursor: _CountingCursor(
+        make_cursor(cursor))
+    connection.make_debug_cursor = lambda cursor: _CountingCursor(
+        make_debug_cursor(cursor))
+
+
+_orm_hook_installed = False
+
+
+def install_orm_hook():
+    """Count queries of all database connections in 'orm' metrics"""
+    global _orm_hook_installed
+    with _configure_lock:
+        if _orm_hook_installed:
+            return
+        _orm_hook_installed = True
+
+        from django.db.backends import signals
+        from django.db import connections
+
+        signals.connection_created.connect(_instrument_connection)
+        for connection in connections.all():
+            _instrument_connection(connection)
+
+
+def read_spans(path):
+    """Read spans exported by JsonLinesExporter
+
+    Broken lines, e.g. of a file which is being written, are skipped.
+
+    :rtype: generator
+    :returns: dicts of spans
+    """
+    if not os.path.exists(path):
+        return
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('type') != 'metric':
+                yield record
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile
+
+    :type values: list
+    :param pct: percent, 0 - 100
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
@@ -13,6 +13,8 @@
 #    under the License.
 
 import importlib
+import sys
+import types
 
 
 def load_class(path):
@@ -23,3 +25,40 @@ def load_class(path):
 
 def get_class_path(obj):
     return obj.__module__ + ':' + obj.__class__.__name__
+
+
+class LazyModule(types.ModuleType):
+    """Module which is imported on the first access to its attributes
+
+    Used for heavy dependencies (paramiko, keystoneauth1, yaml, ...) which
+    are not needed by most of dos.py subcommands. The real module is
+    remembered after the first access, and attributes missing in the
+    placeholder are looked up in it, so both can be patched as usual.
+    """
+
+    def _load(self):
+        module = self.__dict__.get('_lazy_module')
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self.__name__)
+
+
+def lazy_import(name):
+    """Get module by name without importing it until it is used
+
+    :type name: str
+    :rtype: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -11,7 +11,9 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
-import netaddr
+from devops.helpers import loader
+
+netaddr = loader.lazy_import('netaddr')
 
 
 class IpNetworksPool(object):
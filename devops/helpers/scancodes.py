@@ -12,6 +12,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import re
+import threading
+
 # Based on http://www.win.tue.nl/~aeb/linux/kbd/scancodes-1.html
 # Scancodes < 0x80 - key presses, > 0x80 - key releases
 SCANCODES = {
@@ -149,7 +153,13 @@ SPECIALS = {
     '<F12>': 0x58
 }
 
-__all__ = ['from_string']
+# Max number of keys pressed by one virDomainSendKey() call
+# (VIR_DOMAIN_SEND_KEY_MAX_KEYS)
+MAX_KEYS = 16
+
+SHIFT = 0x2a
+
+__all__ = ['from_string', 'to_batches', 'batches_from_string']
 
 
 def iterable(a):
@@ -158,26 +168,131 @@ def iterable(a):
     return a if isinstance(a, (tuple, list)) else (a,)
 
 
+class Translator(object):
+    """Translator of strings into scancodes with a precompiled table
+
+    Codes of all keys are converted to tuples once, the string is split
+    into characters and <Special> keys by one regular expression, and
+    results for `cache_size` least recently used strings are kept, as the
+    same commands are typed again and again. Caching is disabled if
+    `cache_size` is 0.
+    """
+
+    # <Special> key, or any other character
+    TOKEN_RE = re.compile(r'<[^>]*>|.', re.DOTALL)
+
+    def __init__(self, scancodes=None, specials=None, cache_size=128):
+        self.table = {}
+        for key, codes in (scancodes or SCANCODES).items():
+            self.table[key] = tuple(iterable(codes))
+        for key, codes in (specials or SPECIALS).items():
+            self.table[key] = tuple(iterable(codes))
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, key, func, *args):
+        if self.cache_size <= 0:
+            return func(*args)
+        with self._lock:
+            if key in self._cache:
+                # move to the end as the most recently used
+                result = self._cache.pop(key)
+                self._cache[key] = result
+                return result
+        result = func(*args)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _translate(self, s):
+        get = self.table.get
+        return tuple(codes for codes in map(get, self.TOKEN_RE.findall(s))
+                     if codes)
+
+    def translate(self, s):
+        """Get scancodes of keys in the string
+
+        :rtype: tuple
+        """
+        return self._cached(('codes', s), self._translate, s)
+
+    def batches(self, s, max_keys=MAX_KEYS):
+        """Get scancodes of keys in the string packed by to_batches()
+
+        :rtype: tuple
+        """
+        return self._cached(('batches', s, max_keys), self._batches,
+                            s, max_keys)
+
+    def _batches(self, s, max_keys):
+        return tuple(to_batches(self.translate(s), max_keys=max_keys))
+
+
 def from_string(s):
     """from_string(s) - Convert string of chars into string of scancodes."""
 
-    scancodes = []
+    return list(translator.translate(s))
+
+
+def batches_from_string(s, max_keys=MAX_KEYS):
+    """Convert string of chars into batches of scancodes ready to be sent
+
+    See to_batches().
+    """
+
+    return translator.batches(s, max_keys=max_keys)
+
+
+def _is_plain(codes):
+    return (len(codes) == 1 and isinstance(codes[0], int) and
+            codes[0] != SHIFT)
+
+
+def _is_shifted(codes):
+    return (len(codes) == 2 and codes[0] == SHIFT and
+            isinstance(codes[1], int) and codes[1] != SHIFT)
+
+
+def to_batches(scancodes, max_keys=MAX_KEYS):
+    """to_batches(scancodes) - Pack scancodes into keys pressed together.
+
+    Keys of a batch are pressed one by one in the given order and released
+    together, so the guest gets the same characters as if they were typed
+    separately. A batch never contains the same key twice, and once shift
+    is pressed in a batch, only shifted keys follow it. Other key
+    combinations and ('wait', ) are never packed with other keys.
+    """
 
-    while len(s) > 0:
-        if s[0] == '<' and s.find('>') > 0:
-            special_end = s.find('>') + 1
-            special = s[0:special_end]
-            s = s[special_end:]
+    batches = []
+    batch = None
+    for codes in scancodes:
+        if batch is not None and len(batch) < max_keys:
+            if _is_plain(codes) and SHIFT not in batch:
+                if codes[0] not in batch:
+                    batch.append(codes[0])
+                    continue
+            elif _is_shifted(codes) and (SHIFT in batch or
+                                         len(batch) + 1 < max_keys):
+                if codes[1] not in batch:
+                    if SHIFT not in batch:
+                        batch.append(SHIFT)
+                    batch.append(codes[1])
+                    continue
 
-            codes = SPECIALS.get(special)
+        if batch is not None:
+            batches.append(tuple(batch))
+            batch = None
+        if _is_plain(codes) or _is_shifted(codes):
+            batch = list(codes)
         else:
-            key = s[0]
-            s = s[1:]
+            batches.append(codes)
 
-            codes = SCANCODES.get(key)
+    if batch is not None:
+        batches.append(tuple(batch))
+    return batches
 
-        codes = iterable(codes)
-        if len(codes) > 0:
-            scancodes.append(codes)
 
-    return scancodes
+translator = Translator()
@@ -24,15 +24,18 @@ import threading
 import time
 import warnings
 
-import paramiko
 import six
 
 from devops import error
 from devops.helpers import decorators
 from devops.helpers import exec_result
+from devops.helpers import instrumentation
+from devops.helpers import loader
 from devops.helpers import proc_enums
 from devops import logger
 
+paramiko = loader.lazy_import('paramiko')
+
 
 class SSHAuth(object):
     __slots__ = ['__username', '__password', '__key', '__keys']
@@ -493,14 +496,18 @@ class SSHClient(six.with_metaclass(_MemorizedSSH, object)):
         """
         return self.__ssh
 
-    @decorators.retry(paramiko.SSHException, count=3, delay=3)
     def __connect(self):
         """Main method for connection open"""
-        with self.lock:
-            self.auth.connect(
-                client=self.__ssh,
-                hostname=self.hostname, port=self.port,
-                log=True)
+        # decorated here, so paramiko is not imported with the module
+        @decorators.retry(paramiko.SSHException, count=3, delay=3)
+        def connect():
+            with self.lock:
+                self.auth.connect(
+                    client=self.__ssh,
+                    hostname=self.hostname, port=self.port,
+                    log=True)
+
+        connect()
 
     def __connect_sftp(self):
         """SFTP connection opener"""
@@ -833,12 +840,15 @@ class SSHClient(six.with_metaclass(_MemorizedSSH, object)):
         :rtype: ExecResult
         :raises: TimeoutError
         """
-        chan, _, stderr, stdout = self.execute_async(command, **kwargs)
+        with instrumentation.span('ssh.execute',
+                                  host=self.hostname) as cur_span:
+            chan, _, stderr, stdout = self.execute_async(command, **kwargs)
 
-        result = self.__exec_command(
-            command, chan, stdout, stderr, timeout,
-            verbose=verbose
-        )
+            result = self.__exec_command(
+                command, chan, stdout, stderr, timeout,
+                verbose=verbose
+            )
+            cur_span.attrs['exit_code'] = int(result.exit_code)
 
         if verbose:
             print(
@@ -995,6 +1005,9 @@ class SSHClient(six.with_metaclass(_MemorizedSSH, object)):
         """
         return self._sftp.open(path, mode)
 
+    @instrumentation.traced(
+        'sftp.upload',
+        lambda self, source, target: {'host': self.hostname})
     def upload(self, source, target):
         """Upload file(s) from source to target using SFTP session
 
@@ -1008,7 +1021,9 @@ class SSHClient(six.with_metaclass(_MemorizedSSH, object)):
 
         source = os.path.expanduser(source)
         if not os.path.isdir(source):
-            self._sftp.put(source, target)
+            attrs = self._sftp.put(source, target)
+            instrumentation.count('sftp.bytes', attrs.st_size,
+                                  direction='upload')
             return
 
         for rootdir, _, files in os.walk(source):
@@ -1024,8 +1039,13 @@ class SSHClient(six.with_metaclass(_MemorizedSSH, object)):
                 remote_path = posixpath.join(targetdir, entry)
                 if self.exists(remote_path):
                     self._sftp.unlink(remote_path)
-                self._sftp.put(local_path, remote_path)
+                attrs = self._sftp.put(local_path, remote_path)
+                instrumentation.count('sftp.bytes', attrs.st_size,
+                                      direction='upload')
 
+    @instrumentation.traced(
+        'sftp.download',
+        lambda self, destination, target: {'host': self.hostname})
     def download(self, destination, target):
         """Download file(s) to target from destination
 
@@ -1044,6 +1064,10 @@ class SSHClient(six.with_metaclass(_MemorizedSSH, object)):
         if not self.isdir(destination):
             if self.exists(destination):
                 self._sftp.get(destination, target)
+                if instrumentation.is_enabled('sftp'):
+                    instrumentation.count(
+                        'sftp.bytes', os.path.getsize(target),
+                        direction='download')
             else:
                 logger.debug(
                     "Can't download %s because it doesn't exist", destination
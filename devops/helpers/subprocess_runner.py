@@ -27,6 +27,7 @@ import six
 from devops import error
 from devops.helpers import decorators
 from devops.helpers import exec_result
+from devops.helpers import instrumentation
 from devops.helpers import metaclasses
 from devops.helpers import proc_enums
 from devops import logger
@@ -190,8 +191,10 @@ class Subprocess(six.with_metaclass(metaclasses.SingletonMeta, object)):
         :raises: TimeoutError
         """
         logger.debug("Executing command: {!r}".format(command.rstrip()))
-        result = cls.__exec_command(command=command, timeout=timeout,
-                                    verbose=verbose, **kwargs)
+        with instrumentation.span('subprocess.execute') as cur_span:
+            result = cls.__exec_command(command=command, timeout=timeout,
+                                        verbose=verbose, **kwargs)
+            cur_span.attrs['exit_code'] = int(result.exit_code)
         if verbose:
             print(
                 '\n{cmd!r} execution results: Exit code: {code!s}'.format(
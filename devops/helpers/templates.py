@@ -17,10 +17,11 @@ from __future__ import division
 import collections
 import os
 
-import netaddr
-import yaml
-
 from devops import error
+from devops.helpers import loader
+
+netaddr = loader.lazy_import('netaddr')
+yaml = loader.lazy_import('yaml')
 
 
 def yaml_template_load(config_file):
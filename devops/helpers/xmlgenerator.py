@@ -12,13 +12,77 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from xml.dom import minidom
 # noinspection PyPep8Naming
 from xml.etree import ElementTree as ET
 
 import six
 
 
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+
+
+def _escape(data):
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '"', '&quot;').replace('>', '&gt;')
+
+
+def _serialize(elem, parts, indent, level, newl):
+    pad = indent * level
+    attrs = ''.join(' {0}="{1}"'.format(key, _escape(value))
+                    for key, value in sorted(elem.items()))
+    if not len(elem):
+        if elem.text:
+            parts.append('{0}<{1}{2}>{3}</{1}>{4}'.format(
+                pad, elem.tag, attrs, _escape(elem.text), newl))
+        else:
+            parts.append('{0}<{1}{2}/>{3}'.format(pad, elem.tag, attrs, newl))
+        return
+
+    parts.append('{0}<{1}{2}>{3}'.format(pad, elem.tag, attrs, newl))
+    if elem.text:
+        parts.append(pad + indent + _escape(elem.text) + newl)
+    for child in elem:
+        _serialize(child, parts, indent, level + 1, newl)
+        if child.tail:
+            parts.append(pad + indent + _escape(child.tail) + newl)
+    parts.append('{0}</{1}>{2}'.format(pad, elem.tag, newl))
+
+
+def tostring(elem, pretty=True):
+    """Serialize element with XML declaration
+
+    Pretty printed output is the same as of minidom toprettyxml() with
+    4 spaces indentation, but the tree is not parsed again.
+
+    :type elem: ET.Element
+    :param pretty: put every element on a separate indented line
+    :rtype: str
+    """
+    if pretty:
+        parts = [XML_DECLARATION, '\n']
+        _serialize(elem, parts, '    ', 0, '\n')
+    else:
+        parts = [XML_DECLARATION]
+        _serialize(elem, parts, '', 0, '')
+    result = ''.join(parts)
+    if six.PY2 and isinstance(result, six.text_type):
+        return result.encode('utf-8')
+    return result
+
+
+def sub_element(parent, tag, text=None, **attrib):
+    """Add child element, values of attributes are converted to strings
+
+    :type parent: ET.Element
+    :rtype: ET.Element
+    """
+    elem = ET.SubElement(
+        parent, tag, {k: str(v) for k, v in attrib.items()})
+    if text:
+        elem.text = str(text)
+    return elem
+
+
 class XMLGeneratorElement(object):
 
     def __init__(self, name, parent, builder):
@@ -68,11 +132,8 @@ class XMLGenerator(object):
             parent=self.curr_el,
             builder=self)
 
+    def to_string(self, pretty=True):
+        return tostring(self.root, pretty=pretty)
+
     def __str__(self):
-        rough_string = ET.tostring(self.root, encoding='utf-8')
-        reparsed = minidom.parseString(rough_string)
-        s = reparsed.toprettyxml(indent='    ', encoding='utf-8')
-        if six.PY2:
-            return s
-        else:
-            return str(s, encoding='utf-8')
+        return self.to_string()
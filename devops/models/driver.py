@@ -12,12 +12,42 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+
 from django.db import models
 
 from devops.helpers import loader
 from devops.models import base
 
 
+class NodeState(object):
+    """State of a node reported by the driver
+
+    :param active: True if the node is running or paused
+    :param paused: True if the node is paused
+    """
+
+    def __init__(self, active, paused=False):
+        self.active = active
+        self.paused = paused
+
+    @property
+    def status(self):
+        """Human readable state name
+
+        :rtype: str
+        """
+        if self.paused:
+            return 'paused'
+        if self.active:
+            return 'running'
+        return 'shutoff'
+
+    def __repr__(self):
+        return '{0}(status={1!r})'.format(self.__class__.__name__,
+                                          self.status)
+
+
 class Driver(base.ParamedModel, base.BaseModel):
 
     class Meta(object):
@@ -41,3 +71,155 @@ class Driver(base.ParamedModel, base.BaseModel):
 
     def get_allocated_networks(self):
         return []
+
+    def define_networks(self, l2_network_devices):
+        """Define L2 network devices of the driver
+
+        :type l2_network_devices: list
+        """
+        for l2_network_device in l2_network_devices:
+            l2_network_device.define()
+
+    def add_dhcp_hosts(self, interfaces):
+        """Add DHCP host entries of interfaces to defined networks
+
+        Called when addresses are assigned to interfaces, so drivers can
+        update networks which are already defined. Drivers which don't
+        serve DHCP don't do anything.
+
+        :type interfaces: list
+        """
+        pass
+
+    @contextlib.contextmanager
+    def dhcp_hosts_batch(self):
+        """Add DHCP host entries of the block at once when it is left"""
+        yield
+
+    def set_blocked(self, items, blocked, missing_ok=False):
+        """Block or unblock traffic of interfaces and L2 network devices
+
+        Default implementation blocks every item separately. Drivers
+        that are able to change several items at once should override
+        this method.
+
+        :param items: interfaces and L2 network devices of the driver
+        :type blocked: bool
+        :param missing_ok: skip items which can't be blocked by the driver
+        """
+        for item in items:
+            if blocked:
+                item.block()
+            else:
+                item.unblock()
+
+    def define_volumes(self, volumes):
+        """Define volumes of the driver
+
+        :type volumes: list
+        """
+        for vol in volumes:
+            vol.define()
+
+    def define_nodes_volumes(self, nodes):
+        """Define volumes of nodes
+
+        Yields every node as soon as all its volumes are defined, so the
+        node can be defined while volumes of other nodes are in progress.
+
+        :type nodes: list
+        :rtype: generator
+        """
+        for nod in nodes:
+            self.define_volumes(nod.get_volumes())
+            yield nod
+
+    def check_capacity(self, requirements, report):
+        """Check if the driver is able to provide required resources
+
+        Called before the environment is created. Problems are added to
+        the report by report.error() or report.warning(). Drivers which
+        don't know their capacity don't report anything.
+
+        :type requirements: devops.helpers.capacity.Requirements
+        :type report: devops.helpers.capacity.CapacityReport
+        """
+        pass
+
+    def get_nodes_state(self, nodes):
+        """Get state of several nodes of the driver
+
+        Default implementation asks every node separately. Drivers that
+        are able to get the state of all their nodes in one call should
+        override this method.
+
+        :type nodes: list
+        :rtype: dict
+        :returns: {node name: NodeState}
+        """
+        return {nod.name: NodeState(active=nod.is_active()) for nod in nodes}
+
+    def sample_nodes_stats(self, nodes):
+        """Take the first sample to measure resource usage rates from
+
+        Drivers which measure rates between two samples take the first one
+        here, so nodes of several drivers can be measured over one
+        interval.
+
+        :type nodes: list
+        :rtype: int
+        :returns: seconds to wait before get_nodes_stats(), 0 if the rates
+            are available right away
+        """
+        return 0
+
+    def get_nodes_stats(self, nodes):
+        """Get resource usage rates of several nodes of the driver
+
+        Call sample_nodes_stats() and wait as long as it returns first.
+        Drivers which can't report resource usage return None for
+        every node.
+
+        :type nodes: list
+        :rtype: dict
+        :returns: {node name: rates or None}
+        """
+        return {nod.name: None for nod in nodes}
+
+    def get_nodes_vnc_ports(self, nodes):
+        """Get VNC ports of several nodes of the driver
+
+        Default implementation asks every node separately.
+
+        :type nodes: list
+        :rtype: dict
+        :returns: {node name: VNC port or None}
+        """
+        return {nod.name: nod.get_vnc_port() for nod in nodes}
+
+    def snapshot_nodes(self, nodes, name, description=None, force=False,
+                       external=False):
+        """Snapshot several nodes of the driver
+
+        Default implementation snapshots nodes one by one.
+
+        :type nodes: list
+        """
+        for nod in nodes:
+            nod.snapshot(name=name, description=description, force=force,
+                         external=external)
+
+    def revert_nodes(self, nodes, name, resume=True, paused=False):
+        """Revert several nodes of the driver to snapshot
+
+        Default implementation reverts all nodes and then resumes them.
+
+        :type nodes: list
+        :param paused: leave nodes paused when they are not resumed, if
+            the driver is able to
+        """
+        for nod in nodes:
+            nod.revert(name)
+        if resume:
+            for nod in nodes:
+                nod.resume()
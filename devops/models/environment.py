@@ -18,10 +18,10 @@ import warnings
 from django.conf import settings
 from django.db import IntegrityError
 from django.db import models
-import netaddr
-import paramiko
 
 from devops import error
+from devops.helpers import instrumentation
+from devops.helpers import loader
 from devops.helpers import network as network_helpers
 from devops.helpers import ssh_client
 from devops import logger
@@ -31,6 +31,9 @@ from devops.models import group
 from devops.models import network
 from devops.models import node
 
+netaddr = loader.lazy_import('netaddr')
+paramiko = loader.lazy_import('paramiko')
+
 
 class Environment(base.BaseModel):
     class Meta(object):
@@ -207,12 +210,59 @@ class Environment(base.BaseModel):
         self.delete()
 
     def suspend(self, **kwargs):
-        for nod in self.get_nodes():
-            nod.suspend()
+        for grp in self.get_groups():
+            grp.suspend_nodes()
 
     def resume(self, **kwargs):
-        for nod in self.get_nodes():
-            nod.resume()
+        for grp in self.get_groups():
+            grp.resume_nodes()
+
+    def get_nodes_state(self):
+        """Get state of all environment nodes, one driver request per group
+
+        :rtype: list
+        :returns: [(Node, NodeState), ...]
+        """
+        nodes_state = []
+        for grp in self.get_groups():
+            nodes_state += grp.get_nodes_state()
+        return nodes_state
+
+    def get_active_nodes(self):
+        return [nod for nod, state in self.get_nodes_state() if state.active]
+
+    def get_nodes_stats(self, interval=None):
+        """Get resource usage rates of all environment nodes
+
+        Rates of nodes of all groups are measured over the same interval.
+
+        :param interval: seconds to measure the rates over, default
+            interval of the drivers if None
+        :rtype: list
+        :returns: [(Node, rates or None), ...]
+        """
+        groups = [(grp, list(grp.get_nodes())) for grp in self.get_groups()]
+        wait = max([grp.driver.sample_nodes_stats(nodes)
+                    for grp, nodes in groups] or [0])
+        if wait:
+            time.sleep(interval or wait)
+
+        nodes_stats = []
+        for grp, nodes in groups:
+            stats = grp.driver.get_nodes_stats(nodes)
+            nodes_stats += [(nod, stats[nod.name]) for nod in nodes]
+        return nodes_stats
+
+    def get_nodes_vnc_ports(self):
+        """Get VNC ports of all environment nodes, one request per group
+
+        :rtype: list
+        :returns: [(Node, VNC port or None), ...]
+        """
+        vnc_ports = []
+        for grp in self.get_groups():
+            vnc_ports += grp.get_nodes_vnc_ports()
+        return vnc_ports
 
     def snapshot(self, name=None, description=None, force=False, suspend=True):
         """Snapshot the environment
@@ -229,13 +279,17 @@ class Environment(base.BaseModel):
             raise error.DevopsError(
                 'Snapshot with name {0} already exists.'.format(
                     self.params.snapshot_name))
-        if suspend:
-            for nod in self.get_nodes():
-                nod.suspend()
-
-        for nod in self.get_nodes():
-            nod.snapshot(name=name, description=description, force=force,
-                         external=settings.SNAPSHOTS_EXTERNAL)
+        with instrumentation.span('env.snapshot', env=self.name,
+                                  snapshot=name):
+            if suspend:
+                with instrumentation.span('env.snapshot.suspend',
+                                          env=self.name, snapshot=name):
+                    self.suspend()
+
+            for grp in self.get_groups():
+                grp.snapshot_nodes(name=name, description=description,
+                                   force=force,
+                                   external=settings.SNAPSHOTS_EXTERNAL)
 
     def revert(self, name=None, flag=True, resume=True):
         """Revert the environment from snapshot
@@ -247,16 +301,18 @@ class Environment(base.BaseModel):
         if flag and not self.has_snapshot(name):
             raise Exception("some nodes miss snapshot,"
                             " test should be interrupted")
-        for nod in self.get_nodes():
-            nod.revert(name)
-
-        for grp in self.get_groups():
-            for l2netdev in grp.get_l2_network_devices():
-                l2netdev.unblock()
-
-        if resume:
-            for nod in self.get_nodes():
-                nod.resume()
+        groups = list(self.get_groups())
+        # All nodes are reverted paused before any of them is resumed,
+        # drivers do it for nodes of one group
+        resume_groups = resume and len(groups) == 1
+        with instrumentation.span('env.revert', env=self.name,
+                                  snapshot=name):
+            for grp in groups:
+                grp.driver.set_blocked(grp.get_l2_network_devices(),
+                                       blocked=False)
+                grp.revert_nodes(name, resume=resume_groups, paused=resume)
+            if resume and not resume_groups:
+                self.resume()
 
     # NOTE: Does not work
     # TO REWRITE FOR LIBVIRT DRIVER ONLY
@@ -13,6 +13,7 @@
 #    under the License.
 
 import copy
+import time
 
 from django.db import models
 
@@ -88,17 +89,14 @@ class Group(base.BaseModel):
         return all(n.has_snapshot(name) for n in self.get_nodes())
 
     def define_volumes(self):
-        for vol in self.get_volumes():
-            vol.define()
+        self.driver.define_volumes(self.get_volumes())
 
     def define_networks(self):
-        for l2_network_device in self.get_l2_network_devices():
-            l2_network_device.define()
+        self.driver.define_networks(
+            self.get_l2_network_devices().select_related('address_pool'))
 
     def define_nodes(self):
-        for nod in self.get_nodes():
-            for vol in nod.get_volumes():
-                vol.define()
+        for nod in self.driver.define_nodes_volumes(self.get_nodes()):
             nod.define()
 
     def start_networks(self):
@@ -115,6 +113,71 @@ class Group(base.BaseModel):
         for nod in self.get_nodes():
             nod.destroy()
 
+    def get_nodes_state(self, nodes=None):
+        """Get state of group nodes with a single driver request
+
+        :rtype: list
+        :returns: [(Node, NodeState), ...]
+        """
+        if nodes is None:
+            nodes = self.get_nodes()
+        nodes = list(nodes)
+        states = self.driver.get_nodes_state(nodes)
+        return [(nod, states[nod.name]) for nod in nodes]
+
+    def get_active_nodes(self):
+        return [nod for nod, state in self.get_nodes_state() if state.active]
+
+    def get_nodes_stats(self, nodes=None, interval=None):
+        """Get resource usage rates of group nodes
+
+        :rtype: list
+        :returns: [(Node, rates or None), ...]
+        """
+        if nodes is None:
+            nodes = self.get_nodes()
+        nodes = list(nodes)
+        wait = self.driver.sample_nodes_stats(nodes)
+        if wait:
+            time.sleep(interval or wait)
+        stats = self.driver.get_nodes_stats(nodes)
+        return [(nod, stats[nod.name]) for nod in nodes]
+
+    def get_nodes_vnc_ports(self, nodes=None):
+        """Get VNC ports of group nodes with a single driver request
+
+        :rtype: list
+        :returns: [(Node, VNC port or None), ...]
+        """
+        if nodes is None:
+            nodes = self.get_nodes()
+        nodes = list(nodes)
+        ports = self.driver.get_nodes_vnc_ports(nodes)
+        return [(nod, ports[nod.name]) for nod in nodes]
+
+    def suspend_nodes(self, nodes=None):
+        for nod, state in self.get_nodes_state(nodes):
+            nod.suspend(state=state)
+
+    def resume_nodes(self, nodes=None):
+        for nod, state in self.get_nodes_state(nodes):
+            nod.resume(state=state)
+
+    def snapshot_nodes(self, name, nodes=None, description=None,
+                       force=False, external=False):
+        """Snapshot group nodes, concurrently if the driver is able to"""
+        if nodes is None:
+            nodes = self.get_nodes()
+        self.driver.snapshot_nodes(nodes, name, description=description,
+                                   force=force, external=external)
+
+    def revert_nodes(self, name, nodes=None, resume=True, paused=False):
+        """Revert group nodes to snapshot and resume them if required"""
+        if nodes is None:
+            nodes = self.get_nodes()
+        return self.driver.revert_nodes(nodes, name, resume=resume,
+                                        paused=paused)
+
     def erase(self):
         for nod in self.get_nodes():
             nod.erase()
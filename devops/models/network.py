@@ -18,14 +18,16 @@ from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
 import jsonfield
-import netaddr
 
 from devops import error
 from devops.helpers import helpers
+from devops.helpers import loader
 from devops.helpers import network
 from devops import logger
 from devops.models import base
 
+netaddr = loader.lazy_import('netaddr')
+
 
 class AddressPool(base.ParamedModel, base.BaseModel):
     """Address pool
@@ -550,6 +552,7 @@ class Interface(base.ParamedModel):
             ip_address=str(ip),
             interface=self,
         )
+        self.driver.add_dhcp_hosts([self])
 
     @property
     def is_blocked(self):
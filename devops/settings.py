@@ -270,8 +270,83 @@ DEVOPS_SETTINGS_TEMPLATE = os.environ.get('DEVOPS_SETTINGS_TEMPLATE', None)
 SNAPSHOTS_EXTERNAL = get_var_as_bool('SNAPSHOTS_EXTERNAL', False)
 SNAPSHOTS_EXTERNAL_DIR = os.environ.get("SNAPSHOTS_EXTERNAL_DIR",
                                         os.path.expanduser("~/.devops/snap"))
+# Max number of nodes of a group which state is saved at once when the
+# environment is snapshotted, compression of memory state files of external
+# snapshots ('' keeps files written by libvirt as is, or 'gzip') and its
+# level
+SNAPSHOTS_CONCURRENCY = int(os.environ.get('SNAPSHOTS_CONCURRENCY', 4))
+SNAPSHOTS_MEMORY_COMPRESSION = os.environ.get(
+    'SNAPSHOTS_MEMORY_COMPRESSION', '')
+SNAPSHOTS_MEMORY_COMPRESSION_LEVEL = int(
+    os.environ.get('SNAPSHOTS_MEMORY_COMPRESSION_LEVEL', 1))
+# File where timings of snapshot and revert phases are appended as JSON
+# lines, summarized by 'dos.py snapshot-stats'; '' disables it. The file
+# is not rotated, e.g. ~/.devops/snapshot-stats.jsonl
+SNAPSHOT_STATS_FILE = os.environ.get('SNAPSHOT_STATS_FILE', '')
+
+# File where spans and metrics of libvirt, SSH, SFTP, subprocess and DB
+# calls, wait loops and snapshot operations are appended ('' disables
+# it), its format: 'jsonl' or 'otlp' (OpenTelemetry JSON), and
+# comma-separated categories to record, all by default
+INSTRUMENTATION_FILE = os.environ.get('INSTRUMENTATION_FILE', '')
+INSTRUMENTATION_FORMAT = os.environ.get('INSTRUMENTATION_FORMAT', 'jsonl')
+INSTRUMENTATION_CATEGORIES = [
+    category for category in
+    os.environ.get('INSTRUMENTATION_CATEGORIES', '').split(',') if category]
 CLOUD_IMAGE_DIR = os.environ.get(
     'CLOUD_IMAGE_DIR', os.path.expanduser('~/.devops/cloud_image_settings'))
 
+# Index of base images cached in libvirt storage pools
+IMAGE_CACHE_INDEX = os.environ.get(
+    'IMAGE_CACHE_INDEX', os.path.expanduser('~/.devops/image_cache.json'))
+# Evict least recently used unreferenced base images when the total size
+# of cached images exceeds this limit in gigabytes, 0 disables eviction
+IMAGE_CACHE_MAX_SIZE = float(os.environ.get('IMAGE_CACHE_MAX_SIZE', 0))
+# Directory of locks of cached images shared by all users of the host, so
+# an image is uploaded by one process while others wait for it and it is
+# not evicted meanwhile
+IMAGE_CACHE_LOCK_DIR = os.environ.get('IMAGE_CACHE_LOCK_DIR',
+                                      '/tmp/devops-image-cache')
+
+# Persistent cache of source image digests
+HASH_CACHE_PATH = os.environ.get(
+    'HASH_CACHE_PATH', os.path.expanduser('~/.devops/hash_cache.json'))
+# Size of file chunks hashed in parallel and number of hashing threads
+HASH_CHUNK_SIZE = int(os.environ.get('HASH_CHUNK_SIZE', 64 * 1024 ** 2))
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 4))
+
+# Host capabilities cached per libvirt connection URI and libvirt version,
+# empty value disables the cache
+LIBVIRT_CAPABILITIES_CACHE = os.environ.get(
+    'LIBVIRT_CAPABILITIES_CACHE',
+    os.path.expanduser('~/.devops/libvirt_capabilities.json'))
+
+# Names of bridges reserved by running devops processes of all users of
+# the host, empty value disables reservations between processes
+DEVICE_NAMES_LOCK = os.environ.get('DEVICE_NAMES_LOCK',
+                                   '/tmp/devops-device-names.json')
+
+# Max number of concurrent volume I/O operations (creation and upload of
+# libvirt volumes) in one process, and max number of parallel uploads
+VOLUME_IO_CONCURRENCY = int(os.environ.get('VOLUME_IO_CONCURRENCY', 4))
+VOLUME_UPLOAD_STREAMS = int(os.environ.get('VOLUME_UPLOAD_STREAMS', 2))
+
+# Max number of libvirt networks of a group defined concurrently
+NETWORK_DEFINE_CONCURRENCY = int(
+    os.environ.get('NETWORK_DEFINE_CONCURRENCY', 4))
+
+# Keystrokes sent to nodes: max number of keys pressed by one sendKey call
+# (1 sends every key separately), time in milliseconds to hold the keys
+# (0 is the hypervisor default), and if <Wait> waits for the screen of
+# the node to settle instead of sleeping SEND_KEYS_WAIT_TIMEOUT seconds
+SEND_KEYS_BATCH_SIZE = int(os.environ.get('SEND_KEYS_BATCH_SIZE', 16))
+SEND_KEYS_HOLD_TIME = int(os.environ.get('SEND_KEYS_HOLD_TIME', 0))
+SEND_KEYS_WAIT_SCREEN = get_var_as_bool('SEND_KEYS_WAIT_SCREEN', False)
+SEND_KEYS_WAIT_TIMEOUT = float(os.environ.get('SEND_KEYS_WAIT_TIMEOUT', 1))
+
+# Max number of libvirt nwfilters requested or redefined concurrently
+# when traffic of several interfaces and networks is blocked at once
+NWFILTER_CONCURRENCY = int(os.environ.get('NWFILTER_CONCURRENCY', 4))
+
 # Enable creating nwfilters for libvirt networks and interfaces
 ENABLE_LIBVIRT_NWFILTERS = get_var_as_bool('ENABLE_LIBVIRT_NWFILTERS', False)
@@ -16,17 +16,24 @@ from __future__ import print_function
 
 import argparse
 import collections
+import csv
+import datetime
+import json
 import os
 import sys
 
-import tabulate
+import six
 
 import devops
 from devops import client
 from devops import error
 from devops.helpers import helpers
+from devops.helpers import instrumentation
+from devops.helpers import loader
 from devops import logger
 
+tabulate = loader.lazy_import('tabulate')
+
 
 class Shell(object):
     def __init__(self, args):
@@ -53,30 +60,108 @@ class Shell(object):
         print(tabulate.tabulate(columns, headers=headers,
                                 tablefmt="simple"))
 
-    def do_list(self):
-        env_names = self.client.list_env_names()
-        columns = []
-        for env_name in sorted(env_names):
-            env = self.client.get_env(env_name)
-            column = collections.OrderedDict()
-            column['NAME'] = env.name
-            if self.params.list_ips:
-                if env.has_admin():
-                    column['ADMIN IP'] = env.get_admin_ip()
-                else:
-                    column['ADMIN IP'] = ''
-            if self.params.timestamps:
-                column['CREATED'] = helpers.utc_to_local(env.created).strftime(
-                    '%Y-%m-%d_%H:%M:%S')
-            columns.append(column)
+    OUTPUT_FORMATS = ('table', 'json', 'jsonl', 'csv')
+
+    def print_rows(self, headers, rows):
+        """Print rows in the output format chosen with --format
+
+        A table needs all rows to align columns, other formats print
+        every row as soon as it is produced. Keys of json and jsonl
+        records and the csv header are derived from the headers, e.g.
+        'NODE-NAME' becomes 'node_name'.
+
+        :type headers: list
+        :param rows: iterable of row value sequences
+        """
+        output_format = getattr(self.params, 'output_format', 'table')
+        if output_format == 'table':
+            self.print_table(headers=headers, columns=list(rows))
+            return
+
+        keys = [header.lower().replace(' ', '_').replace('-', '_')
+                for header in headers]
+        if output_format == 'csv':
+            self._print_csv_row(keys)
+            for row in rows:
+                self._print_csv_row(row)
+        elif output_format == 'jsonl':
+            for row in rows:
+                self._print_line(self._to_json(keys, row))
+        else:
+            prefix = '['
+            for row in rows:
+                self._print_line(prefix + self._to_json(keys, row))
+                prefix = ','
+            self._print_line('[]' if prefix == '[' else ']')
+
+    @staticmethod
+    def _to_json(keys, row):
+        return json.dumps(collections.OrderedDict(zip(keys, row)),
+                          default=str)
 
-        self.print_table(headers='keys', columns=columns)
+    def _print_csv_row(self, row):
+        buf = six.StringIO()
+        csv.writer(buf, lineterminator='').writerow(
+            ['' if value is None else value for value in row])
+        self._print_line(buf.getvalue())
+
+    @staticmethod
+    def _print_line(line):
+        print(line)
+        sys.stdout.flush()
+
+    def do_list(self):
+        envs = sorted(self.client.list_envs(), key=lambda env: env.name)
+        headers = ['NAME']
+        if self.params.list_ips:
+            admin_ips = self.client.get_admin_ips()
+            headers.append('ADMIN IP')
+        if self.params.timestamps:
+            headers.append('CREATED')
+
+        def rows():
+            for env in envs:
+                row = [env.name]
+                if self.params.list_ips:
+                    row.append(admin_ips.get(env.name, ''))
+                if self.params.timestamps:
+                    row.append(helpers.utc_to_local(env.created).strftime(
+                        '%Y-%m-%d_%H:%M:%S'))
+                yield row
+
+        self.print_rows(headers, rows())
 
     def do_show(self):
-        nodes = sorted(self.env.get_nodes(), key=lambda node: node.name)
-        headers = ("VNC", "NODE-NAME", "GROUP-NAME")
-        columns = [(node.get_vnc_port(), node.name, node.group.name)
-                   for node in nodes]
+        vnc_ports = sorted(self.env.get_nodes_vnc_ports(),
+                           key=lambda item: item[0].name)
+        headers = ["VNC", "NODE-NAME", "GROUP-NAME"]
+        if self.params.show_state:
+            nodes_state = dict(self.env.get_nodes_state())
+            headers.append("STATE")
+
+        def rows():
+            for node, vnc_port in vnc_ports:
+                row = [vnc_port, node.name, node.group.name]
+                if self.params.show_state:
+                    row.append(nodes_state[node].status)
+                yield row
+
+        self.print_rows(headers, rows())
+
+    def do_stats(self):
+        nodes_stats = sorted(self.env.get_nodes_stats(self.params.interval),
+                             key=lambda item: item[0].name)
+        headers = ("NODE-NAME", "CPU %", "MEMORY MB", "IOPS",
+                   "READ MB/s", "WRITE MB/s", "RX MB/s", "TX MB/s")
+        columns = []
+        for node, rates in nodes_stats:
+            if rates is None:
+                columns.append((node.name,) + ('-',) * (len(headers) - 1))
+            else:
+                columns.append((node.name, rates.cpu, rates.memory,
+                                rates.iops, rates.read_mbps,
+                                rates.write_mbps, rates.rx_mbps,
+                                rates.tx_mbps))
         self.print_table(headers=headers, columns=columns)
 
     def do_erase(self):
@@ -119,17 +204,13 @@ class Shell(object):
         snapshots = sorted(snapshots.values(), key=lambda x: x.info.created)
 
         headers = ('SNAPSHOT', 'CREATED', 'NODES-NAMES')
-        columns = []
-        for info, nodes in snapshots:
-            nodes.sort()
-            columns.append((
-                info.name,
-                helpers.utc_to_local(
-                    info.created).strftime('%Y-%m-%d %H:%M:%S'),
-                ', '.join(nodes),
-            ))
+        rows = ((
+            info.name,
+            helpers.utc_to_local(info.created).strftime('%Y-%m-%d %H:%M:%S'),
+            ', '.join(sorted(nodes)),
+        ) for info, nodes in snapshots)
 
-        self.print_table(columns=columns, headers=headers)
+        self.print_rows(headers, rows)
 
     def do_snapshot_delete(self):
         for node in self.env.get_nodes():
@@ -139,8 +220,104 @@ class Shell(object):
 
     def do_net_list(self):
         headers = ("NETWORK NAME", "IP NET")
-        columns = [(net.name, net.ip_network)
-                   for net in self.env.get_address_pools()]
+        rows = ((net.name, net.ip_network)
+                for net in self.env.get_address_pools())
+        self.print_rows(headers, rows)
+
+    def do_image_cache(self):
+        # libvirt is required by this command only
+        from devops.driver.libvirt import libvirt_driver
+        from devops.driver.libvirt import libvirt_image_cache
+
+        conn = libvirt_driver.LibvirtManager.get_connection(
+            self.params.connection_string)
+        cache = libvirt_image_cache.ImageCache(conn, self.params.storage_pool)
+
+        if self.params.evict:
+            for name in cache.evict(max_size=self.params.max_size * 1024 ** 3):
+                print('Evicted {}'.format(name))
+
+        headers = ('DIGEST', 'FORMAT', 'SIZE(GB)', 'REFS', 'LAST-USED',
+                   'SOURCE')
+        columns = []
+        for img in cache.list():
+            last_used = '-'
+            if img.last_used:
+                last_used = datetime.datetime.fromtimestamp(
+                    img.last_used).strftime('%Y-%m-%d %H:%M:%S')
+            columns.append((img.digest[:12], img.format,
+                            round(img.allocation / 1024.0 ** 3, 2),
+                            img.refcount, last_used, img.source or '-'))
+        self.print_table(headers=headers, columns=columns)
+
+    def do_snapshot_gc(self):
+        from django.conf import settings
+
+        # libvirt is required by this command only
+        from devops.driver.libvirt import libvirt_driver
+        from devops.driver.libvirt import libvirt_memory_files
+
+        # any error while snapshots are listed stops the command, files of
+        # unlisted snapshots would be removed otherwise
+        referenced = set()
+        prefixes = []
+        connection_strings = set()
+        for env_name in self.client.list_env_names():
+            env = self.client.get_env(env_name)
+            prefixes.append(env_name + '_')
+            for grp in env.get_groups():
+                if isinstance(grp.driver, libvirt_driver.LibvirtDriver):
+                    connection_strings.add(grp.driver.connection_string)
+            for node in env.get_nodes():
+                for snap in node.get_snapshots():
+                    memory_file = getattr(snap, 'memory_file', None)
+                    if memory_file:
+                        referenced.add(memory_file)
+
+        # SNAPSHOTS_EXTERNAL_DIR may be shared with other databases, users
+        # and domains defined by hand
+        for connection_string in sorted(connection_strings):
+            conn = libvirt_driver.LibvirtManager.get_connection(
+                connection_string)
+            referenced.update(
+                libvirt_memory_files.list_snapshot_memory_files(conn))
+
+        dry_run = self.params.dry_run or not self.params.yes
+        memory_files = libvirt_memory_files.MemoryFiles(
+            settings.SNAPSHOTS_EXTERNAL_DIR)
+        for path in memory_files.collect_garbage(
+                referenced, prefixes=prefixes, min_age=self.params.min_age,
+                dry_run=dry_run):
+            if dry_run:
+                print('Would remove {}'.format(path))
+            else:
+                print('Removed {}'.format(path))
+
+    def do_snapshot_stats(self):
+        from django.conf import settings
+
+        stats_file = self.params.stats_file or settings.SNAPSHOT_STATS_FILE
+        if not stats_file:
+            raise error.DevopsError(
+                'Timings of snapshots are not recorded, set '
+                'SNAPSHOT_STATS_FILE or use --stats-file')
+        durations = collections.defaultdict(list)
+        for span in instrumentation.read_spans(stats_file):
+            attrs = span.get('attrs') or {}
+            if (self.params.env_name and
+                    attrs.get('env') != self.params.env_name):
+                continue
+            if span.get('error') or span.get('duration') is None:
+                continue
+            key = (span['name'], attrs.get('role') or '-')
+            durations[key].append(span['duration'])
+
+        headers = ('PHASE', 'ROLE', 'COUNT', 'P50(s)', 'P95(s)')
+        columns = [
+            (name, role, len(values),
+             round(instrumentation.percentile(values, 50), 3),
+             round(instrumentation.percentile(values, 95), 3))
+            for (name, role), values in sorted(durations.items())]
         self.print_table(headers=headers, columns=columns)
 
     def do_time_sync(self):
@@ -186,6 +363,16 @@ class Shell(object):
 
     def do_create_env(self):
         """Create env using config file."""
+        if not self.params.skip_capacity_check:
+            report = self.client.plan_env_from_config(
+                self.params.env_config_name)
+            for msg in report.warnings:
+                logger.warning(msg)
+            if not report.ok:
+                raise error.DevopsError(
+                    'Not enough resources for the environment:\n'
+                    '{}'.format(report))
+
         env = self.client.create_env_from_config(
             self.params.env_config_name)
         env.define()
@@ -267,6 +454,13 @@ class Shell(object):
                                             default=os.environ.get(
                                                 'DEVOPS_SETTINGS_TEMPLATE'))
 
+        skip_capacity_check_parser = argparse.ArgumentParser(add_help=False)
+        skip_capacity_check_parser.add_argument(
+            '--skip-capacity-check', dest='skip_capacity_check',
+            action='store_const', const=True,
+            help='do not check if the host has enough resources',
+            default=False)
+
         snapshot_name_parser = argparse.ArgumentParser(add_help=False)
         snapshot_name_parser.add_argument('snapshot_name',
                                           help='snapshot name',
@@ -293,6 +487,58 @@ class Shell(object):
                                        action='store_const', const=True,
                                        help='show creation timestamps',
                                        default=False)
+        show_state_parser = argparse.ArgumentParser(add_help=False)
+        show_state_parser.add_argument('--state', dest='show_state',
+                                       action='store_const', const=True,
+                                       help='show state of nodes',
+                                       default=False)
+        interval_parser = argparse.ArgumentParser(add_help=False)
+        interval_parser.add_argument('--interval', dest='interval',
+                                     type=float,
+                                     help='seconds to measure rates over',
+                                     default=None)
+        image_cache_parser = argparse.ArgumentParser(add_help=False)
+        image_cache_parser.add_argument(
+            '--connection-string', dest='connection_string',
+            help='libvirt connection URI', default='qemu:///system')
+        image_cache_parser.add_argument(
+            '--storage-pool', dest='storage_pool',
+            help='libvirt storage pool name', default='default')
+        image_cache_parser.add_argument(
+            '--evict', dest='evict', action='store_const', const=True,
+            help='remove least recently used images without overlays',
+            default=False)
+        image_cache_parser.add_argument(
+            '--max-size', dest='max_size', type=float,
+            help='evict images until their total size in GB is not more '
+                 'than this value',
+            default=0)
+        snapshot_gc_parser = argparse.ArgumentParser(add_help=False)
+        snapshot_gc_parser.add_argument(
+            '--dry-run', dest='dry_run', action='store_const', const=True,
+            help='only show files which would be removed (default)',
+            default=False)
+        snapshot_gc_parser.add_argument(
+            '--yes', dest='yes', action='store_const', const=True,
+            help='remove the files', default=False)
+        snapshot_gc_parser.add_argument(
+            '--min-age', dest='min_age', type=int,
+            help='keep files changed less than this number of seconds ago',
+            default=3600)
+        snapshot_stats_parser = argparse.ArgumentParser(add_help=False)
+        snapshot_stats_parser.add_argument(
+            '--stats-file', dest='stats_file',
+            help='file with timings of snapshot and revert phases '
+                 '(default: SNAPSHOT_STATS_FILE)',
+            default=None)
+        snapshot_stats_parser.add_argument(
+            '--env', dest='env_name',
+            help='show timings of this environment only', default=None)
+        format_parser = argparse.ArgumentParser(add_help=False)
+        format_parser.add_argument(
+            '--format', dest='output_format', choices=self.OUTPUT_FORMATS,
+            help='output format, rows of json, jsonl and csv are printed '
+                 'as soon as they are ready', default='table')
         iso_path_parser = argparse.ArgumentParser(add_help=False)
         iso_path_parser.add_argument('--iso-path', '-I', dest='iso_path',
                                      help='Set Fuel ISO path',
@@ -384,12 +630,20 @@ class Shell(object):
                                            help='available commands',
                                            dest='command')
         subparsers.add_parser('list',
-                              parents=[list_ips_parser, timestamps_parser],
+                              parents=[list_ips_parser, timestamps_parser,
+                                       format_parser],
                               help="Show virtual environments",
                               description="Show virtual environments on host")
-        subparsers.add_parser('show', parents=[name_parser],
+        subparsers.add_parser('show',
+                              parents=[name_parser, show_state_parser,
+                                       format_parser],
                               help="Show VMs in environment",
                               description="Show VMs in environment")
+        subparsers.add_parser('stats', parents=[name_parser, interval_parser],
+                              help="Show resource usage of nodes",
+                              description="Display CPU, memory, disk and "
+                                          "network usage rates of "
+                                          "environment nodes")
         subparsers.add_parser('erase', parents=[name_parser],
                               help="Delete environment",
                               description="Delete environment and VMs on it")
@@ -420,7 +674,7 @@ class Shell(object):
                               description="Synchronization environment "
                               "and devops"),
         subparsers.add_parser('snapshot-list',
-                              parents=[name_parser],
+                              parents=[name_parser, format_parser],
                               help="Show snapshots in environment",
                               description="Show snapshots in selected "
                               "environment")
@@ -429,11 +683,33 @@ class Shell(object):
                               help="Delete snapshot from environment",
                               description="Delete snapshot from selected "
                               "environment")
+        subparsers.add_parser('snapshot-gc',
+                              parents=[snapshot_gc_parser],
+                              help="Remove unused snapshot memory files",
+                              description="Remove memory state files of "
+                                          "external snapshots of devops "
+                                          "environments which are not used "
+                                          "by any snapshot of libvirt hosts "
+                                          "of the environments, only show "
+                                          "them without --yes")
+        subparsers.add_parser('snapshot-stats',
+                              parents=[snapshot_stats_parser],
+                              help="Show timings of snapshots and reverts",
+                              description="Display median and 95th "
+                                          "percentile of time spent in "
+                                          "snapshot and revert phases per "
+                                          "node role")
         subparsers.add_parser('net-list',
-                              parents=[name_parser],
+                              parents=[name_parser, format_parser],
                               help="Show networks in environment",
                               description="Display allocated networks for "
                               "environment")
+        subparsers.add_parser('image-cache',
+                              parents=[image_cache_parser],
+                              help="Show cached source images",
+                              description="Display base images cached in "
+                                          "libvirt storage pool and evict "
+                                          "unused ones")
         subparsers.add_parser('time-sync',
                               parents=[name_parser, node_name_parser],
                               help="Sync time on all env nodes",
@@ -462,7 +738,8 @@ class Shell(object):
                               description="Create an environment by using "
                                           "cli options"),
         subparsers.add_parser('create-env',
-                              parents=[env_config_name_parser],
+                              parents=[env_config_name_parser,
+                                       skip_capacity_check_parser],
                               help="Create a new environment",
                               description="Create an environment from a "
                                           "template file"),
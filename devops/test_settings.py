@@ -18,3 +18,5 @@ from devops.settings import *  # noqa
 
 # make tests faster
 DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3'}
+
+SNAPSHOT_STATS_FILE = ''
@@ -95,6 +95,31 @@ class TestDevopsClient(driverless.DriverlessTestCase):
         test_env.erase()
         assert self.c.list_env_names() == []
 
+    def test_list_envs(self):
+        assert [env.name for env in self.c.list_envs()] == ['test']
+
+    def test_get_admin_ips(self):
+        assert self.c.get_admin_ips() == {}
+
+        self.group.add_node(
+            name='admin',
+            role='fuel_master',
+            interfaces=[
+                dict(label='eth0', l2_network_device='admin',
+                     interface_model='e1000'),
+                dict(label='eth1', l2_network_device='admin',
+                     interface_model='e1000'),
+            ])
+        self.group.add_node(
+            name='slave-01',
+            role='fuel_slave',
+            interfaces=[dict(label='eth0', l2_network_device='admin',
+                             interface_model='e1000')])
+
+        with self.assertNumQueries(1):
+            admin_ips = self.c.get_admin_ips()
+        assert admin_ips == {'test': self.c.get_env('test').get_admin_ip()}
+
     def test_create_env_default(self):
         env = self.c.create_env(env_name='test2')
         assert env.name == 'test2'
@@ -163,6 +188,14 @@ class TestDevopsClient(driverless.DriverlessTestCase):
         assert env.get_address_pool(name='pool1') is not None
         assert env.get_group(name='rack-01') is not None
 
+    def test_plan_env_from_config_file(self):
+        report = self.c.plan_env_from_config('/path/to/my-conf.yaml')
+        self.get_conf_mock.assert_called_once_with('/path/to/my-conf.yaml')
+        assert report.ok
+        assert list(report.requirements) == ['rack-01']
+        assert report.requirements['rack-01'].networks == 1
+        assert self.c.list_env_names() == ['test']
+
     def test_synchronize_all(self):
         sync_all_mock = self.patch(
             'devops.models.environment.Environment.synchronize_all')
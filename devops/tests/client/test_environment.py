@@ -106,6 +106,15 @@ class TestDevopsEnvironment(driverless.DriverlessTestCase):
 
         self.vol_define_mock.assert_called_once_with()
 
+    @mock.patch('devops.models.driver.Driver.dhcp_hosts_batch')
+    def test_add_slaves_dhcp_hosts_batch(self, batch_mock):
+        self.denv.add_slaves(nodes_count=1)
+
+        batch_mock.assert_called_once_with()
+        batch_mock.return_value.__enter__.assert_called_once_with()
+        batch_mock.return_value.__exit__.assert_called_once_with(
+            None, None, None)
+
     def test_admin_setup(self):
         self.group.add_node(
             name='admin',
@@ -89,7 +89,7 @@ class LibvirtTestCase(TestCase):
 
     def setUp(self):
         # reset device names
-        LibvirtDriver._device_name_generators = {}
+        LibvirtDriver._device_name_allocators = {}
 
         self.libvirt_vol_up_mock = self.patch('libvirt.virStorageVol.upload')
         self.libvirt_vol_resize_mock = self.patch(
@@ -104,6 +104,13 @@ class LibvirtTestCase(TestCase):
         self.libvirt_list_all_devs_mock = self.patch(
             'libvirt.virConnect.listAllDevices')
 
+        override = self.settings(LIBVIRT_CAPABILITIES_CACHE='',
+                                 DEVICE_NAMES_LOCK='')
+        override.enable()
+        self.addCleanup(override.disable)
+        LibvirtManager.capabilities = {}
+        LibvirtManager.nwfilter_states = {}
+
         self._libvirt_clear_all()
         conn = LibvirtManager.get_connection('test:///default')
 
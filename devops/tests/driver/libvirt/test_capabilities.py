@@ -0,0 +1,148 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import pytest
+
+from devops.driver.libvirt import libvirt_capabilities
+from devops import error
+from devops.models import Environment
+from devops.tests.driver.libvirt.base import CAPS_XML
+from devops.tests.driver.libvirt.base import LibvirtTestCase
+
+
+class TestHostCapabilities(unittest.TestCase):
+
+    def setUp(self):
+        self.caps = libvirt_capabilities.HostCapabilities(CAPS_XML)
+
+    def test_emulators(self):
+        assert self.caps.emulators == {
+            ('i686', 'qemu'): '/usr/bin/qemu-system-i386',
+            ('i686', 'test'): '/usr/bin/test-emulator',
+            ('x86_64', 'test'): '/usr/bin/test-emulator',
+        }
+        assert self.caps.supports('i686', 'qemu')
+        assert not self.caps.supports('x86_64', 'kvm')
+
+    def test_get_emulator(self):
+        assert self.caps.get_emulator('i686', 'qemu') == (
+            '/usr/bin/qemu-system-i386')
+        with pytest.raises(error.DevopsError):
+            self.caps.get_emulator('x86_64', 'kvm')
+
+    def test_guest_features(self):
+        features = self.caps.get_guest_features('x86_64')
+        assert sorted(features) == [
+            'acpi', 'apic', 'cpuselection', 'deviceboot']
+        assert features['acpi'] == {'default': 'on', 'toggle': 'yes'}
+        assert 'pae' in self.caps.get_guest_features('i686')
+        assert self.caps.get_guest_features('x86_64', os_type='xen') == {}
+
+
+class TestCapabilitiesCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.cache_path = os.path.join(self.tmp_dir, 'caps', 'caps.json')
+        self.cache = libvirt_capabilities.CapabilitiesCache(self.cache_path)
+
+        self.conn = mock.Mock()
+        self.conn.getCapabilities.return_value = CAPS_XML
+        self.conn.getLibVersion.return_value = 1002001
+        self.conn.getVersion.return_value = 2005000
+
+    def test_get(self):
+        caps = self.cache.get(self.conn, 'qemu:///system')
+        assert caps.xml == CAPS_XML
+
+        with open(self.cache_path) as f:
+            assert json.load(f) == {
+                'qemu:///system': {
+                    'versions': [1002001, 2005000],
+                    'xml': CAPS_XML,
+                }
+            }
+
+        # another process doesn't request capabilities again
+        cache = libvirt_capabilities.CapabilitiesCache(self.cache_path)
+        caps = cache.get(self.conn, 'qemu:///system')
+        assert caps.get_emulator('i686', 'test') == '/usr/bin/test-emulator'
+        self.conn.getCapabilities.assert_called_once_with()
+
+    def test_version_changed(self):
+        self.cache.get(self.conn, 'qemu:///system')
+        self.conn.getLibVersion.return_value = 1003000
+
+        self.cache.get(self.conn, 'qemu:///system')
+
+        assert self.conn.getCapabilities.call_count == 2
+
+    def test_uri(self):
+        self.cache.get(self.conn, 'qemu:///system')
+        self.cache.get(self.conn, 'qemu+ssh://host/system')
+
+        assert self.conn.getCapabilities.call_count == 2
+
+    def test_corrupted(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, 'w') as f:
+            f.write('{"qemu:///sys')
+
+        self.cache.get(self.conn, 'qemu:///system')
+        self.cache.get(self.conn, 'qemu:///system')
+
+        self.conn.getCapabilities.assert_called_once_with()
+
+    def test_disabled(self):
+        cache = libvirt_capabilities.CapabilitiesCache('')
+
+        cache.get(self.conn, 'qemu:///system')
+
+        assert not self.conn.getLibVersion.called
+        assert not os.path.exists(self.cache_path)
+
+
+class TestLibvirtDriverCapabilities(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestLibvirtDriverCapabilities, self).setUp()
+
+        self.env = Environment.create('test_env')
+        self.group = self.env.add_group(
+            group_name='test_group',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool')
+
+    def test_shared_by_drivers(self):
+        node1 = self.group.add_node(
+            name='test_node1', role='default',
+            architecture='i686', hypervisor='test')
+        node2 = self.group.add_node(
+            name='test_node2', role='default',
+            architecture='x86_64', hypervisor='test')
+
+        node1.define()
+        node2.define()
+
+        assert node1.driver.capabilities is node2.driver.capabilities
+        self.caps_mock.assert_called_once_with()
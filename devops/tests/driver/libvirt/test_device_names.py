@@ -0,0 +1,127 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from devops.driver.libvirt import libvirt_device_names
+
+
+class TestDeviceNameAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.lock_path = os.path.join(self.tmp_dir, 'device_names.json')
+
+        self.list_names = mock.Mock(return_value=['virbr1', 'eth0'])
+        self.allocator = self.create_allocator()
+
+    def create_allocator(self, uri='qemu:///system'):
+        return libvirt_device_names.DeviceNameAllocator(
+            uri, self.list_names, lock_path=self.lock_path)
+
+    def read_reservations(self):
+        with open(self.lock_path) as f:
+            return json.load(f)
+
+    def test_allocate(self):
+        assert self.allocator.allocate('virbr') == ['virbr0']
+        assert self.allocator.allocate('virbr', 3) == [
+            'virbr2', 'virbr3', 'virbr4']
+        assert self.allocator.allocate('virnet') == ['virnet0']
+        assert self.list_names.call_count == 3
+
+    def test_batch(self):
+        with self.allocator.batch():
+            names = [self.allocator.allocate('virbr')[0] for _ in range(5)]
+        assert names == ['virbr0', 'virbr2', 'virbr3', 'virbr4', 'virbr5']
+        self.list_names.assert_called_once_with()
+
+        self.allocator.allocate('virbr')
+        assert self.list_names.call_count == 2
+
+    def test_threads(self):
+        names = []
+
+        def allocate():
+            for _ in range(10):
+                names.extend(self.allocator.allocate('virbr'))
+
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(names) == 40
+        assert len(set(names)) == 40
+        assert 'virbr1' not in names
+
+    def test_processes(self):
+        assert self.allocator.allocate('virbr', 2) == ['virbr0', 'virbr2']
+        reservations = self.read_reservations()['qemu:///system']
+        assert sorted(reservations) == ['virbr0', 'virbr2']
+        assert reservations['virbr0']['pid'] == os.getpid()
+
+        # allocator of another process on the same host
+        other = self.create_allocator()
+        assert other.allocate('virbr') == ['virbr3']
+
+        # allocator of another host
+        remote = self.create_allocator('qemu+ssh://host/system')
+        assert remote.allocate('virbr') == ['virbr0']
+
+    @mock.patch('devops.driver.libvirt.libvirt_device_names.os.kill')
+    def test_dead_process(self, kill_mock):
+        with open(self.lock_path, 'w') as f:
+            json.dump({'qemu:///system': {
+                'virbr0': {'pid': 1000001, 'time': time.time()},
+                'virbr2': {'pid': 1000002, 'time': 0},
+                'virbr3': {'pid': 1000003, 'time': time.time()},
+            }}, f)
+        kill_mock.side_effect = lambda pid, sig: (
+            None if pid == 1000003 else self._raise_esrch())
+
+        assert self.allocator.allocate('virbr', 2) == ['virbr0', 'virbr2']
+        assert sorted(self.read_reservations()['qemu:///system']) == [
+            'virbr0', 'virbr2', 'virbr3']
+
+    @staticmethod
+    def _raise_esrch():
+        raise OSError(3, 'No such process')
+
+    def test_no_lock_file(self):
+        allocator = libvirt_device_names.DeviceNameAllocator(
+            'qemu:///system', self.list_names, lock_path='')
+        assert allocator.allocate('virbr') == ['virbr0']
+        assert not os.path.exists(self.lock_path)
+
+    def test_lock_file_is_shared(self):
+        self.lock_path = os.path.join(self.tmp_dir, 'locks', 'names.json')
+        allocator = self.create_allocator()
+        assert allocator.allocate('virbr') == ['virbr0']
+
+        # writable by processes of other users
+        assert stat.S_IMODE(os.stat(self.lock_path).st_mode) == 0o666
+        assert stat.S_IMODE(
+            os.stat(os.path.dirname(self.lock_path)).st_mode) == 0o1777
@@ -23,6 +23,7 @@ from netaddr import IPNetwork
 # noinspection PyProtectedMember
 from devops.driver.libvirt.libvirt_driver import _LibvirtManager
 from devops.driver.libvirt.libvirt_driver import LibvirtDriver
+from devops.helpers import capacity
 from devops.models import Environment
 from devops.tests.driver.libvirt.base import LibvirtTestCase
 
@@ -71,6 +72,21 @@ class TestLibvirtManager(TestCase):
         assert self.manager.connections == {'qemu:///system': c,
                                             'test:///default': c3}
 
+    def test_get_storage_pool(self):
+        conn = self.manager.get_connection('qemu:///system')
+        pool = self.manager.get_storage_pool('qemu:///system', 'default')
+        pool2 = self.manager.get_storage_pool('qemu:///system', 'default')
+
+        assert pool is pool2
+        conn.storagePoolLookupByName.assert_called_once_with('default')
+        assert self.manager.get_storage_pools('qemu:///system') == {
+            'default': pool}
+
+        # handles are looked up again for a new connection
+        conn.isAlive.return_value = False
+        self.manager.get_storage_pool('qemu:///system', 'default')
+        assert conn.storagePoolLookupByName.call_count == 2
+
 
 class TestLibvirtDriver(LibvirtTestCase):
 
@@ -149,6 +165,96 @@ class TestLibvirtDriver(LibvirtTestCase):
     def test_get_version(self):
         assert isinstance(self.d.get_libvirt_version(), int)
 
+    def test_storage_pool(self):
+        pool = self.d.get_storage_pool('default-pool')
+        assert pool.name() == 'default-pool'
+        assert self.d.get_storage_pool('default-pool') is pool
+
+        info = self.d.get_storage_pool_info('default-pool')
+        assert info['capacity'] > 0
+        assert info['capacity'] >= info['allocation']
+        assert info['available'] > 0
+
+    def test_create_volumes(self):
+        pool = self.d.get_storage_pool('default-pool')
+        patcher = mock.patch.object(pool, 'refresh')
+        refresh_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        xml = ('<volume><name>{}</name>'
+               '<capacity>1048576</capacity></volume>')
+
+        volumes = self.d.create_volumes(
+            [xml.format('test_vol1'), xml.format('test_vol2')], pool=pool)
+
+        assert [v.name() for v in volumes] == ['test_vol1', 'test_vol2']
+        refresh_mock.assert_called_once_with(0)
+        assert self.d.get_volume_pool(volumes[0]) is pool
+
+    def _check_capacity(self, **kwargs):
+        requirements = capacity.Requirements()
+        requirements.nodes = 1
+        requirements.guests.add(('i686', 'test'))
+        for name, value in kwargs.items():
+            setattr(requirements, name, value)
+        report = capacity.CapacityReport()
+        self.d.check_capacity(requirements, report)
+        return report
+
+    def test_check_capacity(self):
+        self.d.storage_pool_name = 'default-pool'
+        patcher = mock.patch.object(self.d.conn, 'getFreeMemory',
+                                    return_value=2048 * 1024 ** 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _, host_memory, host_cpus = self.d.conn.getInfo()[:3]
+
+        report = self._check_capacity(vcpu=1, max_vcpu=1, memory=1024,
+                                      disk_thick=capacity.GB)
+        assert report.ok
+        assert report.warnings == []
+
+        report = self._check_capacity(
+            vcpu=host_cpus * 2, max_vcpu=host_cpus + 1,
+            memory=host_memory + 1)
+        assert len(report.errors) == 2
+        assert 'vCPUs' in report.errors[0]
+        assert 'memory' in report.errors[1]
+
+        with mock.patch.object(self.d, 'get_free_hugepages',
+                               return_value=512):
+            report = self._check_capacity(memory=1024, hugepages=1024)
+        assert 'hugepages' in report.errors[0]
+
+        report = self._check_capacity(disk_thick=1024 ** 5)
+        assert 'storage pool' in report.errors[0]
+
+    def test_check_capacity_unknown_hugepages(self):
+        self.d.storage_pool_name = 'default-pool'
+        # capabilities of the test host report no hugepage sizes
+        assert self.d.get_free_hugepages() is None
+
+        report = self._check_capacity(memory=1024, hugepages=1024)
+        assert report.ok
+        assert report.warnings == [
+            'Unable to get free hugepages on host test:///default']
+
+    def test_check_capacity_architecture(self):
+        self.d.storage_pool_name = 'default-pool'
+        requirements = capacity.Requirements()
+        requirements.guests.add(('s390x', 'kvm'))
+        report = capacity.CapacityReport()
+
+        self.d.check_capacity(requirements, report)
+
+        assert report.errors == [
+            'Host test:///default does not support kvm guests of s390x '
+            'architecture']
+
+    def test_check_capacity_no_pool(self):
+        report = self._check_capacity()
+        assert report.errors[0].startswith(
+            "Storage pool 'default' is not available")
+
 
 class TestLibvirtDriverDeviceNames(LibvirtTestCase):
 
@@ -255,3 +361,25 @@ class TestLibvirtDriverDeviceNames(LibvirtTestCase):
         assert self.d.get_available_device_name('other') == 'other0'
         assert self.d.get_available_device_name('other') == 'other1'
         assert self.d.get_available_device_name('other') == 'other2'
+
+    def test_get_available_device_names(self):
+        self.libvirt_list_all_devs_mock.return_value = [
+            self.dev_mock, self.dev2_mock]
+        assert self.d.get_available_device_names('virnet', 3) == [
+            'virnet0', 'virnet2', 'virnet3']
+        self.libvirt_list_all_devs_mock.assert_called_once_with()
+
+    def test_define_networks(self):
+        self.libvirt_list_all_devs_mock.return_value = []
+        self.group.add_l2_network_device(
+            name='test_l2_net_dev2',
+            forward=dict(mode='nat'),
+        )
+
+        self.group.define_networks()
+
+        self.libvirt_list_all_devs_mock.assert_called_once_with()
+        bridges = [
+            self.d.conn.networkLookupByUUIDString(net.uuid).bridgeName()
+            for net in self.group.get_l2_network_devices().order_by('name')]
+        assert bridges == ['virbr0', 'virbr1']
@@ -0,0 +1,208 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from devops.driver.libvirt import libvirt_driver
+from devops.driver.libvirt import libvirt_image_cache
+from devops.helpers import hashing
+from devops.models import Environment
+from devops.tests.driver.libvirt.base import LibvirtTestCase
+
+
+class TestLibvirtImageCache(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestLibvirtImageCache, self).setUp()
+
+        self.sleep_mock = self.patch('time.sleep')
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.index_path = os.path.join(self.tmp_dir, 'image_cache.json')
+        override = self.settings(
+            IMAGE_CACHE_INDEX=self.index_path,
+            IMAGE_CACHE_MAX_SIZE=0,
+            IMAGE_CACHE_LOCK_DIR=os.path.join(self.tmp_dir, 'locks'),
+            HASH_CACHE_PATH=os.path.join(self.tmp_dir, 'hash_cache.json'))
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.image_path = os.path.join(self.tmp_dir, 'admin.qcow2')
+        with open(self.image_path, 'wb') as f:
+            f.write(libvirt_image_cache.QCOW2_MAGIC + b'\0' * 1020)
+        self.digest = hashing.get_file_digest(self.image_path)
+
+        self.env = Environment.create('test_env')
+        self.group = self.env.add_group(
+            group_name='test_group',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool',
+            use_image_cache=True)
+        self.d = self.group.driver
+
+        self.node1 = self.group.add_node(
+            name='test_node1',
+            role='default',
+            architecture='i686',
+            hypervisor='test')
+        self.node2 = self.group.add_node(
+            name='test_node2',
+            role='default',
+            architecture='i686',
+            hypervisor='test')
+
+    def test_get_image_format(self):
+        assert libvirt_image_cache.get_image_format(
+            self.image_path) == 'qcow2'
+        raw_path = os.path.join(self.tmp_dir, 'admin.iso')
+        with open(raw_path, 'wb') as f:
+            f.write(b'CD001')
+        assert libvirt_image_cache.get_image_format(raw_path) == 'raw'
+
+    def test_define_uses_cached_image(self):
+        vol1 = self.node1.add_volume(name='system',
+                                     source_image=self.image_path)
+        vol1.define()
+        vol2 = self.node2.add_volume(name='system',
+                                     source_image=self.image_path)
+        vol2.define()
+
+        # the image is uploaded only once to the base volume
+        self.libvirt_vol_up_mock.assert_called_once()
+
+        base_name = 'devops-image-' + self.digest
+        pool = self.d.conn.storagePoolLookupByName('default-pool')
+        base_path = pool.storageVolLookupByName(base_name).path()
+        assert vol1.backing_store is None
+        assert 'backingStore' in vol1._libvirt_volume.XMLDesc(0)
+        assert base_path in vol2._libvirt_volume.XMLDesc(0)
+
+        images = self.d.image_cache.list()
+        assert len(images) == 1
+        assert images[0].name == base_name
+        assert images[0].format == 'qcow2'
+        assert images[0].refcount == 2
+        assert images[0].source == self.image_path
+
+        with open(self.index_path) as f:
+            index = json.load(f)
+        assert list(index.values())[0][self.digest]['source'] == (
+            self.image_path)
+
+    def test_raw_volume_is_not_cached(self):
+        vol = self.node1.add_volume(name='system', format='raw',
+                                    source_image=self.image_path)
+        vol.define()
+        assert self.d.image_cache.list() == []
+
+    def test_evict_unused(self):
+        vol = self.node1.add_volume(name='system',
+                                    source_image=self.image_path)
+        vol.define()
+
+        cache = self.d.image_cache
+        assert cache.evict() == []
+
+        vol.erase()
+        assert cache.list()[0].refcount == 0
+        assert cache.evict() == ['devops-image-' + self.digest]
+        assert cache.list() == []
+
+    def test_incomplete_base_is_uploaded_again(self):
+        cache = self.d.image_cache
+        upload = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtVolume.upload_file')
+        cache.get_base(self.image_path, upload=upload)
+        os.remove(self.index_path)
+
+        # the index of another user doesn't make the base incomplete
+        cache.get_base(self.image_path, upload=upload)
+        upload.assert_called_once()
+
+        base_name = 'devops-image-' + self.digest
+        cache.pool.storageVolLookupByName(
+            cache.get_marker_name(self.digest)).delete(0)
+        cache.get_base(self.image_path, upload=upload)
+        assert upload.call_count == 2
+        assert [img.name for img in cache.list()] == [base_name]
+
+    def test_incomplete_base_with_overlays_is_kept(self):
+        vol = self.node1.add_volume(name='system',
+                                    source_image=self.image_path)
+        vol.define()
+        cache = self.d.image_cache
+        cache.pool.storageVolLookupByName(
+            cache.get_marker_name(self.digest)).delete(0)
+
+        upload = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtVolume.upload_file')
+        cache.get_base(self.image_path, upload=upload)
+        upload.assert_not_called()
+        assert vol.exists()
+        assert cache.pool.storageVolLookupByName(
+            cache.get_marker_name(self.digest))
+
+    def test_get_base_does_not_evict(self):
+        upload = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtVolume.upload_file')
+        cache = self.d.image_cache
+        with self.settings(IMAGE_CACHE_MAX_SIZE=1e-9):
+            base_vol = cache.get_base(self.image_path, upload=upload)
+            assert [img.name for img in cache.list()] == [base_vol.name()]
+            assert cache.trim() == [base_vol.name()]
+        assert cache.list() == []
+
+    def test_evict_skips_pinned(self):
+        vol = self.node1.add_volume(name='system',
+                                    source_image=self.image_path)
+        vol.define()
+        vol.erase()
+
+        cache = self.d.image_cache
+        upload = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtVolume.upload_file')
+        base_vol, pin = cache.acquire_base(self.image_path, upload=upload)
+        # flock of another open file blocks the same process too
+        assert cache.evict() == []
+        pin.close()
+        assert cache.evict() == [base_vol.name()]
+
+    def test_concurrent_evict_waits_for_overlay(self):
+        cache = self.d.image_cache
+        vol = self.node1.add_volume(name='system',
+                                    source_image=self.image_path)
+        evicted = []
+        get_define_xml = libvirt_driver.LibvirtVolume.get_define_xml
+
+        def define_xml(volume, base_vol=None):
+            # another thread trims the cache before the overlay exists
+            thread = threading.Thread(
+                target=lambda: evicted.extend(cache.evict()))
+            thread.start()
+            thread.join()
+            return get_define_xml(volume, base_vol=base_vol)
+
+        self.patch('devops.driver.libvirt.libvirt_driver.'
+                   'LibvirtVolume.get_define_xml',
+                   side_effect=define_xml, autospec=True)
+        vol.define()
+        assert evicted == []
+        assert vol.exists()
+        assert cache.list()[0].refcount == 1
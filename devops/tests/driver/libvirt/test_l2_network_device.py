@@ -12,9 +12,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import libvirt
 import mock
 from netaddr import IPNetwork
+import pytest
 
+from devops.driver.libvirt.libvirt_driver import LibvirtL2NetworkDevice
 from devops.error import DevopsObjNotFound
 from devops.models import Environment
 from devops.tests.driver.libvirt.base import LibvirtTestCase
@@ -118,3 +121,119 @@ class TestLibvirtL2NetworkDevice(LibvirtTestCase):
         assert len(self.env.get_networks()) == 1
         l2dev = self.env.get_network(name='test_l2_net_dev')
         assert l2dev.id == self.l2_net_dev.id
+
+    def test_define_networks(self):
+        self.ap.ip_range_set('dhcp', '172.0.0.100', '172.0.0.200')
+        self.l2_net_dev.dhcp = True
+        self.l2_net_dev.save()
+        self.group.add_l2_network_device(
+            name='test_bridge',
+            forward=dict(mode='bridge'),
+            parent_iface=dict(phys_dev='br0'),
+        )
+        self.group.add_l2_network_device(name='test_isolated')
+        node = self.group.add_node(name='test_node', role='default')
+        node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+            mac_address='64:b6:87:44:14:17')
+
+        with mock.patch('libvirt.virConnect.listAllDevices',
+                        return_value=[]) as list_all_devs_mock:
+            self.group.define_networks()
+        list_all_devs_mock.assert_called_once_with()
+
+        devs = {dev.name: dev for dev in self.group.get_l2_network_devices()}
+        assert all(dev.exists() for dev in devs.values())
+        bridge_names = {name: dev.bridge_name()
+                        for name, dev in devs.items()}
+        assert bridge_names == {
+            'test_l2_net_dev': 'virbr0',
+            'test_bridge': 'br0',
+            'test_isolated': 'virbr1',
+        }
+
+        xml = devs['test_l2_net_dev']._libvirt_network.XMLDesc(0)
+        assert ("<host mac='64:b6:87:44:14:17' name='test_node' "
+                "ip='172.0.0.100'/>") in xml
+
+    # speed up retry
+    @mock.patch('time.sleep')
+    def test_define_networks_failure(self, sleep_mock):
+        self.group.add_l2_network_device(name='test_l2_net_dev2')
+        define_libvirt_network = LibvirtL2NetworkDevice.define_libvirt_network
+
+        def define(dev, **kwargs):
+            if dev.name == 'test_l2_net_dev2':
+                raise libvirt.libvirtError('Failed to define network')
+            return define_libvirt_network(dev, **kwargs)
+
+        with mock.patch.object(LibvirtL2NetworkDevice,
+                               'define_libvirt_network',
+                               autospec=True, side_effect=define):
+            with pytest.raises(libvirt.libvirtError):
+                self.group.define_networks()
+
+        # successfully defined network is saved and can be erased
+        self.l2_net_dev.refresh_from_db()
+        assert self.l2_net_dev.exists() is True
+        assert self.group.get_l2_network_device(
+            name='test_l2_net_dev2').uuid is None
+
+    def _add_node(self, name, mac_address):
+        node = self.group.add_node(name=name, role='default')
+        return node.add_interface(
+            label='eth0',
+            l2_network_device_name='test_l2_net_dev',
+            interface_model='virtio',
+            mac_address=mac_address)
+
+    def test_add_dhcp_hosts(self):
+        self.ap.ip_range_set('dhcp', '172.0.0.100', '172.0.0.200')
+        self.l2_net_dev.dhcp = True
+        self.l2_net_dev.save()
+        self.l2_net_dev.define()
+        self.l2_net_dev.start()
+
+        # address is added to the running network and to its config
+        self._add_node('test_node', '64:b6:87:44:14:17')
+
+        host = ("<host mac='64:b6:87:44:14:17' name='test_node' "
+                "ip='172.0.0.100'/>")
+        net = self.l2_net_dev._libvirt_network
+        assert host in net.XMLDesc(0)
+        assert host in net.XMLDesc(libvirt.VIR_NETWORK_XML_INACTIVE)
+
+        # existing hosts are skipped
+        self.l2_net_dev.add_dhcp_hosts([dict(
+            mac='64:b6:87:44:14:17', ip='172.0.0.100', name='test_node')])
+        assert net.XMLDesc(0).count('<host ') == 1
+
+    def test_add_dhcp_hosts_not_defined(self):
+        self.l2_net_dev.dhcp = True
+        self.l2_net_dev.save()
+
+        with mock.patch.object(LibvirtL2NetworkDevice,
+                               'add_dhcp_hosts') as add_dhcp_hosts_mock:
+            self._add_node('test_node', '64:b6:87:44:14:17')
+
+        assert not add_dhcp_hosts_mock.called
+
+    def test_dhcp_hosts_batch(self):
+        self.l2_net_dev.dhcp = True
+        self.l2_net_dev.save()
+        self.l2_net_dev.define()
+
+        with mock.patch.object(LibvirtL2NetworkDevice,
+                               'add_dhcp_hosts') as add_dhcp_hosts_mock:
+            with self.d.dhcp_hosts_batch():
+                with self.d.dhcp_hosts_batch():
+                    self._add_node('test_node1', '64:b6:87:44:14:17')
+                self._add_node('test_node2', '64:b6:87:44:14:18')
+                assert not add_dhcp_hosts_mock.called
+
+        add_dhcp_hosts_mock.assert_called_once_with([
+            dict(mac='64:b6:87:44:14:17', ip='172.0.0.2', name='test_node1'),
+            dict(mac='64:b6:87:44:14:18', ip='172.0.0.3', name='test_node2'),
+        ])
@@ -0,0 +1,168 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from devops.driver.libvirt import libvirt_memory_files
+
+
+class TestMemoryFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.memory_files = libvirt_memory_files.MemoryFiles(
+            self.path, compression='gzip')
+
+    def write_memory_file(self, name, data=b'memory' * 1000, age=0):
+        memory_file = os.path.join(self.path, 'snapshot-memory-' + name)
+        with open(memory_file, 'wb') as f:
+            f.write(data)
+        if age:
+            mtime = time.time() - age
+            os.utime(memory_file, (mtime, mtime))
+        return memory_file
+
+    def test_no_compression(self):
+        memory_files = libvirt_memory_files.MemoryFiles(self.path)
+        memory_file = self.write_memory_file('env_node.snap')
+
+        assert memory_files.compress(memory_file) == memory_file
+        assert os.listdir(self.path) == ['snapshot-memory-env_node.snap']
+        with memory_files.uncompressed(memory_file) as path:
+            assert path == memory_file
+        assert os.path.exists(memory_file)
+
+    def test_compress(self):
+        memory_file = self.write_memory_file('env_node.snap')
+
+        compressed_file = self.memory_files.compress(memory_file)
+        assert compressed_file == memory_file + '.gz'
+        assert not os.path.exists(memory_file)
+        assert os.path.getsize(compressed_file) < 6000
+        assert libvirt_memory_files.MemoryFiles.exists(memory_file)
+
+        with self.memory_files.uncompressed(memory_file) as path:
+            assert path == memory_file
+            with open(path, 'rb') as f:
+                assert f.read() == b'memory' * 1000
+        assert not os.path.exists(memory_file)
+        assert os.path.exists(compressed_file)
+
+    def test_dedup(self):
+        file1 = self.memory_files.compress(
+            self.write_memory_file('env_node1.snap'))
+        file2 = self.memory_files.compress(
+            self.write_memory_file('env_node2.snap'))
+        file3 = self.memory_files.compress(
+            self.write_memory_file('env_node3.snap', data=b'other'))
+
+        assert os.path.samefile(file1, file2)
+        assert not os.path.samefile(file1, file3)
+        assert len(os.listdir(self.memory_files.objects_path)) == 2
+
+    def test_collect_garbage(self):
+        used = self.write_memory_file('env_node1.snap', age=7200)
+        unused = self.write_memory_file('env_node2.snap', age=7200)
+        recent = self.write_memory_file('env_node3.snap')
+        compressed_used = self.memory_files.compress(
+            self.write_memory_file('env_node4.snap', age=7200))
+        compressed_unused = self.memory_files.compress(
+            self.write_memory_file('env_node5.snap', age=7200,
+                                   data=b'other'))
+        os.utime(compressed_unused, (time.time() - 7200,) * 2)
+        objects = os.listdir(self.memory_files.objects_path)
+        assert len(objects) == 2
+
+        referenced = [used, compressed_used[:-len('.gz')]]
+        garbage = self.memory_files.collect_garbage(referenced, dry_run=True)
+        unused_object = [
+            os.path.join(self.memory_files.objects_path, name)
+            for name in objects
+            if os.path.samefile(
+                os.path.join(self.memory_files.objects_path, name),
+                compressed_unused)]
+        assert sorted(garbage) == sorted(
+            [unused, compressed_unused] + unused_object)
+        assert os.path.exists(unused)
+
+        assert self.memory_files.collect_garbage(referenced) == garbage
+        assert not os.path.exists(unused)
+        assert not os.path.exists(compressed_unused)
+        assert os.path.exists(used)
+        assert os.path.exists(recent)
+        assert os.path.exists(compressed_used)
+        assert len(os.listdir(self.memory_files.objects_path)) == 1
+
+    def test_collect_garbage_keeps_recent_objects(self):
+        compressed = self.memory_files.compress(
+            self.write_memory_file('env_node1.snap'))
+        old = time.time() - 7200
+        os.utime(compressed, (old, old))
+        os.remove(compressed)
+        # object of a snapshot in progress which is not linked yet
+        os.remove(self.memory_files.compress(
+            self.write_memory_file('env_node2.snap', data=b'other')))
+
+        garbage = self.memory_files.collect_garbage([])
+        assert len(garbage) == 1
+        assert len(os.listdir(self.memory_files.objects_path)) == 1
+
+    def test_dedup_refreshes_object(self):
+        compressed = self.memory_files.compress(
+            self.write_memory_file('env_node1.snap'))
+        old = time.time() - 7200
+        os.utime(compressed, (old, old))
+        os.remove(compressed)
+
+        self.memory_files.compress(self.write_memory_file('env_node2.snap'))
+        assert self.memory_files.collect_garbage([]) == []
+
+    def test_collect_garbage_of_environments(self):
+        own = self.write_memory_file('env1_node.snap', age=7200)
+        other = self.write_memory_file('env2_node.snap', age=7200)
+
+        garbage = self.memory_files.collect_garbage([], prefixes=['env1_'])
+        assert garbage == [own]
+        assert os.path.exists(other)
+
+    def test_unmanaged_domain_snapshot(self):
+        referenced = self.write_memory_file('env1_manual.snap', age=7200)
+        unused = self.write_memory_file('env1_node.snap', age=7200)
+
+        snap = mock.Mock()
+        snap.getXMLDesc.return_value = (
+            '<domainsnapshot><name>manual</name>'
+            '<memory snapshot="external" file="{}"/>'
+            '</domainsnapshot>'.format(referenced))
+        internal_snap = mock.Mock()
+        internal_snap.getXMLDesc.return_value = (
+            '<domainsnapshot><memory snapshot="internal"/></domainsnapshot>')
+        # domain defined by hand, it is unknown to devops
+        domain = mock.Mock()
+        domain.listAllSnapshots.return_value = [snap, internal_snap]
+        conn = mock.Mock()
+        conn.listAllDomains.return_value = [domain]
+
+        memory_files = libvirt_memory_files.list_snapshot_memory_files(conn)
+        assert memory_files == {referenced}
+        assert self.memory_files.collect_garbage(
+            memory_files, prefixes=['env1_']) == [unused]
+        assert os.path.exists(referenced)
@@ -205,14 +205,47 @@ class TestLibvirtNode(LibvirtTestCase):
         with mock.patch('libvirt.virDomain.sendKey') as send_key:
             send_key.return_value = 0
             self.node.send_keys('123<Wait>\n<Enter>')
-            send_key.assert_has_calls([
-                mock.call(0, 0, [2], 1, 0),
-                mock.call(0, 0, [3], 1, 0),
-                mock.call(0, 0, [4], 1, 0),
+            assert send_key.mock_calls == [
+                mock.call(0, 0, [2, 3, 4], 3, 0),
                 mock.call(0, 0, [28], 1, 0),
-            ])
+            ]
             self.sleep_mock.assert_called_once_with(1)
 
+    def test_send_keys_not_batched(self):
+        self.node.define()
+        self.node.start()
+
+        with self.settings(SEND_KEYS_BATCH_SIZE=1, SEND_KEYS_HOLD_TIME=50):
+            with mock.patch('libvirt.virDomain.sendKey') as send_key:
+                send_key.return_value = 0
+                self.node.send_keys('12A')
+                assert send_key.mock_calls == [
+                    mock.call(0, 50, [2], 1, 0),
+                    mock.call(0, 50, [3], 1, 0),
+                    mock.call(0, 50, [42, 30], 2, 0),
+                ]
+
+    @mock.patch('devops.driver.libvirt.libvirt_driver.time.time')
+    @mock.patch(
+        'devops.driver.libvirt.libvirt_driver.LibvirtNode.get_screenshot_hash')
+    def test_send_keys_wait_screen(self, hash_mock, time_mock):
+        self.node.define()
+        self.node.start()
+        # every screenshot takes 0.25s
+        time_mock.side_effect = lambda: hash_mock.call_count * 0.25
+        # screen is changed by the first keys and settles,
+        # but it is not changed by the last keys until the timeout
+        hash_mock.side_effect = ['boot', 'boot', 'typed', 'menu', 'menu',
+                                 'menu', 'menu', 'menu', 'menu']
+
+        with mock.patch('libvirt.virDomain.sendKey') as send_key:
+            send_key.return_value = 0
+            self.node.send_keys('12<Wait>3<Wait>', wait_screen=True)
+            assert send_key.call_count == 2
+
+        assert hash_mock.call_count == 9
+        assert self.sleep_mock.mock_calls == [mock.call(0.1)] * 6
+
     def test_start_reboot(self):
         self.node.define()
         assert self.node.is_active() is False
@@ -253,6 +286,64 @@ class TestLibvirtNode(LibvirtTestCase):
         assert self.node.is_active() is True
         assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_RUNNING
 
+    def test_get_nodes_state(self):
+        self.node.define()
+        state = self.d.get_nodes_state([self.node])['test_node']
+        assert state.active is False
+        assert state.status == 'shutoff'
+
+        self.node.start()
+        state = self.d.get_nodes_state([self.node])['test_node']
+        assert state.active is True
+        assert state.paused is False
+        assert state.status == 'running'
+        assert state.domain.UUIDString() == self.node.uuid
+
+    def test_get_nodes_state_requests_state_only(self):
+        stats_mock = self.patch('libvirt.virConnect.getAllDomainStats',
+                                return_value=[])
+        self.d.get_nodes_state([self.node])
+        stats_mock.assert_called_once_with(
+            libvirt.VIR_DOMAIN_STATS_STATE, 0)
+
+    def test_get_nodes_state_no_stats_support(self):
+        err = libvirt.libvirtError('unsupported')
+        err.get_error_code = mock.Mock(return_value=libvirt.VIR_ERR_NO_SUPPORT)
+        self.patch('libvirt.virConnect.getAllDomainStats', side_effect=err)
+
+        self.node.define()
+        self.node.start()
+        self.node.suspend()
+        state = self.d.get_nodes_state([self.node])['test_node']
+        assert state.active is True
+        assert state.paused is True
+        assert state.status == 'paused'
+
+    def test_get_nodes_vnc_ports(self):
+        other_node = self.group.add_node(
+            name='other_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        self.node.define()
+
+        ports = self.d.get_nodes_vnc_ports([self.node, other_node])
+        assert ports == {'test_node': '-1', 'other_node': None}
+        assert self.group.get_nodes_vnc_ports() == [
+            (self.node, '-1'), (other_node, None)]
+
+    def test_group_suspend_resume_nodes(self):
+        self.node.define()
+        self.node.start()
+
+        self.group.suspend_nodes()
+        assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_PAUSED
+        assert self.group.get_active_nodes() == [self.node]
+
+        self.group.resume_nodes()
+        assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_RUNNING
+
     def test_get_target_dev(self):
         self.node.define()
         assert self.node.get_interface_target_dev(
@@ -319,6 +319,61 @@ class TestLibvirtNodeSnapshot(TestLibvirtNodeSnapshotBase):
         assert self.node.is_active() is True
         assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_RUNNING
 
+    def test_revert_running(self):
+        self.node.start()
+        self.node.suspend()
+        self.node.snapshot(name='test1')
+
+        self.node.revert(name='test1', resume=True)
+        assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_RUNNING
+
+    @mock.patch('devops.helpers.ssh_client.SSHClient.close_connections')
+    def test_revert_nodes(self, close_mock):
+        self.interface.address_set.create(ip_address='172.0.0.10')
+        self.node.start()
+        self.node.suspend()
+        self.node.snapshot(name='test1')
+
+        self.libvirt_nwfilter_define_mock.reset_mock()
+        timings = self.d.revert_nodes([self.node], 'test1')
+        assert list(timings) == ['unblock', 'revert', 'resume', 'ssh']
+        assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_RUNNING
+        # filter of the interface is blocked
+        assert self.libvirt_nwfilter_define_mock.call_count == 1
+        close_mock.assert_called_once_with(hostname='172.0.0.10')
+
+        # nothing is blocked now
+        self.libvirt_nwfilter_define_mock.reset_mock()
+        self.d.revert_nodes([self.node], 'test1', resume=False)
+        assert self.libvirt_nwfilter_define_mock.called is False
+        assert self.node._libvirt_node.info()[0] == libvirt.VIR_DOMAIN_PAUSED
+
+    def test_revert_nodes_resumes_after_all_reverts(self):
+        node2 = self.group.add_node(
+            name='tnode2',
+            role='default',
+            architecture='i686',
+            hypervisor='test',
+        )
+        node2.define()
+        nodes = [self.node, node2]
+        for nod in nodes:
+            nod.start()
+            nod.snapshot(name='test1')
+
+        calls = mock.Mock()
+        revert_mock = self.patch('libvirt.virDomain.revertToSnapshot')
+        resume_mock = self.patch('libvirt.virDomain.resume')
+        calls.attach_mock(revert_mock, 'revert')
+        calls.attach_mock(resume_mock, 'resume')
+
+        self.d.revert_nodes(nodes, 'test1')
+
+        assert [name for name, _, _ in calls.mock_calls] == [
+            'revert', 'revert', 'resume', 'resume']
+        for _, args, _ in calls.mock_calls[:2]:
+            assert args[1] == libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_PAUSED
+
 
 @pytest.mark.xfail(reason="need libvirtd >= 1.2.12")
 class TestLibvirtNodeExternalSnapshot(TestLibvirtNodeSnapshotBase):
@@ -1284,3 +1339,117 @@ class TestLibvirtNodeExternalSnapshot(TestLibvirtNodeSnapshotBase):
                       (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REDEFINE |
                        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_CURRENT)),
         ])
+
+    def test_snapshot_index(self):
+        for name in ('test1', 'test2'):
+            self.snap_xmls_dict[name] = (
+                '<domainsnapshot>\n'
+                '    <name>{0}</name>\n'
+                '    <memory snapshot="no" />\n'
+                '    <disks>\n'
+                '        <disk name="sda" snapshot="external" >\n'
+                '            <source file="/default-pool'
+                '/tenv_tnode_tvol.{0}" />\n'
+                '        </disk>\n'
+                '    </disks>\n'
+                '    <domain>\n'
+                '        <cpu mode="host-model" />\n'
+                '    </domain>\n'
+                '</domainsnapshot>'.format(name))
+
+        self.node.snapshot(name='test1', external=True)
+        self.node.snapshot(name='test2', external=True)
+
+        index = self.node.get_snapshot_index()
+        assert index.current == 'test2'
+        assert index.get_parent('test2') == 'test1'
+        assert index.get_children('test1') == ['test2']
+
+        volume = self.node.disk_devices[0].volume
+        assert volume.name == 'tvol.test2'
+        assert index.get_volume_chain(volume.id) == ('tvol', 2)
+
+        # index is rebuilt from libvirt snapshots and volumes
+        snap1_mock = self.snap_mocks_dict['test1']
+        snap1_mock.getName.return_value = 'test1'
+        no_parent = libvirt.libvirtError('no parent')
+        no_parent.get_error_code = mock.Mock(
+            return_value=libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT)
+        snap1_mock.getParent.side_effect = no_parent
+        snap2_mock = self.snap_mocks_dict['test2']
+        snap2_mock.getName.return_value = 'test2'
+        snap2_mock.getParent.return_value = snap1_mock
+        with mock.patch('libvirt.virDomain.listAllSnapshots') as list_mock,\
+                mock.patch('libvirt.virDomain.hasCurrentSnapshot') as\
+                has_current_mock,\
+                mock.patch('libvirt.virDomain.snapshotCurrent') as\
+                current_mock:
+            list_mock.return_value = [snap1_mock, snap2_mock]
+            has_current_mock.return_value = 1
+            current_mock.return_value = snap2_mock
+            self.node.snapshot_chains = None
+            index = self.node.get_snapshot_index()
+
+        assert index.current == 'test2'
+        assert index.get_children('test1') == ['test2']
+        assert index.get_volume_chain(volume.id) == ('tvol', 2)
+
+    def test_flatten_snapshot_chains(self):
+        for name in ('test1', 'test2'):
+            self.snap_xmls_dict[name] = (
+                '<domainsnapshot>\n'
+                '    <name>{0}</name>\n'
+                '    <memory snapshot="no" />\n'
+                '    <disks>\n'
+                '        <disk name="sda" snapshot="external" >\n'
+                '            <source file="/default-pool'
+                '/tenv_tnode_tvol.{0}" />\n'
+                '        </disk>\n'
+                '    </disks>\n'
+                '    <domain>\n'
+                '        <cpu mode="host-model" />\n'
+                '    </domain>\n'
+                '</domainsnapshot>'.format(name))
+        self.node.snapshot(name='test1', external=True)
+        self.node.snapshot(name='test2', external=True)
+        volume = self.node.disk_devices[0].volume
+
+        assert self.node.flatten_snapshot_chains(max_length=2) == []
+
+        # offline
+        shell_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtDriver.shell')
+        assert self.node.flatten_snapshot_chains() == [volume]
+        shell_mock.check_call.assert_called_once_with(
+            'sudo qemu-img rebase -f qcow2 -b /default-pool/tenv_tnode_tvol '
+            '-F qcow2 /default-pool/tenv_tnode_tvol.test2', timeout=3600)
+
+        index = self.node.get_snapshot_index()
+        assert index.get_volume_chain(volume.id) == ('tvol', 2)
+        assert index.get_chain_length(volume.id) == 1
+        # database keeps the volume the snapshot is based on
+        assert volume.backing_store.name == 'tvol.test1'
+
+        # online
+        index.set_chain_length(volume.id, 2)
+        self.node.save()
+        self.node.start()
+        with mock.patch('libvirt.virDomain.blockRebase') as rebase_mock,\
+                mock.patch('libvirt.virDomain.blockJobInfo') as info_mock:
+            info_mock.side_effect = [{'cur': 1, 'end': 2}, {}]
+            assert self.node.flatten_snapshot_chains() == [volume]
+
+        rebase_mock.assert_called_once_with(
+            'sda', '/default-pool/tenv_tnode_tvol', 0, 0)
+        assert info_mock.call_count == 2
+
+    def test_wait_block_job_timeout(self):
+        self.node.start()
+        time_mock = self.patch('time.time')
+        time_mock.side_effect = [0, 1, 2]
+        with mock.patch('libvirt.virDomain.blockJobInfo') as info_mock,\
+                mock.patch('libvirt.virDomain.blockJobAbort') as abort_mock:
+            info_mock.return_value = {'cur': 1, 'end': 2}
+            with self.assertRaises(DevopsError):
+                self.node.wait_block_job('sda', timeout=1)
+        abort_mock.assert_called_once_with('sda', 0)
@@ -0,0 +1,162 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import libvirt
+import mock
+import pytest
+
+from devops.driver.libvirt import libvirt_nwfilters
+from devops import error
+from devops.models import Environment
+from devops.tests.driver.libvirt.base import LibvirtTestCase
+
+
+class TestNWFilterStates(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.filters = {
+            'net1': self.create_filter('uuid1', blocked=False),
+            'net2': self.create_filter('uuid2', blocked=True),
+            'net3': self.create_filter('uuid3', blocked=False),
+        }
+        self.conn.nwfilterLookupByName.side_effect = self.lookup
+        self.states = libvirt_nwfilters.NWFilterStates(self.conn)
+
+        self.build_xml = mock.Mock(
+            side_effect=lambda uuid, blocked: '{0}:{1}'.format(uuid, blocked))
+        self.build_xmls = {name: self.build_xml for name in self.filters}
+
+    @staticmethod
+    def create_filter(uuid, blocked):
+        nwfilter = mock.Mock()
+        nwfilter.UUIDString.return_value = uuid
+        nwfilter.XMLDesc.return_value = (
+            '<filter name="test">{}</filter>'.format(
+                '<rule action="drop"><all/></rule>' if blocked else ''))
+        return nwfilter
+
+    def lookup(self, name):
+        if name not in self.filters:
+            e = libvirt.libvirtError('nwfilter not found')
+            e.get_error_code = mock.Mock(
+                return_value=libvirt.VIR_ERR_NO_NWFILTER)
+            raise e
+        return self.filters[name]
+
+    def test_get(self):
+        states = self.states.get(['net1', 'net2'])
+        assert states['net1'].uuid == 'uuid1'
+        assert states['net1'].blocked is False
+        assert states['net2'].blocked is True
+
+        self.states.get(['net1', 'net2'])
+        assert self.conn.nwfilterLookupByName.call_count == 2
+
+        self.states.forget(['net1'])
+        self.states.get(['net1', 'net2'])
+        assert self.conn.nwfilterLookupByName.call_count == 3
+
+    def test_set_blocked(self):
+        changed = self.states.set_blocked(self.build_xmls, blocked=True)
+
+        assert changed == ['net1', 'net3']
+        self.conn.nwfilterDefineXML.assert_has_calls([
+            mock.call('uuid1:True'),
+            mock.call('uuid3:True'),
+        ], any_order=True)
+        assert self.conn.nwfilterDefineXML.call_count == 2
+
+        # state is cached, nothing to do
+        self.conn.reset_mock()
+        assert self.states.set_blocked(self.build_xmls, blocked=True) == []
+        assert not self.conn.nwfilterLookupByName.called
+        assert not self.conn.nwfilterDefineXML.called
+
+        assert self.states.set_blocked(
+            self.build_xmls, blocked=False) == ['net1', 'net2', 'net3']
+        assert not self.conn.nwfilterLookupByName.called
+
+    def test_missing(self):
+        self.build_xmls['net4'] = self.build_xml
+
+        with pytest.raises(error.DevopsError):
+            self.states.set_blocked(self.build_xmls, blocked=True)
+        assert not self.conn.nwfilterDefineXML.called
+
+        changed = self.states.set_blocked(
+            self.build_xmls, blocked=True, missing_ok=True)
+        assert changed == ['net1', 'net3']
+
+    def test_define_failure(self):
+        self.states.get(['net1', 'net2', 'net3'])
+        self.conn.nwfilterDefineXML.side_effect = ValueError
+
+        with pytest.raises(ValueError):
+            self.states.set_blocked(self.build_xmls, blocked=True)
+
+        # states of filters which could be changed are requested again
+        self.conn.reset_mock()
+        self.states.get(['net1', 'net2', 'net3'])
+        assert self.conn.nwfilterLookupByName.call_count == 2
+
+
+class TestLibvirtDriverSetBlocked(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestLibvirtDriverSetBlocked, self).setUp()
+
+        nwfilter = self.libvirt_nwfilter_lookup_mock.return_value
+        nwfilter.XMLDesc.return_value = '<filter name="test"/>'
+        nwfilter.UUIDString.return_value = (
+            'e3db79b5-717c-4b15-9198-ecad569c1ea2')
+
+        self.env = Environment.create('tenv')
+        self.group = self.env.add_group(
+            group_name='test_group',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            enable_nwfilters=True)
+        self.l2_net_devs = [
+            self.group.add_l2_network_device(name='net1'),
+            self.group.add_l2_network_device(name='net2'),
+        ]
+        self.d = self.group.driver
+
+    def test_set_blocked(self):
+        self.d.set_blocked(self.l2_net_devs, blocked=True)
+
+        assert self.libvirt_nwfilter_lookup_mock.call_count == 2
+        self.libvirt_nwfilter_define_mock.assert_has_calls([
+            mock.call(
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<filter name="tenv_{}">\n'
+                '    <uuid>e3db79b5-717c-4b15-9198-ecad569c1ea2</uuid>\n'
+                '    <rule action="drop" direction="inout" '
+                'priority="-1000">\n'
+                '        <all/>\n'
+                '    </rule>\n'
+                '</filter>\n'.format(name))
+            for name in ('net1', 'net2')], any_order=True)
+
+        self.libvirt_nwfilter_lookup_mock.reset_mock()
+        self.libvirt_nwfilter_define_mock.reset_mock()
+        self.l2_net_devs[0].block()
+        assert not self.libvirt_nwfilter_lookup_mock.called
+        assert not self.libvirt_nwfilter_define_mock.called
+
+        self.l2_net_devs[0].unblock()
+        assert self.libvirt_nwfilter_define_mock.call_count == 1
@@ -0,0 +1,116 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import unittest
+
+from devops.driver.libvirt import libvirt_snapshot_index
+
+
+class TestSnapshotIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = libvirt_snapshot_index.SnapshotIndex.build(
+            snapshots=[
+                ('test1', None),
+                ('test2', 'test1'),
+                ('test1-revert', 'test1'),
+                ('test3', 'test1-revert'),
+                ('test1-revert0', 'test1'),
+            ],
+            current='test1-revert0',
+            volumes=[
+                (1, 'tvol', None),
+                (2, 'tvol.test1', 1),
+                (3, 'tvol.test2', 2),
+                (4, 'tvol.test1-revert', 1),
+                (5, 'tvol.test3', 4),
+                (6, 'base', None),
+                (7, 'base.test1', 6),
+                (8, 'other', 100),
+            ])
+
+    def test_revert_name(self):
+        assert libvirt_snapshot_index.revert_name('test1', 0) == (
+            'test1-revert')
+        assert libvirt_snapshot_index.revert_name('test1', 1) == (
+            'test1-revert0')
+        assert libvirt_snapshot_index.revert_name('test1', 3) == (
+            'test1-revert2')
+
+    def test_build(self):
+        assert self.index.current == 'test1-revert0'
+        assert self.index.get_parent('test1') is None
+        assert self.index.get_children('test1') == [
+            'test2', 'test1-revert', 'test1-revert0']
+        assert self.index.get_children('test1-revert') == ['test3']
+        assert self.index.data['reverts'] == {'test1': 2}
+
+        assert self.index.get_volume_chain(1) == ('tvol', 0)
+        assert self.index.get_volume_chain(3) == ('tvol', 2)
+        assert self.index.get_volume_chain(5) == ('tvol', 2)
+        assert self.index.get_volume_chain(7) == ('base', 1)
+        assert self.index.get_root_id(5) == 1
+        assert self.index.get_chain_length(5) == 2
+        # backing store is unknown
+        assert self.index.get_volume_chain(8) is None
+
+    def test_data_is_serializable(self):
+        data = json.loads(json.dumps(self.index.data))
+        index = libvirt_snapshot_index.SnapshotIndex(data)
+        assert index.get_volume_chain(3) == ('tvol', 2)
+        assert index.get_revert_names('test1') == [
+            'test1-revert', 'test1-revert0']
+
+    def test_volumes(self):
+        assert self.index.add_volume(9, 'tvol', 3, root_id=1) == ('tvol', 3)
+        assert self.index.get_volume_chain(9) == ('tvol', 3)
+        assert self.index.get_root_id(9) == 1
+        assert self.index.get_chain_length(9) == 3
+
+        self.index.set_chain_length(9, 1)
+        assert self.index.get_volume_chain(9) == ('tvol', 3)
+        assert self.index.get_chain_length(9) == 1
+
+        self.index.remove_volume(9)
+        assert self.index.get_volume_chain(9) is None
+
+    def test_add_remove_snapshot(self):
+        self.index.add_snapshot('test4', parent=self.index.current)
+        self.index.current = 'test4'
+        assert self.index.get_children('test1-revert0') == ['test4']
+
+        self.index.remove_snapshot('test4')
+        assert not self.index.has_snapshot('test4')
+        assert self.index.get_children('test1-revert0') == []
+        assert self.index.current == 'test1-revert0'
+
+        # children are moved to the parent
+        self.index.remove_snapshot('test1-revert')
+        assert self.index.get_children('test1') == [
+            'test2', 'test1-revert0', 'test3']
+        assert self.index.get_parent('test3') == 'test1'
+
+    def test_reverts(self):
+        assert self.index.get_revert_names('test1') == [
+            'test1-revert', 'test1-revert0']
+        assert self.index.get_revert_names('test2') == []
+
+        assert self.index.add_revert('test1') == 'test1-revert1'
+        assert self.index.add_revert('test2') == 'test2-revert'
+        self.index.add_snapshot('test2-revert', parent='test2')
+        assert self.index.get_revert_names('test2') == ['test2-revert']
+
+        self.index.remove_snapshot('test1-revert')
+        assert self.index.get_revert_names('test1') == ['test1-revert0']
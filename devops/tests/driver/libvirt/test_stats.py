@@ -0,0 +1,190 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import libvirt
+import mock
+
+from devops.driver.libvirt import libvirt_driver
+from devops.driver.libvirt import libvirt_stats
+from devops.models import Environment
+from devops.tests.driver.libvirt.base import LibvirtTestCase
+
+
+def make_state(cpu_time, rd_reqs, wr_bytes, rx_bytes):
+    return libvirt_driver.DomainState(mock.Mock(), {
+        'state.state': libvirt.VIR_DOMAIN_RUNNING,
+        'cpu.time': cpu_time,
+        'vcpu.current': 2,
+        'balloon.current': 1048576,
+        'block.count': 2,
+        'block.0.rd.reqs': rd_reqs,
+        'block.1.wr.bytes': wr_bytes,
+        'net.count': 1,
+        'net.0.rx.bytes': rx_bytes,
+    })
+
+
+class TestStatsRates(unittest.TestCase):
+
+    def test_make_sample(self):
+        sample = libvirt_stats.make_sample(
+            make_state(10 ** 9, 5, 1024, 2048), 100.0)
+        assert sample == libvirt_stats.StatsSample(
+            timestamp=100.0, cpu_time=10 ** 9, vcpu=2, memory=1048576,
+            rd_reqs=5, wr_reqs=0, rd_bytes=0, wr_bytes=1024,
+            rx_bytes=2048, tx_bytes=0)
+
+    def test_get_rates(self):
+        prev = libvirt_stats.make_sample(make_state(0, 0, 0, 0), 100.0)
+        last = libvirt_stats.make_sample(
+            make_state(2 * 10 ** 9, 400, 8 * 1024 ** 2, 1024 ** 2), 102.0)
+        rates = libvirt_stats.get_rates(prev, last)
+        assert rates.cpu == 50.0
+        assert rates.memory == 1024
+        assert rates.iops == 200.0
+        assert rates.read_mbps == 0
+        assert rates.write_mbps == 4.0
+        assert rates.rx_mbps == 0.5
+        assert rates.tx_mbps == 0
+
+    def test_get_rates_counters_reset(self):
+        prev = libvirt_stats.make_sample(make_state(10 ** 9, 9, 9, 9), 100.0)
+        last = libvirt_stats.make_sample(make_state(0, 0, 0, 0), 101.0)
+        rates = libvirt_stats.get_rates(prev, last)
+        assert rates.cpu == 0
+        assert rates.iops == 0
+
+    def test_get_rates_same_timestamp(self):
+        sample = libvirt_stats.make_sample(make_state(0, 0, 0, 0), 100.0)
+        assert libvirt_stats.get_rates(sample, sample) is None
+
+
+class TestStatsCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = mock.Mock()
+        self.driver.get_domains_state.side_effect = [
+            {'uuid1': make_state(i * 10 ** 9, i, i, i),
+             'uuid2': make_state(0, 0, 0, 0)}
+            for i in range(5)]
+        self.collector = libvirt_stats.StatsCollector(
+            self.driver, interval=1, size=3)
+
+    def test_ring_buffer(self):
+        for _ in range(5):
+            self.collector.sample()
+        samples = self.collector.get_samples('uuid1')
+        assert len(samples) == 3
+        assert [s.rd_reqs for s in samples] == [2, 3, 4]
+        assert len(self.collector.get_history('uuid1')) == 2
+
+    def test_sample_requests_usage_stats(self):
+        self.collector.sample()
+        self.driver.get_domains_state.assert_called_once_with(
+            self.driver.domain_stats)
+
+    def test_sample_filter_uuids(self):
+        self.collector.sample(uuids={'uuid1'})
+        self.collector.sample(uuids={'uuid1'})
+        assert len(self.collector.get_samples('uuid1')) == 2
+        assert self.collector.get_samples('uuid2') == []
+        assert self.collector.get_rates('uuid2') is None
+
+    def test_get_rates_one_sample(self):
+        self.collector.sample()
+        assert self.collector.get_rates('uuid1') is None
+
+
+class TestLibvirtNodesStats(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestLibvirtNodesStats, self).setUp()
+
+        self.sleep_mock = self.patch('time.sleep')
+
+        self.env = Environment.create('test_env')
+        self.group = self.env.add_group(
+            group_name='test_group',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool')
+        self.d = self.group.driver
+        self.node = self.group.add_node(
+            name='test_node',
+            role='default',
+            architecture='i686',
+            hypervisor='test')
+
+        self.node.define()
+        self.node.start()
+
+    def tearDown(self):
+        libvirt_stats.StatsCollectors.collectors.clear()
+        super(TestLibvirtNodesStats, self).tearDown()
+
+    def test_get_nodes_stats(self):
+        time_mock = self.patch('devops.driver.libvirt.libvirt_stats.time')
+        time_mock.time.side_effect = [100.0, 103.0]
+
+        stats = self.env.get_nodes_stats(interval=3)
+        self.sleep_mock.assert_called_once_with(3)
+        assert len(stats) == 1
+        nod, rates = stats[0]
+        assert nod == self.node
+        assert rates.cpu >= 0
+        assert len(self.d.stats_collector.get_samples(self.node.uuid)) == 2
+
+    def test_get_nodes_stats_of_groups(self):
+        group2 = self.env.add_group(
+            group_name='test_group2',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool')
+        node2 = group2.add_node(
+            name='test_node2',
+            role='default',
+            architecture='i686',
+            hypervisor='test')
+        node2.define()
+        node2.start()
+        time_mock = self.patch('devops.driver.libvirt.libvirt_stats.time')
+        time_mock.time.side_effect = [100.0, 100.0, 105.0, 105.0]
+
+        stats = self.env.get_nodes_stats()
+        self.sleep_mock.assert_called_once_with(5)
+        assert [nod for nod, rates in stats] == [self.node, node2]
+        assert all(rates is not None for nod, rates in stats)
+
+    def test_get_nodes_stats_collector_running(self):
+        time_mock = self.patch('devops.driver.libvirt.libvirt_stats.time')
+        time_mock.time.side_effect = [100.0, 105.0]
+        self.d.stats_collector.sample()
+        self.d.stats_collector.sample()
+        with mock.patch.object(libvirt_stats.StatsCollector, 'is_running',
+                               new_callable=mock.PropertyMock,
+                               return_value=True):
+            stats = self.env.get_nodes_stats(interval=3)
+        self.sleep_mock.assert_not_called()
+        assert stats[0][1] is not None
+
+    def test_collector_shared_per_connection(self):
+        grp = self.env.get_group(name='test_group')
+        assert grp.driver is not self.d
+        assert grp.driver.stats_collector is self.d.stats_collector
+
+        grp.driver.stats_interval = 1
+        assert grp.driver.stats_collector is not self.d.stats_collector
+        assert grp.driver.stats_collector.interval == 1
@@ -13,10 +13,15 @@
 #    under the License.
 
 import collections
+import os
+import shutil
+import tempfile
 
+import libvirt
 import mock
 import pytest
 
+from devops.driver.libvirt import libvirt_driver
 from devops.models import Environment
 from devops.tests.driver.libvirt.base import LibvirtTestCase
 
@@ -34,10 +39,14 @@ class TestLibvirtVolume(LibvirtTestCase):
 
         self.os_mock = self.patch('devops.helpers.helpers.os')
         # noinspection PyPep8Naming
-        Size = collections.namedtuple('Size', ['st_size'])
+        Size = collections.namedtuple('Size', ['st_size', 'st_blocks'])
         self.file_sizes = {
-            '/tmp/admin.iso': Size(st_size=5 * 1024 ** 3),
-            '/tmp/admin2.iso': Size(st_size=6442000000),
+            '/tmp/admin.iso': Size(st_size=5 * 1024 ** 3,
+                                   st_blocks=5 * 1024 ** 3 // 512),
+            '/tmp/admin2.iso': Size(st_size=6442000000,
+                                    st_blocks=6442000000 // 512),
+            '/tmp/sparse.qcow2': Size(st_size=5 * 1024 ** 3,
+                                      st_blocks=1024),
         }
         self.os_mock.stat.side_effect = self.file_sizes.get
 
@@ -191,3 +200,111 @@ class TestLibvirtVolume(LibvirtTestCase):
         volume.upload('/tmp/admin2.iso')
         self.libvirt_vol_resize_mock.assert_called_once_with(6442000000)
         assert volume.capacity is None
+
+    @pytest.mark.skipif(
+        not libvirt_driver.LibvirtVolume.sparse_upload_supported(),
+        reason="need libvirt >= 3.4 with sparse streams")
+    def test_upload_sparse(self):
+        sparse_snd_mock = self.patch('libvirt.virStream.sparseSendAll')
+        volume = self.node.add_volume(
+            name='test_volume',
+            source_image='/tmp/admin.iso',
+        )
+        volume.define()
+        self.libvirt_vol_up_mock.reset_mock()
+
+        volume.upload('/tmp/sparse.qcow2')
+        self.libvirt_vol_up_mock.assert_called_once_with(
+            flags=libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM,
+            length=5368709120, offset=0, stream=mock.ANY)
+        assert sparse_snd_mock.called is True
+        assert self.libvirt_stream_snd_mock.called is False
+
+        volume.upload('/tmp/sparse.qcow2', sparse=False)
+        self.libvirt_vol_up_mock.assert_called_with(
+            flags=0, length=5368709120, offset=0, stream=mock.ANY)
+        assert self.libvirt_stream_snd_mock.called is True
+
+    @pytest.mark.skipif(
+        not libvirt_driver.LibvirtVolume.sparse_upload_supported(),
+        reason="need libvirt >= 3.4 with sparse streams")
+    def test_upload_sparse_unsupported(self):
+        sparse_snd_mock = self.patch('libvirt.virStream.sparseSendAll')
+        volume = self.node.add_volume(
+            name='test_volume',
+            source_image='/tmp/admin.iso',
+        )
+        volume.define()
+        self.libvirt_vol_up_mock.reset_mock()
+        self.libvirt_stream_snd_mock.reset_mock()
+
+        err = libvirt.libvirtError('unsupported')
+        err.err = (libvirt.VIR_ERR_NO_SUPPORT,)
+        self.libvirt_vol_up_mock.side_effect = [err, None]
+        volume.upload('/tmp/sparse.qcow2')
+        self.libvirt_vol_up_mock.assert_has_calls((
+            mock.call(flags=libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM,
+                      length=5368709120, offset=0, stream=mock.ANY),
+            mock.call(flags=0, length=5368709120, offset=0, stream=mock.ANY),
+        ))
+        assert sparse_snd_mock.called is False
+        assert self.libvirt_stream_snd_mock.called is True
+
+    def test_upload_aborts_stream(self):
+        abort_mock = self.patch('libvirt.virStream.abort')
+        volume = self.node.add_volume(
+            name='test_volume',
+            source_image='/tmp/admin.iso',
+        )
+        volume.define()
+        self.libvirt_stream_fin_mock.reset_mock()
+
+        self.libvirt_stream_snd_mock.side_effect = libvirt.libvirtError(
+            'broken stream')
+        with pytest.raises(libvirt.libvirtError):
+            libvirt_driver.LibvirtVolume.upload_file(
+                volume.driver.conn, volume._libvirt_volume,
+                '/tmp/admin.iso', sparse=False)
+        abort_mock.assert_called_once_with()
+        assert self.libvirt_stream_fin_mock.called is False
+
+
+class TestFileStreamSource(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestFileStreamSource, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'image.raw')
+        with open(self.path, 'wb') as f:
+            f.seek(1024 ** 2)
+            f.write(b'data' * 1024)
+            f.truncate(3 * 1024 ** 2)
+
+    def test_read(self):
+        source = libvirt_driver._FileStreamSource()
+        chunks = []
+        with open(self.path, 'rb') as fd:
+            while True:
+                chunk = source.read(None, 64 * 1024, fd.fileno())
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        assert [len(c) for c in chunks] == [64 * 1024] * 48
+        assert b''.join(chunks)[1024 ** 2:1024 ** 2 + 4] == b'data'
+        assert source.sent == 3 * 1024 ** 2
+
+    @pytest.mark.skipif(not hasattr(os, 'SEEK_DATA'),
+                        reason="SEEK_DATA is not supported")
+    def test_sparse_sections(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        source = libvirt_driver._FileStreamSource()
+
+        assert source.hole(None, fd) == [False, 1024 ** 2]
+        source.skip(None, 1024 ** 2, fd)
+        in_data, length = source.hole(None, fd)
+        assert in_data is True
+        assert length >= 4096
+        assert source.read(None, 4096, fd) == b'data' * 1024
+        assert source.sent == 4096
@@ -0,0 +1,138 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+
+import mock
+import pytest
+
+from devops.driver.libvirt import libvirt_xml_builder as builder
+from devops import error
+from devops.models import Environment
+from devops.tests.driver.libvirt.base import LibvirtTestCase
+
+
+class TestLibvirtVolumePipeline(LibvirtTestCase):
+
+    def setUp(self):
+        super(TestLibvirtVolumePipeline, self).setUp()
+
+        self.sleep_mock = self.patch('time.sleep')
+
+        self.open_mock = mock.mock_open(read_data='image_data')
+        self.patch('devops.driver.libvirt.libvirt_driver.open',
+                   self.open_mock, create=True)
+
+        self.os_mock = self.patch('devops.helpers.helpers.os')
+        # noinspection PyPep8Naming
+        Size = collections.namedtuple('Size', ['st_size', 'st_blocks'])
+        self.os_mock.stat.return_value = Size(st_size=500, st_blocks=1)
+
+        self.env = Environment.create('test_env')
+        self.group = self.env.add_group(
+            group_name='test_group',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool')
+        self.d = self.group.driver
+
+        self.nodes = []
+        for i in range(3):
+            nod = self.group.add_node(
+                name='test_node{}'.format(i),
+                role='default',
+                architecture='i686',
+                hypervisor='test')
+            nod.add_volume(name='system', capacity=1,
+                           source_image='/tmp/admin.iso')
+            nod.add_volume(name='data', capacity=1)
+            self.nodes.append(nod)
+        self.empty_node = self.group.add_node(
+            name='test_node_empty',
+            role='default',
+            architecture='i686',
+            hypervisor='test')
+
+    def test_define_nodes_volumes(self):
+        nodes = list(self.d.define_nodes_volumes(self.group.get_nodes()))
+
+        assert sorted(n.name for n in nodes) == sorted(
+            n.name for n in self.nodes + [self.empty_node])
+        for nod in self.nodes:
+            for vol in nod.get_volumes():
+                assert vol.uuid
+                assert vol.serial
+                assert vol.exists()
+        assert self.libvirt_vol_up_mock.call_count == 3
+
+    def test_define_nodes(self):
+        node_define_mock = self.patch(
+            'devops.driver.libvirt.libvirt_driver.LibvirtNode.define')
+        self.group.define_nodes()
+        assert node_define_mock.call_count == 4
+
+    def test_define_volumes_backing_store(self):
+        parent = self.group.add_volume(name='parent', capacity=1)
+        child = self.group.add_volume(name='child', backing_store=parent)
+
+        self.group.define_volumes()
+
+        parent.refresh_from_db()
+        child.refresh_from_db()
+        assert parent.exists()
+        assert child.exists()
+        assert parent.get_path() in child._libvirt_volume.XMLDesc(0)
+
+    def test_define_volumes_error(self):
+        self.group.add_volume(name='broken')  # no capacity
+
+        with pytest.raises(error.DevopsError):
+            self.group.define_volumes()
+
+    def test_define_volumes_caches_images_in_workers(self):
+        group = self.env.add_group(
+            group_name='cached_group',
+            driver_name='devops.driver.libvirt',
+            connection_string='test:///default',
+            storage_pool_name='default-pool',
+            use_image_cache=True)
+        vol = group.add_volume(name='cached', format='qcow2',
+                               source_image='/tmp/admin.qcow2')
+        base_vol = group.driver.storage_pool.createXML(
+            builder.LibvirtXMLBuilder.build_volume_xml(
+                name='base', capacity=1024, vol_format='qcow2',
+                backing_store_path=None, backing_store_format=None), 0)
+
+        threads = []
+        pin = mock.Mock()
+
+        def acquire_base(cache, path, upload):
+            threads.append(threading.current_thread())
+            return base_vol, pin
+
+        self.patch(
+            'devops.driver.libvirt.libvirt_image_cache.'
+            'ImageCache.acquire_base',
+            side_effect=acquire_base, autospec=True)
+
+        group.define_volumes()
+        pin.close.assert_called_once_with()
+
+        vol.refresh_from_db()
+        assert vol.exists()
+        assert base_vol.path() in vol._libvirt_volume.XMLDesc(0)
+        assert len(threads) == 1
+        assert threads[0] is not threading.current_thread()
+        self.libvirt_vol_up_mock.assert_not_called()
@@ -277,6 +277,27 @@ class TestVolumeXml(BaseTestXMLBuilder):
                        '    </backingStore>\n'
                        '</volume>\n')
 
+    def test_permissions(self):
+        xml = self.xml_builder.build_volume_xml(
+            name='test_name',
+            capacity=1048576,
+            vol_format='raw',
+            backing_store_path=None,
+            backing_store_format=None,
+            permissions_mode='0444',
+        )
+        assert xml == ('<?xml version="1.0" encoding="utf-8"?>\n'
+                       '<volume>\n'
+                       '    <name>test_name</name>\n'
+                       '    <capacity>1048576</capacity>\n'
+                       '    <target>\n'
+                       '        <format type="raw"/>\n'
+                       '        <permissions>\n'
+                       '            <mode>0444</mode>\n'
+                       '        </permissions>\n'
+                       '    </target>\n'
+                       '</volume>\n')
+
 
 class TestSnapshotXml(BaseTestXMLBuilder):
 
@@ -598,6 +619,45 @@ class TestNodeXml(BaseTestXMLBuilder):
 </domain>
 """
 
+    def test_not_pretty(self):
+        params = dict(
+            name='test_name',
+            hypervisor='test_description',
+            use_host_cpu=True,
+            vcpu=4,
+            memory=1024,
+            use_hugepages=False,
+            hpet=True,
+            os_type='hvm',
+            architecture='i686',
+            boot=['hd'],
+            reboot_timeout=None,
+            bootmenu_timeout=0,
+            emulator='/usr/bin/kvm',
+            has_vnc=False,
+            vnc_password=None,
+            local_disk_devices=self.disk_devices,
+            interfaces=self.interfaces,
+            acpi=False,
+            numa=[],
+        )
+        xml = self.xml_builder.build_node_xml(pretty=False, **params)
+        pretty_xml = self.xml_builder.build_node_xml(**params)
+
+        assert '\n' not in xml
+        assert xml == ''.join(
+            line.strip() for line in pretty_xml.splitlines())
+
+    def test_fragments_cache(self):
+        fragment = self.xml_builder._get_fragment(
+            'devices_head', '/usr/bin/kvm', True, None)
+        assert [elem.tag for elem in fragment] == [
+            'controller', 'emulator', 'graphics']
+        assert self.xml_builder._get_fragment(
+            'devices_head', '/usr/bin/kvm', True, None) is fragment
+        assert self.xml_builder._get_fragment(
+            'devices_head', '/usr/bin/qemu-kvm', True, None) is not fragment
+
 
 class TestNWfilterXml(BaseTestXMLBuilder):
 
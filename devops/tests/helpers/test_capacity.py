@@ -0,0 +1,142 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+import mock
+
+from devops.helpers import capacity
+from devops.models import Environment
+
+
+class TestCapacityPlanner(TestCase):
+
+    def setUp(self):
+        super(TestCapacityPlanner, self).setUp()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.image_path = os.path.join(self.tmp_dir, 'admin.iso')
+        with open(self.image_path, 'wb') as f:
+            f.write(b'\0' * 1024)
+
+        patcher = mock.patch(
+            'devops.models.driver.Driver.check_capacity')
+        self.check_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.conf = {
+            'template': {
+                'devops_settings': {
+                    'env_name': 'test_env',
+                    'address_pools': {},
+                    'groups': [
+                        self._group('rack-01', nodes=2),
+                        self._group('rack-02', nodes=1),
+                    ]
+                }
+            }
+        }
+
+    def _group(self, name, nodes):
+        return {
+            'name': name,
+            'driver': {
+                'name': 'devops.driver.dummy',
+                'params': {'dummy_parameter': 15},
+            },
+            'l2_network_devices': {
+                'admin': {'address_pool': 'pool1'},
+                'public': {'address_pool': 'pool2'},
+            },
+            'group_volumes': [
+                {'name': 'base', 'capacity': 10},
+            ],
+            'nodes': [
+                {
+                    'name': '{0}-slave-{1}'.format(name, i),
+                    'role': 'fuel_slave',
+                    'params': {
+                        'memory': 2048,
+                        'volumes': [
+                            {'name': 'system',
+                             'source_image': self.image_path},
+                            {'name': 'data', 'capacity': 1},
+                            {'name': 'overlay', 'backing_store': 'base'},
+                        ],
+                    },
+                } for i in range(nodes)
+            ],
+        }
+
+    def test_plan_environment(self):
+        report = capacity.plan_environment(self.conf)
+
+        assert report.ok
+        assert list(report.requirements) == ['rack-01', 'rack-02']
+        rack1 = report.requirements['rack-01']
+        assert rack1.nodes == 2
+        assert rack1.memory == 4096
+        assert rack1.max_memory == 2048
+        assert rack1.hugepages == 0
+        assert rack1.networks == 2
+        assert rack1.disk_thick == 2 * 1024
+        assert rack1.disk_thin == (10 + 2 * (1 + 10)) * capacity.GB
+        assert rack1.images == {self.image_path}
+
+        total = report.total
+        assert total.nodes == 3
+        assert total.memory == 6144
+        assert total.networks == 4
+
+        # both groups use the same driver settings, so they are checked
+        # together once
+        self.check_mock.assert_called_once()
+        requirements, _ = self.check_mock.call_args[0]
+        assert requirements.nodes == 3
+
+    def test_plan_environment_missing_image(self):
+        os.remove(self.image_path)
+
+        report = capacity.plan_environment(self.conf)
+
+        assert not report.ok
+        assert report.errors[0] == 'Source image {!r} does not exist'.format(
+            self.image_path)
+        assert 'ERROR: Source image' in str(report)
+
+    def test_plan_environment_drivers(self):
+        self.conf['template']['devops_settings']['groups'][1]['driver'][
+            'params']['dummy_parameter'] = 20
+
+        capacity.plan_environment(self.conf)
+
+        assert self.check_mock.call_count == 2
+
+    def test_plan_environment_creates_nothing(self):
+        capacity.plan_environment(self.conf)
+
+        assert Environment.objects.count() == 0
+
+    def test_report(self):
+        report = capacity.CapacityReport()
+        report.warning('host is busy')
+        assert report.ok
+        report.error('host is full')
+        assert not report.ok
+        assert str(report).splitlines()[1:] == [
+            'ERROR: host is full', 'WARNING: host is busy']
@@ -0,0 +1,106 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from devops.helpers import hashing
+
+
+class TestTreeHash(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'image')
+        with open(self.path, 'wb') as f:
+            f.write(b'a' * 10 + b'b' * 10 + b'c' * 5)
+
+    def test_tree_hash(self):
+        digests = [hashlib.sha256(data).digest()
+                   for data in (b'a' * 10, b'b' * 10, b'c' * 5)]
+        expected = hashlib.sha256(b''.join(digests)).hexdigest()
+        assert hashing.tree_hash(self.path, chunk_size=10,
+                                 workers=2) == expected
+
+    def test_single_chunk(self):
+        expected = hashlib.sha256(
+            hashlib.sha256(b'a' * 10 + b'b' * 10 + b'c' * 5).digest()
+        ).hexdigest()
+        assert hashing.tree_hash(self.path, chunk_size=1024) == expected
+
+    def test_empty_file(self):
+        path = os.path.join(self.tmp_dir, 'empty')
+        open(path, 'wb').close()
+        assert hashing.tree_hash(path) == hashlib.sha256().hexdigest()
+
+
+class TestHashCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'image')
+        with open(self.path, 'wb') as f:
+            f.write(b'image_data')
+        self.cache = hashing.HashCache(
+            os.path.join(self.tmp_dir, 'cache', 'hash_cache.json'))
+
+        self.tree_hash_mock = mock.Mock(wraps=hashing.tree_hash)
+        patcher = mock.patch('devops.helpers.hashing.tree_hash',
+                             self.tree_hash_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached(self):
+        digest = self.cache.get_digest(self.path)
+        assert self.tree_hash_mock.call_count == 1
+
+        # new instance reads the persistent cache
+        cache = hashing.HashCache(self.cache.cache_path)
+        assert cache.get_digest(self.path) == digest
+        assert self.tree_hash_mock.call_count == 1
+
+    def test_changed_file(self):
+        digest = self.cache.get_digest(self.path)
+        with open(self.path, 'wb') as f:
+            f.write(b'other_image_data')
+
+        assert self.cache.get_digest(self.path) != digest
+        assert self.tree_hash_mock.call_count == 2
+
+    def test_replaced_file(self):
+        digest = self.cache.get_digest(self.path)
+        stat = os.stat(self.path)
+        new_path = os.path.join(self.tmp_dir, 'new_image')
+        with open(new_path, 'wb') as f:
+            f.write(b'IMAGE_DATA')
+        os.utime(new_path, (stat.st_atime, stat.st_mtime))
+        os.rename(new_path, self.path)
+
+        # same size and mtime, but another inode
+        assert self.cache.get_digest(self.path) != digest
+
+    def test_corrupted_cache(self):
+        os.makedirs(os.path.dirname(self.cache.cache_path))
+        with open(self.cache.cache_path, 'w') as f:
+            f.write('{')
+        digest = self.cache.get_digest(self.path)
+        assert self.cache.get_digest(self.path) == digest
+        assert self.tree_hash_mock.call_count == 1
@@ -0,0 +1,299 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.test import override_settings
+from django.test import TestCase
+import mock
+
+from devops.helpers import helpers
+from devops.helpers import instrumentation
+from devops.helpers import subprocess_runner
+from devops import models
+
+
+class TestSpan(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = mock.Mock()
+        self.exporter.accepts.return_value = True
+        instrumentation.add_exporter(self.exporter)
+        self.addCleanup(instrumentation.remove_exporter, self.exporter)
+
+    def test_span(self):
+        with instrumentation.span('node.revert', node='slave-01') as span:
+            span.attrs['flags'] = 1
+
+        self.exporter.export.assert_called_once_with(span)
+        assert span.duration >= 0
+        assert span.to_dict() == {
+            'name': 'node.revert',
+            'start': span.start,
+            'duration': span.duration,
+            'error': None,
+            'attrs': {'node': 'slave-01', 'flags': 1},
+            'trace_id': span.trace_id,
+            'span_id': span.span_id,
+            'parent_id': None,
+        }
+
+    def test_nested_spans(self):
+        with instrumentation.span('env.revert') as parent:
+            assert instrumentation.current_span() is parent
+            with instrumentation.span('node.revert') as child:
+                pass
+        assert instrumentation.current_span() is None
+        assert child.trace_id == parent.trace_id
+        assert child.parent_id == parent.span_id
+        assert child.span_id != parent.span_id
+        assert len(parent.trace_id) == 32
+        assert len(parent.span_id) == 16
+
+    def test_span_error(self):
+        with self.assertRaises(ValueError):
+            with instrumentation.span('node.revert') as span:
+                raise ValueError()
+        assert span.error == 'ValueError'
+        self.exporter.export.assert_called_once_with(span)
+
+    def test_exporter_error(self):
+        self.exporter.export.side_effect = IOError()
+        with instrumentation.span('node.revert') as span:
+            pass
+        assert span.duration >= 0
+
+    def test_disabled(self):
+        instrumentation.remove_exporter(self.exporter)
+        self.addCleanup(instrumentation.add_exporter, self.exporter)
+        assert instrumentation.is_enabled() is False
+
+        with instrumentation.span('node.revert') as span:
+            pass
+        assert span.duration >= 0
+        assert self.exporter.export.called is False
+
+    def test_categories(self):
+        self.exporter.accepts.side_effect = lambda category: (
+            category == 'node')
+        assert instrumentation.is_enabled('node') is True
+        assert instrumentation.is_enabled('ssh') is False
+
+        with instrumentation.span('ssh.execute'):
+            pass
+        with instrumentation.span('node.revert') as span:
+            pass
+        self.exporter.export.assert_called_once_with(span)
+
+    def test_traced(self):
+        get_attrs = mock.Mock(return_value={'host': 'slave-01'})
+
+        @instrumentation.traced('ssh.download', get_attrs)
+        def download(source, target):
+            return target
+
+        assert download('a', target='b') == 'b'
+        get_attrs.assert_called_once_with('a', target='b')
+        span = self.exporter.export.call_args[0][0]
+        assert span.name == 'ssh.download'
+        assert span.attrs == {'host': 'slave-01'}
+
+    def test_hooks(self):
+        result = subprocess_runner.Subprocess.execute('true')
+        span = self.exporter.export.call_args[0][0]
+        assert span.name == 'subprocess.execute'
+        assert span.attrs == {'exit_code': result.exit_code}
+
+        predicate = mock.Mock(side_effect=[False, True])
+        predicate.__name__ = 'is_ready'
+        with mock.patch('time.sleep'):
+            helpers.wait(predicate, interval=1, timeout=10)
+        span = self.exporter.export.call_args[0][0]
+        assert span.name == 'wait.loop'
+        assert span.attrs == {'predicate': 'is_ready', 'checks': 2}
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = instrumentation.InMemoryExporter(
+            categories=('libvirt', 'sftp'))
+        instrumentation.add_exporter(self.exporter)
+        self.addCleanup(instrumentation.remove_exporter, self.exporter)
+        self.addCleanup(instrumentation.flush)
+
+    def test_metrics(self):
+        instrumentation.count('sftp.bytes', 10, direction='upload')
+        instrumentation.count('sftp.bytes', 5, direction='upload')
+        instrumentation.count('ssh.calls')
+        for value in (0.002, 0.2, 1000):
+            instrumentation.observe('libvirt.call.duration', value,
+                                    method='virDomain.info')
+
+        metrics = {metric['name']: metric
+                   for metric in instrumentation.get_metrics()}
+        assert sorted(metrics) == ['libvirt.call.duration', 'sftp.bytes']
+        assert metrics['sftp.bytes']['value'] == 15
+        assert metrics['sftp.bytes']['attrs'] == {'direction': 'upload'}
+        histogram = metrics['libvirt.call.duration']
+        assert histogram['count'] == 3
+        assert histogram['min'] == 0.002
+        assert histogram['max'] == 1000
+        assert sum(histogram['buckets']) == 3
+        assert histogram['buckets'][1] == 1
+        assert histogram['buckets'][-1] == 1
+
+        instrumentation.flush()
+        assert len(self.exporter.metrics) == 2
+        assert instrumentation.get_metrics() == []
+
+    def test_instrumented_proxy(self):
+        conn = mock.Mock()
+        conn.lookupByName.return_value = 'domain'
+        proxy = instrumentation.instrument(conn, 'libvirt')
+        assert isinstance(proxy, instrumentation.InstrumentedProxy)
+
+        assert proxy.lookupByName('tenv_slave-01') == 'domain'
+        conn.lookupByName.assert_called_once_with('tenv_slave-01')
+        assert [span.name for span in self.exporter.spans] == [
+            'libvirt.Mock.lookupByName']
+        assert instrumentation.get_metrics()[0]['value'] == 1
+
+        domain = instrumentation.instrument(mock.Mock(), 'libvirt')
+        proxy.defineXML(domain, flags=domain)
+        conn.defineXML.assert_called_once_with(
+            domain._obj, flags=domain._obj)
+
+        assert instrumentation.instrument(conn, 'ssh') is conn
+
+
+class TestOrmHook(TestCase):
+
+    def test_queries(self):
+        exporter = instrumentation.InMemoryExporter(categories=('orm',))
+        instrumentation.add_exporter(exporter)
+        self.addCleanup(instrumentation.remove_exporter, exporter)
+        instrumentation.flush()
+
+        list(models.Environment.objects.all())
+        models.Environment.objects.filter(name='tenv').count()
+
+        metrics = {metric['name']: metric
+                   for metric in instrumentation.get_metrics()}
+        assert metrics['orm.queries']['value'] == 2
+        assert metrics['orm.query.duration']['count'] == 2
+        instrumentation.flush()
+
+
+class TestConfigure(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        for name, value in (('_configured', False), ('_exporters', [])):
+            patcher = mock.patch.object(instrumentation, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(instrumentation, 'install_orm_hook')
+        self.install_orm_hook_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('atexit.register')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def configure(self, categories):
+        with override_settings(
+                INSTRUMENTATION_FILE=os.path.join(self.path, 'i.jsonl'),
+                INSTRUMENTATION_CATEGORIES=categories):
+            return instrumentation.get_exporters()
+
+    def test_orm_hook_is_installed_for_orm(self):
+        exporters = self.configure(['orm'])
+        assert len(exporters) == 1
+        self.install_orm_hook_mock.assert_called_once_with()
+
+    def test_orm_hook_is_not_installed(self):
+        exporters = self.configure(['libvirt'])
+        assert len(exporters) == 1
+        self.install_orm_hook_mock.assert_not_called()
+
+
+class TestJsonLinesExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_export(self):
+        stats_file = os.path.join(self.path, 'logs', 'stats.jsonl')
+        exporter = instrumentation.JsonLinesExporter(stats_file)
+        instrumentation.add_exporter(exporter)
+        self.addCleanup(instrumentation.remove_exporter, exporter)
+
+        with instrumentation.span('env.revert', env='env1'):
+            pass
+        with instrumentation.span('node.revert', role='fuel_slave'):
+            pass
+
+        spans = list(instrumentation.read_spans(stats_file))
+        assert [span['name'] for span in spans] == [
+            'env.revert', 'node.revert']
+        assert spans[1]['attrs'] == {'role': 'fuel_slave'}
+        assert list(instrumentation.read_spans(
+            os.path.join(self.path, 'missing.jsonl'))) == []
+
+    def test_otlp_export(self):
+        otlp_file = os.path.join(self.path, 'otlp.jsonl')
+        exporter = instrumentation.OtlpJsonExporter(otlp_file)
+        instrumentation.add_exporter(exporter)
+        self.addCleanup(instrumentation.remove_exporter, exporter)
+
+        with instrumentation.span('env.revert', env='env1') as parent:
+            with self.assertRaises(ValueError):
+                with instrumentation.span('node.revert', nodes=2):
+                    raise ValueError()
+        instrumentation.count('ssh.calls', 3)
+        instrumentation.flush()
+
+        with open(otlp_file) as f:
+            lines = [json.loads(line) for line in f]
+        spans = [line['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+                 for line in lines[:2]]
+        assert spans[0]['name'] == 'node.revert'
+        assert spans[0]['parentSpanId'] == parent.span_id
+        assert spans[0]['status'] == {'code': 2, 'message': 'ValueError'}
+        assert spans[0]['attributes'] == [
+            {'key': 'nodes', 'value': {'intValue': '2'}}]
+        assert spans[1]['traceId'] == parent.trace_id
+        assert 'parentSpanId' not in spans[1]
+        assert int(spans[1]['endTimeUnixNano']) >= int(
+            spans[1]['startTimeUnixNano'])
+
+        metrics = lines[2]['resourceMetrics'][0]['scopeMetrics'][0]
+        assert metrics['metrics'][0]['name'] == 'ssh.calls'
+        assert metrics['metrics'][0]['sum']['dataPoints'][0]['asInt'] == '3'
+
+
+class TestPercentile(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        assert instrumentation.percentile(values, 50) == 3
+        assert instrumentation.percentile(values, 95) == 5
+        assert instrumentation.percentile(values, 0) == 1
+        assert instrumentation.percentile([], 50) is None
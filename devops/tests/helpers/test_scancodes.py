@@ -0,0 +1,122 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import mock
+
+from devops.helpers import scancodes
+
+
+class TestScancodes(unittest.TestCase):
+
+    def test_from_string(self):
+        assert scancodes.from_string('a1<Enter>A<Wait><KillX>\n') == [
+            (0x1e,), (0x02,), (0x1c,), (0x2a, 0x1e), ('wait',),
+            (0x1d, 0x38, 0x0e)]
+
+    def test_to_batches(self):
+        codes = scancodes.from_string('12<Wait>3<Enter>')
+        assert scancodes.to_batches(codes) == [
+            (0x02, 0x03), ('wait',), (0x04, 0x1c)]
+
+    def test_to_batches_repeated_key(self):
+        codes = scancodes.from_string('hello')
+        assert scancodes.to_batches(codes) == [
+            (0x23, 0x12, 0x26), (0x26, 0x18)]
+
+    def test_to_batches_shift(self):
+        codes = scancodes.from_string('aBCd E')
+        assert scancodes.to_batches(codes) == [
+            (0x1e, 0x2a, 0x30, 0x2e), (0x20, 0x39, 0x2a, 0x12)]
+
+    def test_to_batches_combination(self):
+        codes = scancodes.from_string('a<KillX>b')
+        assert scancodes.to_batches(codes) == [
+            (0x1e,), (0x1d, 0x38, 0x0e), (0x30,)]
+
+    def test_to_batches_max_keys(self):
+        codes = scancodes.from_string('1234567AB')
+        assert scancodes.to_batches(codes, max_keys=4) == [
+            (0x02, 0x03, 0x04, 0x05), (0x06, 0x07, 0x08),
+            (0x2a, 0x1e, 0x30)]
+        assert scancodes.to_batches(codes, max_keys=1) == codes
+
+
+class TestTranslator(unittest.TestCase):
+
+    # kernel command of the Fuel master node
+    KERNEL_CMD = (
+        '<Wait>\n<Wait>\n<Wait>\n<Esc>\n<Wait>\n'
+        'vmlinuz initrd=initrd.img ks=cdrom:/ks.cfg\n'
+        ' ip=10.109.0.2::10.109.0.1:255.255.255.0:nailgun.test.domain.local'
+        ':eth0:off::: dns1=8.8.8.8 showmenu=no wait_for_external_config=yes'
+        ' build_images=0\n <Enter>\n')
+
+    def setUp(self):
+        self.translator = scancodes.Translator()
+
+    def test_translate(self):
+        assert self.translator.translate('a<b') == (
+            (0x1e,), (0x2a, 0x33), (0x30,))
+        assert self.translator.translate('<Tab><Unknown>x') == (
+            (0x0f,), (0x2d,))
+        assert scancodes.from_string(self.KERNEL_CMD) == list(
+            self.translator.translate(self.KERNEL_CMD))
+
+    def test_cache(self):
+        codes = self.translator.translate(self.KERNEL_CMD)
+        assert self.translator.translate(self.KERNEL_CMD) is codes
+
+        batches = self.translator.batches(self.KERNEL_CMD)
+        assert self.translator.batches(self.KERNEL_CMD) is batches
+        assert batches == tuple(scancodes.to_batches(codes))
+        assert scancodes.batches_from_string(self.KERNEL_CMD) == batches
+
+    def test_cache_size(self):
+        translator = scancodes.Translator(cache_size=2)
+        translate = mock.Mock(wraps=translator._translate)
+        translator._translate = translate
+
+        codes = translator.translate('a')
+        translator.translate('b')
+        assert translator.translate('a') is codes
+        assert translate.call_count == 2
+
+        # 'b' is the least recently used
+        translator.translate('c')
+        assert list(translator._cache) == [('codes', 'a'), ('codes', 'c')]
+        assert translator.translate('a') is codes
+        translator.translate('b')
+        assert translate.call_count == 4
+        assert list(translator._cache) == [('codes', 'a'), ('codes', 'b')]
+
+    def test_cache_disabled(self):
+        translator = scancodes.Translator(cache_size=0)
+        translate = mock.Mock(wraps=translator._translate)
+        translator._translate = translate
+
+        assert translator.translate('a') == self.translator.translate('a')
+        translator.translate('a')
+        assert translate.call_count == 2
+        assert not translator._cache
+
+    def test_cache_same_output(self):
+        long_cmd = self.KERNEL_CMD * 20
+        uncached = scancodes.Translator(cache_size=0)
+
+        assert uncached.translate(long_cmd) == self.translator.translate(
+            long_cmd)
+        assert uncached.batches(long_cmd) == self.translator.batches(
+            long_cmd)
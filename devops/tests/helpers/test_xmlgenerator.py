@@ -0,0 +1,87 @@
+#    Copyright 2016 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+from xml.dom import minidom
+# noinspection PyPep8Naming
+from xml.etree import ElementTree as ET
+
+import six
+
+from devops.helpers import xmlgenerator
+
+
+class TestXMLGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = xmlgenerator.XMLGenerator('domain', type='kvm')
+        self.xml.name('test & <node>')
+        with self.xml.devices:
+            with self.xml.disk(type='file', device='disk'):
+                self.xml.source(file='/tmp/"disk".img')
+                self.xml.serial(123)
+            self.xml.emulator('/usr/bin/kvm')
+            # pylint: disable=pointless-statement
+            # noinspection PyStatementEffect
+            self.xml.video
+            # pylint: enable=pointless-statement
+
+    @staticmethod
+    def minidom_tostring(elem):
+        s = minidom.parseString(ET.tostring(elem, encoding='utf-8'))
+        s = s.toprettyxml(indent='    ', encoding='utf-8')
+        return s if six.PY2 else str(s, encoding='utf-8')
+
+    def test_str(self):
+        assert str(self.xml) == self.minidom_tostring(self.xml.root)
+        assert str(self.xml) == (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<domain type="kvm">\n'
+            '    <name>test &amp; &lt;node&gt;</name>\n'
+            '    <devices>\n'
+            '        <disk device="disk" type="file">\n'
+            '            <source file="/tmp/&quot;disk&quot;.img"/>\n'
+            '            <serial>123</serial>\n'
+            '        </disk>\n'
+            '        <emulator>/usr/bin/kvm</emulator>\n'
+            '        <video/>\n'
+            '    </devices>\n'
+            '</domain>\n')
+
+    def test_not_pretty(self):
+        assert self.xml.to_string(pretty=False) == (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<domain type="kvm">'
+            '<name>test &amp; &lt;node&gt;</name>'
+            '<devices>'
+            '<disk device="disk" type="file">'
+            '<source file="/tmp/&quot;disk&quot;.img"/>'
+            '<serial>123</serial>'
+            '</disk>'
+            '<emulator>/usr/bin/kvm</emulator>'
+            '<video/>'
+            '</devices>'
+            '</domain>')
+
+    def test_mixed_content(self):
+        root = ET.fromstring('<a>text<b x="1"/>tail<c>d</c></a>')
+        assert xmlgenerator.tostring(root) == self.minidom_tostring(root)
+
+    def test_sub_element(self):
+        root = ET.Element('memory')
+        elem = xmlgenerator.sub_element(root, 'size', 1024, unit='KiB',
+                                        count=2)
+        assert elem.text == '1024'
+        assert elem.attrib == {'unit': 'KiB', 'count': '2'}
+        assert xmlgenerator.sub_element(root, 'hugepages').text is None
@@ -17,9 +17,17 @@
 # pylint: disable=no-self-use
 
 import datetime
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from dateutil import tz
+from django.test.utils import override_settings
 import mock
 import netaddr
 
@@ -74,6 +82,52 @@ class TestMain(unittest.TestCase):
             shell.main(['start'])
 
 
+class TestStartup(unittest.TestCase):
+
+    # seconds to import devops.shell, the best of several runs
+    IMPORT_TIME_BUDGET = 1.5
+
+    LAZY_MODULES = ('keystoneauth1', 'libvirt', 'netaddr', 'paramiko',
+                    'tabulate', 'yaml')
+
+    SCRIPT = (
+        'import json, logging, sys, time\n'
+        'start = time.time()\n'
+        'import devops.shell\n'
+        'print(json.dumps({"time": time.time() - start,'
+        ' "modules": sorted(sys.modules),'
+        ' "handlers": [type(h).__name__'
+        ' for h in logging.getLogger("devops").handlers],'
+        ' "paramiko_level": logging.getLogger("paramiko").level,'
+        ' "gmtime": logging.Formatter.converter is time.gmtime}))\n')
+
+    def import_shell(self, logs_dir):
+        env = dict(os.environ,
+                   DJANGO_SETTINGS_MODULE='devops.test_settings',
+                   LOGS_DIR=logs_dir)
+        output = subprocess.check_output(
+            [sys.executable, '-W', 'ignore', '-c', self.SCRIPT], env=env)
+        return json.loads(output.decode('utf-8').splitlines()[-1])
+
+    def test_import_time(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        logs_dir = os.path.join(path, 'logs')
+
+        results = [self.import_shell(logs_dir) for _ in range(3)]
+
+        loaded = {name.split('.')[0] for name in results[0]['modules']}
+        assert sorted(loaded.intersection(self.LAZY_MODULES)) == []
+        assert not os.path.exists(logs_dir)
+        # everything but the log file is configured at import
+        assert results[0]['handlers'] == ['StreamHandler',
+                                          '_DeferredSetupHandler']
+        assert results[0]['paramiko_level'] == logging.WARNING
+        assert results[0]['gmtime'] is True
+        assert min(result['time'] for result in results) < \
+            self.IMPORT_TIME_BUDGET
+
+
 class TestShell(unittest.TestCase):
 
     def patch(self, *args, **kwargs):
@@ -144,6 +198,16 @@ class TestShell(unittest.TestCase):
             m.name = env_name
             m.get_node.side_effect = lambda name: nodes.get(name)
             m.get_nodes.side_effect = nodes.values
+            m.get_nodes_state.side_effect = lambda: [
+                (n, mock.Mock(status='running')) for n in nodes.values()]
+            m.get_nodes_vnc_ports.side_effect = lambda: [
+                (n, n.get_vnc_port.return_value) for n in nodes.values()]
+            m.get_nodes_stats.side_effect = lambda interval: [
+                (n, mock.Mock(cpu=12.5, memory=1024, iops=30.0,
+                              read_mbps=1.25, write_mbps=0.5,
+                              rx_mbps=0.01, tx_mbps=0.02)
+                 if n.name == 'admin' else None)
+                for n in nodes.values()]
             m.get_address_pools.return_value = aps
             m.get_admin.side_effect = lambda: nodes['admin']
             m.get_admin_ip.return_value = admin_ip
@@ -166,6 +230,11 @@ class TestShell(unittest.TestCase):
                 nodes={}, aps=[]),
         }
         self.client_inst.list_env_names.side_effect = self.env_mocks.keys
+        self.client_inst.list_envs.side_effect = lambda: list(
+            self.env_mocks.values())
+        self.client_inst.get_admin_ips.side_effect = lambda: {
+            name: env.get_admin_ip.return_value
+            for name, env in self.env_mocks.items() if env.has_admin()}
         self.client_inst.get_env.side_effect = self.env_mocks.__getitem__
 
     def test_shell(self):
@@ -199,6 +268,8 @@ class TestShell(unittest.TestCase):
             'env1    109.10.0.2\n'
             'env2    109.10.1.2\n'
             'env3')
+        self.client_inst.get_admin_ips.assert_called_once_with()
+        assert self.client_inst.get_env.called is False
 
     def test_list_ips_timestamps(self):
         sh = shell.Shell(['list', '--ips', '--timestamps'])
@@ -211,6 +282,38 @@ class TestShell(unittest.TestCase):
             'env2    109.10.1.2  2016-05-12_17:12:11\n'
             'env3                2016-05-12_17:12:12')
 
+    def test_list_jsonl(self):
+        sh = shell.Shell(['list', '--ips', '--timestamps', '--format',
+                          'jsonl'])
+        sh.execute()
+
+        self.print_mock.assert_has_calls((
+            mock.call('{"name": "env1", "admin_ip": "109.10.0.2", '
+                      '"created": "2016-05-12_17:12:10"}'),
+            mock.call('{"name": "env2", "admin_ip": "109.10.1.2", '
+                      '"created": "2016-05-12_17:12:11"}'),
+            mock.call('{"name": "env3", "admin_ip": "", '
+                      '"created": "2016-05-12_17:12:12"}'),
+        ))
+        assert self.print_mock.call_count == 3
+
+    def test_list_json(self):
+        sh = shell.Shell(['list', '--format', 'json'])
+        sh.execute()
+
+        output = '\n'.join(
+            args[0] for args, _ in self.print_mock.call_args_list)
+        assert json.loads(output) == [
+            {'name': 'env1'}, {'name': 'env2'}, {'name': 'env3'}]
+
+    def test_list_none_json(self):
+        self.env_mocks.clear()
+
+        sh = shell.Shell(['list', '--format', 'json'])
+        sh.execute()
+
+        self.print_mock.assert_called_once_with('[]')
+
     def test_list_none(self):
         self.env_mocks.clear()
 
@@ -220,6 +323,14 @@ class TestShell(unittest.TestCase):
 
         assert self.print_mock.called is False
 
+    def test_list_none_csv(self):
+        self.env_mocks.clear()
+
+        sh = shell.Shell(['list', '--timestamps', '--format', 'csv'])
+        sh.execute()
+
+        self.print_mock.assert_called_once_with('name,created')
+
     def test_show(self):
         sh = shell.Shell(['show', 'env1'])
         sh.execute()
@@ -231,6 +342,34 @@ class TestShell(unittest.TestCase):
             ' 5005  admin        rack-01\n'
             ' 5005  slave-00     rack-01\n'
             ' 5005  slave-01     rack-01')
+        self.env_mocks['env1'].get_nodes_vnc_ports.assert_called_once_with()
+        assert self.env_mocks['env1'].get_nodes_state.called is False
+        for node in self.nodes['env1'].values():
+            assert node.get_vnc_port.called is False
+
+    def test_show_state(self):
+        sh = shell.Shell(['show', 'env1', '--state'])
+        sh.execute()
+
+        self.print_mock.assert_called_once_with(
+            '  VNC  NODE-NAME    GROUP-NAME    STATE\n'
+            '-----  -----------  ------------  -------\n'
+            ' 5005  admin        rack-01       running\n'
+            ' 5005  slave-00     rack-01       running\n'
+            ' 5005  slave-01     rack-01       running')
+
+    def test_show_csv(self):
+        self.nodes['env1']['slave-01'].get_vnc_port.return_value = None
+        sh = shell.Shell(['show', 'env1', '--state', '--format', 'csv'])
+        sh.execute()
+
+        self.print_mock.assert_has_calls((
+            mock.call('vnc,node_name,group_name,state'),
+            mock.call('5005,admin,rack-01,running'),
+            mock.call('5005,slave-00,rack-01,running'),
+            mock.call(',slave-01,rack-01,running'),
+        ))
+        assert self.print_mock.call_count == 4
 
     def test_show_none(self):
         sh = shell.Shell(['show', 'env2'])
@@ -239,6 +378,24 @@ class TestShell(unittest.TestCase):
         self.client_inst.get_env.assert_called_once_with('env2')
         assert self.print_mock.called is False
 
+    def test_stats(self):
+        sh = shell.Shell(['stats', 'env1', '--interval', '2'])
+        sh.execute()
+
+        self.client_inst.get_env.assert_called_once_with('env1')
+        self.env_mocks['env1'].get_nodes_stats.assert_called_once_with(2.0)
+        self.print_mock.assert_called_once_with(
+            'NODE-NAME    CPU %    MEMORY MB    IOPS    READ MB/s    '
+            'WRITE MB/s    RX MB/s    TX MB/s\n'
+            '-----------  -------  -----------  ------  -----------  '
+            '------------  ---------  ---------\n'
+            'admin        12.5     1024         30.0    1.25         '
+            '0.5           0.01       0.02\n'
+            'slave-00     -        -            -       -            '
+            '-             -          -\n'
+            'slave-01     -        -            -       -            '
+            '-             -          -')
+
     def test_erase(self):
         sh = shell.Shell(['erase', 'env1'])
         sh.execute()
@@ -306,6 +463,17 @@ class TestShell(unittest.TestCase):
             'snap1       2016-05-12 17:12:15  admin, slave-00\n'
             'snap2       2016-05-12 17:12:16  admin')
 
+    def test_snapshot_list_csv(self):
+        sh = shell.Shell(['snapshot-list', 'env1', '--format', 'csv'])
+        sh.execute()
+
+        self.print_mock.assert_has_calls((
+            mock.call('snapshot,created,nodes_names'),
+            mock.call('snap1,2016-05-12 17:12:15,"admin, slave-00"'),
+            mock.call('snap2,2016-05-12 17:12:16,admin'),
+        ))
+        assert self.print_mock.call_count == 3
+
     def test_snapshot_list_none(self):
         sh = shell.Shell(['snapshot-list', 'env2'])
         sh.execute()
@@ -335,6 +503,19 @@ class TestShell(unittest.TestCase):
             'public-pool01         109.10.1.0/24\n'
             'storage-pool01        109.10.2.0/24')
 
+    def test_net_list_jsonl(self):
+        sh = shell.Shell(['net-list', 'env1', '--format', 'jsonl'])
+        sh.execute()
+
+        records = [json.loads(args[0])
+                   for args, _ in self.print_mock.call_args_list]
+        assert records == [
+            {'network_name': 'fuelweb_admin-pool01',
+             'ip_net': '109.10.0.0/24'},
+            {'network_name': 'public-pool01', 'ip_net': '109.10.1.0/24'},
+            {'network_name': 'storage-pool01', 'ip_net': '109.10.2.0/24'},
+        ]
+
     def test_net_list_none(self):
         sh = shell.Shell(['net-list', 'env2'])
         sh.execute()
@@ -342,6 +523,55 @@ class TestShell(unittest.TestCase):
         self.client_inst.get_env.assert_called_once_with('env2')
         assert self.print_mock.called is False
 
+    def test_snapshot_stats(self):
+        stats_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
+        self.addCleanup(os.remove, stats_file.name)
+        spans = [
+            ('env.revert', {'env': 'env1'}, 6.0, None),
+            ('node.revert', {'env': 'env1', 'role': 'fuel_master'}, 3.0,
+             None),
+            ('node.revert', {'env': 'env1', 'role': 'fuel_slave'}, 1.0,
+             None),
+            ('node.revert', {'env': 'env1', 'role': 'fuel_slave'}, 2.0,
+             None),
+            ('node.revert', {'env': 'env1', 'role': 'fuel_slave'}, 9.0,
+             'libvirtError'),
+            ('node.revert', {'env': 'env2', 'role': 'fuel_slave'}, 5.0,
+             None),
+        ]
+        with stats_file:
+            for name, attrs, duration, err in spans:
+                stats_file.write(json.dumps(dict(
+                    name=name, attrs=attrs, duration=duration, error=err,
+                    start=0)) + '\n')
+            stats_file.write('{"name": "node.rev')
+
+        sh = shell.Shell(['snapshot-stats', '--stats-file', stats_file.name,
+                          '--env', 'env1'])
+        sh.execute()
+
+        self.print_mock.assert_called_once_with(
+            'PHASE        ROLE           COUNT    P50(s)    P95(s)\n'
+            '-----------  -----------  -------  --------  --------\n'
+            'env.revert   -                  1         6         6\n'
+            'node.revert  fuel_master        1         3         3\n'
+            'node.revert  fuel_slave         2         1         2')
+
+    def test_snapshot_stats_disabled(self):
+        sh = shell.Shell(['snapshot-stats'])
+        with self.assertRaises(error.DevopsError):
+            sh.execute()
+
+    def test_snapshot_stats_default_file(self):
+        read_spans = self.patch(
+            'devops.helpers.instrumentation.read_spans', return_value=[])
+
+        sh = shell.Shell(['snapshot-stats'])
+        with override_settings(SNAPSHOT_STATS_FILE='/tmp/stats.jsonl'):
+            sh.execute()
+
+        read_spans.assert_called_once_with('/tmp/stats.jsonl')
+
     def test_time_sync(self):
         self.env_mocks['env1'].get_curr_time.return_value = {
             'node1': 'Thu May 12 18:26:34 MSK 2016',
@@ -432,9 +662,34 @@ class TestShell(unittest.TestCase):
         )
 
     def test_create_env(self):
+        self.client_inst.plan_env_from_config.return_value.ok = True
+        self.client_inst.plan_env_from_config.return_value.warnings = []
+
         sh = shell.Shell(['create-env', 'myenv.yaml'])
         sh.execute()
 
+        self.client_inst.plan_env_from_config.assert_called_once_with(
+            'myenv.yaml')
+        self.client_inst.create_env_from_config.assert_called_once_with(
+            'myenv.yaml')
+
+    def test_create_env_not_enough_resources(self):
+        report = self.client_inst.plan_env_from_config.return_value
+        report.ok = False
+        report.warnings = []
+
+        sh = shell.Shell(['create-env', 'myenv.yaml'])
+        with self.assertRaises(error.DevopsError):
+            sh.execute()
+
+        assert self.client_inst.create_env_from_config.called is False
+
+    def test_create_env_skip_capacity_check(self):
+        sh = shell.Shell(['create-env', 'myenv.yaml',
+                          '--skip-capacity-check'])
+        sh.execute()
+
+        assert self.client_inst.plan_env_from_config.called is False
         self.client_inst.create_env_from_config.assert_called_once_with(
             'myenv.yaml')
 